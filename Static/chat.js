@@ -30,8 +30,192 @@ document.addEventListener("DOMContentLoaded", () => {
     if (sessionState === 'in_therapy_session' || sessionState === 'awaiting_therapy_start') {
         buildHistoryFromDOM();
     }
+
+    // Images are generated in the background; poll for any that are still being painted
+    document.querySelectorAll(".image-container.pending[data-job-id]").forEach(pollImageJob);
+
+    // Older sessions load a page at a time as the sidebar is scrolled to the bottom
+    const loadMoreSessionsItem = document.getElementById("load-more-sessions");
+    if (loadMoreSessionsItem) {
+        new IntersectionObserver(entries => {
+            if (entries.some(entry => entry.isIntersecting)) loadMoreSessions();
+        }).observe(loadMoreSessionsItem);
+    }
+});
+
+// Older messages load once the page has scrolled to the newest message, so the top marker isn't hit on arrival
+window.addEventListener("load", () => {
+    const loadOlderItem = document.getElementById("load-older-messages");
+    if (loadOlderItem) {
+        new IntersectionObserver(entries => {
+            if (entries.some(entry => entry.isIntersecting)) loadOlderMessages();
+        }).observe(loadOlderItem);
+    }
 });
 
+// 📜 Fetch the page of messages before the oldest one shown and prepend it, keeping the reader's place
+let loadingMessages = false;
+async function loadOlderMessages() {
+    const loadOlderItem = document.getElementById("load-older-messages");
+    if (loadingMessages || !chatWindow.dataset.nextCursor || !currentSessionId) return;
+    loadingMessages = true;
+    try {
+        const res = await fetch(`/api/sessions/${currentSessionId}/messages?cursor=${encodeURIComponent(chatWindow.dataset.nextCursor)}`);
+        if (!res.ok) throw new Error(`Server responded with status: ${res.status}`);
+        const data = await res.json();
+
+        const previousHeight = chatWindow.scrollHeight;
+        loadOlderItem.after(...data.messages.map(createMessageElement));
+        const addedHeight = chatWindow.scrollHeight - previousHeight;
+        if (chatWindow.scrollHeight > chatWindow.clientHeight) {
+            chatWindow.scrollTop += addedHeight;
+        } else {
+            window.scrollBy(0, addedHeight);
+        }
+
+        chatWindow.dataset.nextCursor = data.next_cursor || "";
+        if (!data.next_cursor) loadOlderItem.remove();
+    } catch (err) {
+        console.error(err);
+    } finally {
+        loadingMessages = false;
+    }
+}
+
+// Builds a message bubble from the messages API, matching the server-rendered markup
+function createMessageElement(msg) {
+    const messageContainer = document.createElement("div");
+    messageContainer.classList.add("message", msg.sender);
+    if ((msg.image_url || msg.job_id) && !msg.html) messageContainer.classList.add("image-only-message");
+
+    if (msg.image_url) {
+        const imageBubble = document.createElement("div");
+        imageBubble.classList.add("image-container");
+        imageBubble.appendChild(createDreamImage(msg.image_url));
+        messageContainer.appendChild(imageBubble);
+    } else if (msg.job_id) {
+        const imageBubble = document.createElement("div");
+        imageBubble.classList.add("image-container", "pending");
+        imageBubble.dataset.jobId = msg.job_id;
+        const pendingText = document.createElement("p");
+        pendingText.classList.add("image-pending");
+        pendingText.textContent = "Painting your dream...";
+        imageBubble.appendChild(pendingText);
+        messageContainer.appendChild(imageBubble);
+        pollImageJob(imageBubble);
+    }
+    if (msg.html) {
+        const textBubble = document.createElement("div");
+        textBubble.classList.add("message-text");
+        textBubble.innerHTML = msg.html; // Rendered server-side, like the template's `| safe`
+        messageContainer.appendChild(textBubble);
+    }
+    return messageContainer;
+}
+
+// 📚 Fetch the next page of the session sidebar and append it above the "load more" marker
+let loadingSessions = false;
+async function loadMoreSessions() {
+    const list = document.getElementById("chat-history-list");
+    const loadMoreItem = document.getElementById("load-more-sessions");
+    if (loadingSessions || !list.dataset.nextCursor) return;
+    loadingSessions = true;
+    try {
+        const res = await fetch(`/api/sessions?cursor=${encodeURIComponent(list.dataset.nextCursor)}`);
+        if (!res.ok) throw new Error(`Server responded with status: ${res.status}`);
+        const data = await res.json();
+
+        data.sessions.forEach(session => list.insertBefore(createSessionItem(session, list.dataset.selectedSessionId), loadMoreItem));
+        list.dataset.nextCursor = data.next_cursor || "";
+        if (!data.next_cursor) loadMoreItem.remove();
+    } catch (err) {
+        console.error(err);
+    } finally {
+        loadingSessions = false;
+    }
+}
+
+function createSessionItem(session, selectedSessionId) {
+    const item = document.createElement("li");
+    item.classList.add("chat-session");
+    if (String(session.id) === selectedSessionId) item.classList.add("selected");
+
+    const info = document.createElement("div");
+    info.classList.add("chat-session-info");
+    const link = document.createElement("a");
+    link.href = `/chat/${session.id}`;
+    link.classList.add("chat-link");
+    link.textContent = `${session.title ? session.title.slice(0, 30) : "Untitled dream"}...`;
+    const timestamp = document.createElement("small");
+    timestamp.classList.add("timestamp");
+    timestamp.textContent = session.display_time;
+    info.append(link, timestamp);
+
+    const deleteForm = document.createElement("form");
+    deleteForm.action = `/delete_chat/${session.id}`;
+    deleteForm.method = "post";
+    deleteForm.onsubmit = () => confirm('Are you sure you want to delete this chat?');
+    const deleteBtn = document.createElement("button");
+    deleteBtn.type = "submit";
+    deleteBtn.classList.add("delete-btn");
+    deleteBtn.title = "Delete";
+    deleteBtn.textContent = "🗑️";
+    deleteForm.append(deleteBtn);
+
+    item.append(info, deleteForm);
+    return item;
+}
+
+const IMAGE_POLL_INTERVAL_MS = 3000;
+
+// 🖼️ Stored images come in sizes: a small thumbnail for the chat and a full-size copy for the modal
+function imageVariantUrl(url, size) {
+    return url.startsWith("/images/") ? `${url}?size=${size}` : url;
+}
+
+function createDreamImage(url) {
+    const img = document.createElement("img");
+    img.src = imageVariantUrl(url, "thumb");
+    img.dataset.fullSrc = imageVariantUrl(url, "full");
+    img.alt = "Dream Visualization";
+    img.loading = "lazy";
+    img.classList.add("dream-image");
+    return img;
+}
+
+// 🎨 Poll the image job status endpoint until the dream image is ready
+async function pollImageJob(container) {
+    const jobId = container.dataset.jobId;
+    try {
+        const res = await fetch(`/image_jobs/${jobId}`);
+        if (res.ok) {
+            const data = await res.json();
+            if (data.image_url) {
+                container.replaceChildren(createDreamImage(data.image_url));
+                container.classList.remove("pending");
+                return;
+            }
+        } else if (res.status < 500 && res.status !== 429) {
+            // The job is gone or no longer ours (deleted session, expired login): retrying won't help
+            showImageFailed(container);
+            return;
+        } else {
+            console.error(`Server responded with status: ${res.status}`);
+        }
+    } catch (err) {
+        console.error(err);
+    }
+    setTimeout(() => pollImageJob(container), IMAGE_POLL_INTERVAL_MS);
+}
+
+function showImageFailed(container) {
+    const failedText = document.createElement("p");
+    failedText.classList.add("image-failed");
+    failedText.textContent = "The dream image could not be loaded.";
+    container.replaceChildren(failedText);
+    container.classList.remove("pending");
+}
+
 function updateInputPlaceholder() {
     if (sessionState === 'awaiting_therapy_start') {
         input.placeholder = "Type 'yes' to explore further...";
@@ -84,11 +268,7 @@ function appendMessage(sender, content, type = 'text') {
     // 2. Create the inner bubble for the image
     const imageBubble = document.createElement('div');
     imageBubble.classList.add('image-container');
-    const img = document.createElement("img");
-    img.src = content;
-    img.alt = "Dream Visualization";
-    img.classList.add("dream-image");
-    imageBubble.appendChild(img);
+    imageBubble.appendChild(createDreamImage(content));
     messageContainer.appendChild(imageBubble);
   } else {
     // 2. Create the inner, visible bubble for the text
@@ -113,38 +293,72 @@ function endSession() {
     sessionState = "session_ended";
 }
 
+// 📡 POST a JSON body and call onEvent for every server-sent event in the streamed response
+async function streamEvents(url, body, onEvent) {
+    const res = await fetch(url, {
+        method: "POST",
+        headers: { "Content-Type": "application/json" },
+        body: JSON.stringify(body)
+    });
+    if (!res.ok) {
+        throw new Error(`Server responded with status: ${res.status}`);
+    }
+
+    const reader = res.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = "";
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+
+        // Events are separated by a blank line; keep any partial event for the next read
+        const events = buffer.split("\n\n");
+        buffer = events.pop();
+        for (const event of events) {
+            const dataLine = event.split("\n").find(line => line.startsWith("data: "));
+            if (dataLine) onEvent(JSON.parse(dataLine.slice(6)));
+        }
+    }
+}
+
 // Function for the initial dream submission
 async function handleDreamSubmission(userText) {
     appendMessage("user", userText);
     const thinkingMsg = appendMessage("bot", "Dreaming up an interpretation...");
+    const thinkingText = thinkingMsg.querySelector(".message-text");
     input.value = "";
     sendBtn.disabled = true;
 
+    let receivedToken = false;
+    let finished = false; // Set by the 'done' or 'error' event; a stream can also just stop (dropped connection, proxy timeout)
     try {
-        const res = await fetch("/submit_message", {
-            method: "POST",
-            headers: { "Content-Type": "application/json" },
-            body: JSON.stringify({ dream_text: userText })
+        await streamEvents("/submit_message/stream", { dream_text: userText }, (data) => {
+            if (data.type === "token") {
+                // Replace the placeholder with the interpretation as it is written
+                if (!receivedToken) {
+                    thinkingText.textContent = "";
+                    receivedToken = true;
+                }
+                thinkingText.textContent += data.text;
+                chatWindow.scrollTop = chatWindow.scrollHeight;
+            } else if (data.type === "done") {
+                finished = true;
+                // Redirect to the new chat session page, which will load with the correct state
+                window.location.href = `/chat/${data.session_id}`;
+            } else if (data.type === "error") {
+                finished = true;
+                thinkingText.innerText = data.error || "Sorry, an error occurred: Could not create a new session.";
+                sendBtn.disabled = false;
+            }
         });
-
-        if (!res.ok) {
-            throw new Error(`Server responded with status: ${res.status}`);
-        }
-
-        const data = await res.json();
-
-        if (data.session_id) {
-             // Redirect to the new chat session page, which will load with the correct state
-             window.location.href = `/chat/${data.session_id}`;
-        } else {
-            thinkingMsg.innerText = `Sorry, an error occurred: ${data.error || "Could not create a new session."}`;
-            sendBtn.disabled = false;
-        }
-
     } catch (err) {
         console.error(err);
-        thinkingMsg.innerText = "Sorry, a connection error occurred while processing your dream.";
-        sendBtn.disabled = false;
+    } finally {
+        if (!finished) {
+            thinkingText.innerText = "Sorry, a connection error occurred while processing your dream.";
+            sendBtn.disabled = false;
+        }
     }
 }
 
@@ -195,37 +409,42 @@ async function handleTherapyStart(userText) {
 async function handleTherapyFollowUp(question) {
     appendMessage("user", question);
     const thinkingMsg = appendMessage("bot", "Thinking...");
+    const thinkingText = thinkingMsg.querySelector(".message-text");
     input.value = "";
     sendBtn.disabled = true;
 
+    let receivedToken = false;
+    let finished = false; // Set by the 'done' or 'error' event; a stream can also just stop (dropped connection, proxy timeout)
     try {
         buildHistoryFromDOM(); // Get the latest history
-        const res = await fetch("/therapy", {
-            method: "POST",
-            headers: { "Content-Type": "application/json" },
-            body: JSON.stringify({
-                question: question,
-                history: conversationHistory,
-                session_id: currentSessionId
-            })
+        await streamEvents("/therapy/stream", {
+            question: question,
+            history: conversationHistory,
+            session_id: currentSessionId
+        }, (data) => {
+            if (data.type === "token") {
+                if (!receivedToken) {
+                    thinkingText.textContent = "";
+                    receivedToken = true;
+                }
+                thinkingText.textContent += data.text;
+                chatWindow.scrollTop = chatWindow.scrollHeight;
+            } else if (data.type === "done") {
+                finished = true;
+                thinkingText.innerHTML = data.html; // Swap the raw tokens for the formatted answer
+                questionCount++; // Increment after successful question
+                updateInputPlaceholder(); // This will check the limit and end the session if needed
+            } else if (data.type === "error") {
+                finished = true;
+                thinkingText.innerText = data.error;
+            }
         });
-        if (!res.ok) throw new Error(`Server error: ${res.status}`);
-        const data = await res.json();
-        thinkingMsg.remove();
-
-        if (data.error){
-            appendMessage("bot", data.error);
-        } else {
-            appendMessage("bot", data.answer, true); // True because answer is HTML
-        }
-        
-        questionCount++; // Increment after successful question
-        updateInputPlaceholder(); // This will check the limit and end the session if needed
-
     } catch (err) {
         console.error(err);
-        thinkingMsg.innerText = "Sorry, an error occurred during the follow-up.";
     } finally {
+        if (!finished) {
+            thinkingText.innerText = "Sorry, an error occurred during the follow-up.";
+        }
         if(sessionState !== "session_ended") {
             sendBtn.disabled = false;
         }
@@ -331,7 +550,7 @@ document.addEventListener("DOMContentLoaded", () => {
             // Check if the clicked element is an image inside the chat
             if (event.target && event.target.classList.contains('dream-image')) {
                 modal.style.display = "flex"; // Use 'flex' to enable centering
-                modalImg.src = event.target.src;
+                modalImg.src = event.target.dataset.fullSrc || event.target.src; // Full size only when expanded
             }
         });
 
@@ -0,0 +1,596 @@
+"""
+Offline microbenchmarks for OneiroMind internals.
+
+Usage:
+    python benchmarks.py db [--iterations N]
+    python benchmarks.py plans
+    python benchmarks.py memory [--turns N]
+    python benchmarks.py writes [--writers N] [--submissions N]
+    python benchmarks.py login [--logins N] [--rounds N]
+    python benchmarks.py render [--messages N] [--iterations N]
+    python benchmarks.py images [--image PATH] [--iterations N]
+    python benchmarks.py index [--workers N] [--chunks N]
+    python benchmarks.py retrieval [--index PATH] [--embedding-latency SECONDS]
+    python benchmarks.py concurrency [--requests N] [--llm-latency SECONDS] [--max-slowdown X]
+"""
+import os
+import sys
+import time
+import sqlite3
+import argparse
+import threading
+import tempfile
+import asyncio
+import statistics
+from datetime import datetime, timezone
+
+import db_utils
+
+def _report(name, timings):
+    """Prints the median and p95 latency of a list of per-call timings (seconds)."""
+    timings = sorted(timings)
+    p95 = timings[int(len(timings) * 0.95) - 1]
+    print(f"  {name:<36} median {statistics.median(timings) * 1e6:8.1f} µs   p95 {p95 * 1e6:8.1f} µs")
+
+def _time_calls(func, iterations):
+    timings = []
+    for i in range(iterations):
+        start = time.perf_counter()
+        func(i)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+# --- Database connection layer ---
+def _seed_database(user_count=50, sessions_per_user=20, messages_per_session=6):
+    db_utils.migrate()
+    with db_utils.transaction() as cursor:
+        for user_number in range(user_count):
+            cursor.execute("INSERT INTO users (email, password_hash) VALUES (?, ?)", (f"user{user_number}@example.com", "x"))
+            user_id = cursor.lastrowid
+            for _ in range(sessions_per_user):
+                cursor.execute("INSERT INTO chat_sessions (user_id) VALUES (?)", (user_id,))
+                session_id = cursor.lastrowid
+                for message_number in range(messages_per_session):
+                    cursor.execute(
+                        "INSERT INTO messages (session_id, sender, text) VALUES (?, ?, ?)",
+                        (session_id, "user" if message_number % 2 == 0 else "bot", "I dreamt of falling. " * 20)
+                    )
+
+def _connect_per_call(sql, params, write=False):
+    """The original db_utils access pattern: open, run one statement, commit, close."""
+    conn = sqlite3.connect(db_utils.DATABASE_NAME)
+    conn.row_factory = sqlite3.Row
+    cursor = conn.cursor()
+    cursor.execute(sql, params)
+    result = None if write else [dict(row) for row in cursor.fetchall()]
+    if write:
+        conn.commit()
+    conn.close()
+    return result
+
+def bench_db(iterations):
+    """Compares per-call latency of a fresh connection per call against the pooled WAL connection."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_utils.DATABASE_NAME = os.path.join(tmp_dir, "bench.db")
+        _seed_database()
+        sessions = db_utils.get_user_chat_sessions(1)
+        session_id = sessions[0]['id']
+        write_session_id = sessions[1]['id'] # Writes go elsewhere so they don't grow the session being read
+
+        # Baseline: connection per call on the default rollback journal
+        db_utils.close_connections()
+        with sqlite3.connect(db_utils.DATABASE_NAME) as conn:
+            conn.execute("PRAGMA journal_mode = DELETE")
+        print("Connection per call (rollback journal):")
+        _report("is_user_session", _time_calls(lambda i: _connect_per_call(
+            "SELECT 1 FROM chat_sessions WHERE id = ? AND user_id = ?", (session_id, 1)), iterations))
+        _report("get_user_chat_sessions", _time_calls(lambda i: _connect_per_call(
+            "SELECT * FROM chat_sessions WHERE user_id = ? ORDER BY created_at DESC", (1,)), iterations))
+        _report("get_messages_for_session", _time_calls(lambda i: _connect_per_call(
+            "SELECT * FROM messages WHERE session_id = ? ORDER BY timestamp ASC", (session_id,)), iterations))
+        _report("add_message_to_session", _time_calls(lambda i: _connect_per_call(
+            "INSERT INTO messages (session_id, sender, text) VALUES (?, ?, ?)", (write_session_id, "user", "bench"), write=True), iterations))
+
+        # Pooled: one tuned WAL connection per thread, reused across calls
+        print("Pooled connection (WAL):")
+        db_utils.get_db_connection()
+        _report("is_user_session", _time_calls(lambda i: db_utils.is_user_session(1, session_id), iterations))
+        _report("get_user_chat_sessions", _time_calls(lambda i: db_utils.get_user_chat_sessions(1), iterations))
+        _report("get_messages_for_session", _time_calls(lambda i: db_utils.get_messages_for_session(session_id), iterations))
+        _report("add_message_to_session", _time_calls(lambda i: db_utils.add_message_to_session(write_session_id, "user", text="bench"), iterations))
+        db_utils.close_connections()
+
+# --- Query plans ---
+# The per-page-view queries; each must be answered from an index rather than a table scan
+HOT_QUERIES = {
+    "get_user_chat_sessions": ("SELECT * FROM chat_sessions WHERE user_id = ? ORDER BY created_at DESC", (1,)),
+    "get_messages_for_session": ("SELECT * FROM messages WHERE session_id = ? ORDER BY timestamp ASC", (1,)),
+    "get_messages_page": (
+        "SELECT * FROM messages WHERE session_id = ? AND (timestamp, id) < (?, ?) ORDER BY timestamp DESC, id DESC LIMIT ?",
+        (1, "2100-01-01", 0, 31)
+    ),
+    "get_message_texts_for_session": ("SELECT id, sender, text FROM messages WHERE session_id = ? AND id > ? AND text IS NOT NULL ORDER BY timestamp ASC", (1, 0)),
+    "get_session_memory": ("SELECT summary, summarized_upto FROM session_memory WHERE session_id = ?", (1,)),
+    "is_user_session": ("SELECT 1 FROM chat_sessions WHERE id = ? AND user_id = ?", (1, 1)),
+    "get_user_chat_sessions_page": (
+        f"SELECT {db_utils.SESSION_SUMMARY_COLUMNS} FROM chat_sessions s WHERE s.user_id = ? AND (s.created_at, s.id) < (?, ?) "
+        "ORDER BY s.created_at DESC, s.id DESC LIMIT ?", (1, "2100-01-01", 0, 31)
+    ),
+    "get_chat_session": (f"SELECT {db_utils.SESSION_SUMMARY_COLUMNS} FROM chat_sessions s WHERE s.id = ? AND s.user_id = ?", (1, 1)),
+    "get_pending_image_jobs_for_session": ("SELECT id, message_id FROM image_jobs WHERE session_id = ? AND status IN ('pending', 'running')", (1,)),
+}
+
+def check_query_plans():
+    """Prints the plan of every hot query and returns False if any of them scans a table or sorts."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_utils.DATABASE_NAME = os.path.join(tmp_dir, "plans.db")
+        db_utils.migrate()
+        conn = db_utils.get_db_connection()
+        all_indexed = True
+        for name, (sql, params) in HOT_QUERIES.items():
+            details = [row['detail'] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params)]
+            indexed = not any(detail.startswith("SCAN") or "TEMP B-TREE" in detail for detail in details)
+            all_indexed = all_indexed and indexed
+            print(f"  {'ok  ' if indexed else 'FAIL'} {name}: {'; '.join(details)}")
+        db_utils.close_connections()
+        return all_indexed
+
+# --- Batched writes under concurrency ---
+def _submit_one_per_statement(user_id):
+    """The write pattern of a dream submission before batching: six commits, each insert re-SELECTed."""
+    with db_utils.transaction() as cursor:
+        cursor.execute("INSERT INTO chat_sessions (user_id, created_at) VALUES (?, ?)", (user_id, datetime.now(timezone.utc)))
+        session_id = cursor.lastrowid
+    message_ids = []
+    for sender, text in (("user", "I dreamt of falling."), ("bot", None), ("bot", "Interpretation. " * 40), ("bot", "Follow-up?")):
+        with db_utils.transaction() as cursor:
+            cursor.execute(
+                "INSERT INTO messages (session_id, sender, text, timestamp) VALUES (?, ?, ?, ?)",
+                (session_id, sender, text, datetime.now(timezone.utc))
+            )
+            cursor.execute("SELECT * FROM messages WHERE id = ?", (cursor.lastrowid,))
+            message_ids.append(cursor.fetchone()['id'])
+    with db_utils.transaction() as cursor:
+        now_utc = datetime.now(timezone.utc)
+        cursor.execute(
+            "INSERT INTO image_jobs (session_id, message_id, interpretation, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+            (session_id, message_ids[1], "Interpretation.", now_utc, now_utc)
+        )
+
+def _submit_batched(user_id):
+    """The batched write pattern: the opening message, then the interpretation and its job, in two commits."""
+    session_id = db_utils.start_chat_session(user_id, "I dreamt of falling.")
+    db_utils.store_interpretation(session_id, "Interpretation. " * 40, "Follow-up?")
+
+def _run_writers(submit, writers, submissions):
+    """Runs `submissions` dream submissions on each of `writers` threads; returns (elapsed seconds, per-call timings)."""
+    timings = []
+    timings_lock = threading.Lock()
+
+    def writer(user_id):
+        local_timings = _time_calls(lambda i: submit(user_id), submissions)
+        with timings_lock:
+            timings.extend(local_timings)
+
+    threads = [threading.Thread(target=writer, args=(user_id,)) for user_id in range(1, writers + 1)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - started, timings
+
+def bench_writes(writers, submissions):
+    """Compares dream-submission write throughput of one commit per statement against unit-of-work batches."""
+    for name, submit in (("one commit per statement", _submit_one_per_statement), ("unit of work", _submit_batched)):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db_utils.DATABASE_NAME = os.path.join(tmp_dir, "writes.db")
+            _seed_database(user_count=writers, sessions_per_user=0)
+            elapsed, timings = _run_writers(submit, writers, submissions)
+            print(f"{name.capitalize()} ({writers} writers): {writers * submissions / elapsed:8.1f} submissions/s")
+            _report("submission", timings)
+            db_utils.close_connections()
+
+# --- Password hashing ---
+async def _run_logins(verify, logins):
+    """Runs concurrent logins while a heartbeat measures how long the event loop stalls; returns (elapsed, max stall)."""
+    max_stall = 0.0
+
+    async def heartbeat():
+        nonlocal max_stall
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(0.01)
+            max_stall = max(max_stall, time.perf_counter() - started - 0.01)
+
+    heartbeat_task = asyncio.create_task(heartbeat())
+    await asyncio.sleep(0)
+    started = time.perf_counter()
+    await asyncio.gather(*(verify() for _ in range(logins)))
+    elapsed = time.perf_counter() - started
+    await asyncio.sleep(0.02) # Let the heartbeat record a stall that lasted until the end
+    heartbeat_task.cancel()
+    return elapsed, max_stall
+
+def bench_login(logins, rounds):
+    """Compares login throughput and event-loop stalls of inline bcrypt against process pools of growing size."""
+    import passwords
+    password_hash = passwords.hash_password_sync("correct horse", rounds)
+
+    async def inline_verify():
+        return passwords.verify_password_sync("correct horse", password_hash)
+
+    async def pooled_verify():
+        return await passwords.verify_password("correct horse", password_hash)
+
+    elapsed, stall = asyncio.run(_run_logins(inline_verify, logins))
+    print(f"  {'inline on the event loop':<28} {logins / elapsed:7.1f} logins/s   max loop stall {stall * 1000:8.1f} ms")
+    for workers in sorted({1, 2, 4, os.cpu_count() or 1}):
+        passwords.HASH_WORKERS = workers
+        asyncio.run(pooled_verify()) # Start the worker processes outside the measurement
+        elapsed, stall = asyncio.run(_run_logins(pooled_verify, logins))
+        print(f"  {f'process pool, {workers} workers':<28} {logins / elapsed:7.1f} logins/s   max loop stall {stall * 1000:8.1f} ms")
+        passwords.shutdown()
+    print(f"  ({os.cpu_count()} CPU cores, bcrypt cost {rounds})")
+
+# --- Message rendering ---
+SAMPLE_INTERPRETATION = (
+    "**Direct Meaning:** Falling often reflects a loss of control.\n"
+    "* **Emotional Meaning:** anxiety about a recent change\n"
+    "* **Symbolic Meaning:** letting go of an old role\n"
+    "* **Personal Context:** work pressure and upcoming deadlines\n"
+) * 4
+
+def bench_render(message_count, iterations):
+    """Compares page renders that run markdown_to_html on every message against serving the HTML stored at write time."""
+    import rendering
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_utils.DATABASE_NAME = os.path.join(tmp_dir, "render.db")
+        db_utils.migrate()
+        user_id = db_utils.add_user("render@example.com", "x")
+        session_id = db_utils.start_chat_session(user_id, "I dreamt of falling.")
+        db_utils.add_messages_to_session(session_id, [("bot", SAMPLE_INTERPRETATION)] * (message_count - 1))
+        messages = db_utils.get_messages_for_session(session_id)
+
+        print(f"Rendering a {len(messages)}-message session:")
+        _report("markdown_to_html on every read", _time_calls(
+            lambda i: [rendering.markdown_to_html(msg['text']) for msg in messages], iterations))
+        _report("stored HTML", _time_calls(lambda i: [rendering.message_html(msg) for msg in messages], iterations))
+        db_utils.close_connections()
+
+# --- Image variants ---
+def _sample_image(size=1024):
+    """A stand-in for a generated image: gradients, fine detail and grain, which compress roughly like a real render."""
+    from PIL import Image
+    gradient = Image.linear_gradient("L").resize((size, size))
+    detail = Image.effect_mandelbrot((size, size), (-2.0, -1.25, 0.5, 1.25), 64)
+    noise = Image.effect_noise((size, size), 32)
+    return Image.merge("RGB", (
+        Image.blend(gradient, noise, 0.25),
+        Image.blend(detail, noise, 0.25),
+        Image.blend(Image.radial_gradient("L").resize((size, size)), noise, 0.25),
+    ))
+
+def bench_images(source, iterations):
+    """Reports payload size and encode time of each WebP variant against the original (and an optimized) PNG."""
+    from PIL import Image
+    import image_variants
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        original = os.path.join(tmp_dir, "original.png")
+        if source:
+            with Image.open(source) as image:
+                image.save(original, format="PNG")
+        else:
+            _sample_image().save(original, format="PNG")
+        with Image.open(original) as image:
+            print(f"Source image {image.size[0]}x{image.size[1]}:")
+        print(f"  {'original PNG':<36} {os.path.getsize(original):>10,} bytes")
+
+        optimized = os.path.join(tmp_dir, "optimized.png")
+        start = time.perf_counter()
+        with Image.open(original) as image:
+            image.save(optimized, format="PNG", optimize=True)
+        print(f"  {'optimized PNG':<36} {os.path.getsize(optimized):>10,} bytes   {(time.perf_counter() - start) * 1000:7.1f} ms")
+
+        for variant, (max_side, quality) in image_variants.VARIANTS.items():
+            dest = os.path.join(tmp_dir, f"{variant}.webp")
+            timings = [image_variants.encode_variant(original, dest, max_side, quality)[1] for _ in range(iterations)]
+            label = f"{variant} WebP ({max_side or 'full'} px, q{quality})"
+            print(f"  {label:<36} {os.path.getsize(dest):>10,} bytes   {statistics.median(timings) * 1000:7.1f} ms median encode")
+
+# --- Knowledge base across workers ---
+def _process_memory():
+    """RSS and PSS (resident pages, with shared ones split between the processes mapping them) in MB."""
+    memory = {}
+    with open("/proc/self/smaps_rollup") as f:
+        for line in f:
+            field, value = line.split()[:2]
+            if field in ("Rss:", "Pss:"):
+                memory[field[:-1].lower()] = int(value) / 1024
+    return memory
+
+def _index_worker(mode, index_path, barrier, results):
+    """Loads the knowledge base one way, serves a few queries, then reports once every worker is up."""
+    from langchain_community.vectorstores import FAISS
+    from loadtest import FakeEmbeddings
+    import shared_index
+    embeddings = FakeEmbeddings()
+    before = _process_memory()
+    start = time.perf_counter()
+    if mode == "pickle":
+        retriever = FAISS.load_local(index_path, embeddings, allow_dangerous_deserialization=True).as_retriever(search_kwargs={"k": 5})
+    else:
+        retriever = shared_index.load_retriever(index_path, embeddings, k=5)
+    load_seconds = time.perf_counter() - start
+    for i in range(20):
+        retriever.invoke(f"I dreamt of falling, night {i}")
+    barrier.wait() # Measure only once every worker has the index loaded, so shared pages are split between them
+    after = _process_memory()
+    results.put({"load_seconds": load_seconds, "rss_mb": after["rss"] - before["rss"], "pss_mb": after["pss"] - before["pss"]})
+    barrier.wait()
+
+def bench_index(workers, chunk_count):
+    """Compares per-worker startup time and memory of unpickling the FAISS store against mapping the shared index."""
+    import multiprocessing
+    from langchain_community.vectorstores import FAISS
+    from loadtest import FakeEmbeddings
+    import shared_index
+    context = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        texts = [f"Symbol {i}: " + "Dreaming of this often reflects change, control and safety in waking life. " * 20 for i in range(chunk_count)]
+        vector_store = FAISS.from_texts(texts, FakeEmbeddings())
+        vector_store.save_local(tmp_dir)
+        shared_index.export(vector_store, tmp_dir, "benchmark")
+        print(f"{chunk_count} chunks, {workers} workers (memory is the growth from loading and querying the index):")
+        for mode in ("pickle", "shared"):
+            barrier = context.Barrier(workers)
+            results = context.Queue()
+            processes = [context.Process(target=_index_worker, args=(mode, tmp_dir, barrier, results)) for _ in range(workers)]
+            for process in processes:
+                process.start()
+            samples = [results.get() for _ in processes]
+            for process in processes:
+                process.join()
+            label = "FAISS.load_local (pickle)" if mode == "pickle" else "shared mmap index"
+            print(f"  {label:<28} load {statistics.median(s['load_seconds'] for s in samples) * 1000:8.1f} ms   "
+                  f"RSS {statistics.median(s['rss_mb'] for s in samples):7.1f} MB   "
+                  f"PSS {statistics.median(s['pss_mb'] for s in samples):7.1f} MB per worker")
+
+# --- Hybrid retrieval ---
+SAMPLE_DREAMS = (
+    "I was being chased through a dark forest by a huge snake and my teeth started falling out.",
+    "I was flying over the ocean and then suddenly fell into the cold water.",
+    "My old school was on fire and I couldn't find the right door to get out.",
+    "I was late for an exam and the stairs kept going up forever.",
+    "A dog and a cat were fighting at my wedding while it stormed outside.",
+    "I found a key in a mirror that opened a door in my childhood house.",
+    "I was driving a car across a bridge that collapsed into the river.",
+    "A baby was crying in a hospital and nobody else could hear it.",
+    "Spiders were crawling out of a pile of money on my desk.",
+    "I missed the train and the station turned into a mountain covered in birds.",
+)
+
+def _hashed_bag_of_words(size=768, latency=0.0):
+    """Builds the offline embeddings stand-in (defined here so langchain is only imported when needed)."""
+    from langchain_core.embeddings import Embeddings
+
+    class HashedBagOfWords(Embeddings):
+        """
+        Offline stand-in for the embedding model: feature-hashed word counts, L2-normalized. It ranks by
+        shared words rather than meaning, so overlap figures from it are a proxy; pass --index for real ones.
+        """
+
+        def __init__(self, size=768, latency=0.0):
+            self.size = size
+            self.latency = latency
+
+        def embed_query(self, text):
+            import hashlib
+            import numpy as np
+            vector = np.zeros(self.size, dtype=np.float32)
+            for word in text.lower().split():
+                word = word.strip(".,:;!?()'\"")
+                if word:
+                    vector[int(hashlib.md5(word.encode("utf-8")).hexdigest(), 16) % self.size] += 1.0
+            norm = np.linalg.norm(vector)
+            return (vector / norm if norm else vector).tolist()
+
+        def embed_documents(self, texts):
+            return [self.embed_query(text) for text in texts]
+
+        async def aembed_query(self, text):
+            await asyncio.sleep(self.latency)
+            return self.embed_query(text)
+
+    return HashedBagOfWords(size, latency)
+
+def _synthetic_dictionary():
+    from loadtest import SYMBOLS
+    entries = []
+    for i, symbol in enumerate(SYMBOLS):
+        related = SYMBOLS[(i * 7 + 3) % len(SYMBOLS)]
+        entries.append(
+            f"{symbol.title()}: To dream of {symbol} suggests feelings about change and control. "
+            f"Seeing {symbol} together with {related} can point to a conflict between safety and freedom. "
+            + "Consider what was happening in waking life when the dream occurred. " * 10
+        )
+    return entries
+
+def bench_retrieval(index_path, embedding_latency):
+    """Compares latency of vector, lexical and hybrid retrieval, and how many of the vector retriever's top 5 the others return."""
+    import shared_index
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if index_path:
+            import dream_image
+            google_api_key, _ = dream_image.get_api_keys()
+            embeddings = dream_image.create_embeddings(google_api_key)
+            if not shared_index.is_current(index_path):
+                from langchain_community.vectorstores import FAISS
+                shared_index.export(FAISS.load_local(index_path, embeddings, allow_dangerous_deserialization=True), index_path, dream_image.EMBEDDING_MODEL)
+            print(f"Real index '{index_path}' and embeddings API:")
+        else:
+            from langchain_community.vectorstores import FAISS
+            embeddings = _hashed_bag_of_words(latency=embedding_latency)
+            vector_store = FAISS.from_texts(_synthetic_dictionary(), embeddings)
+            vector_store.save_local(tmp_dir)
+            shared_index.export(vector_store, tmp_dir, "hashed-bag-of-words")
+            index_path = tmp_dir
+            print(f"Synthetic dictionary, hashed bag-of-words embeddings with {embedding_latency * 1000:.0f} ms simulated latency:")
+
+        retrievers = {mode: shared_index.load_retriever(index_path, embeddings, k=5, mode=mode) for mode in shared_index.RETRIEVAL_MODES}
+
+        async def run(retriever):
+            timings, results = [], []
+            for dream in SAMPLE_DREAMS:
+                start = time.perf_counter()
+                documents = await retriever.ainvoke(dream)
+                timings.append(time.perf_counter() - start)
+                results.append([document.page_content for document in documents])
+            return timings, results
+
+        outcomes = {mode: asyncio.run(run(retriever)) for mode, retriever in retrievers.items()}
+        baseline = outcomes["vector"][1]
+        for mode, (timings, results) in outcomes.items():
+            overlap = statistics.mean(len(set(result) & set(expected)) / max(len(expected), 1) for result, expected in zip(results, baseline))
+            print(f"  {mode:<8} median {statistics.median(timings) * 1000:7.2f} ms   max {max(timings) * 1000:7.2f} ms   "
+                  f"overlap with vector top 5: {overlap:4.0%}")
+
+# --- Therapy conversation memory ---
+async def _stub_summarize(summary, new_lines):
+    """Stands in for the summary chain: keeps a bounded tail of everything folded so far."""
+    return f"{summary} {new_lines}".strip()[-600:]
+
+def bench_memory(turns):
+    """Compares the therapy prompt history size (estimated tokens) of the full transcript and the rolling memory."""
+    import conversation_memory
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_utils.DATABASE_NAME = os.path.join(tmp_dir, "memory.db")
+        db_utils.migrate()
+        user_id = db_utils.add_user("memory@example.com", "x")
+        session_id = db_utils.create_chat_session(user_id)
+        summaries = 0
+        print(f"  {'turn':>5} {'full transcript':>16} {'rolling memory':>15}")
+        for turn in range(1, turns + 1):
+            db_utils.add_message_to_session(session_id, "user", text=f"Question {turn}: what does the recurring staircase mean? " * 4)
+            before = db_utils.get_session_memory(session_id)
+            history = asyncio.run(conversation_memory.build_history(session_id, _stub_summarize))
+            summaries += db_utils.get_session_memory(session_id) != before
+            full = conversation_memory.format_messages(db_utils.get_message_texts_for_session(session_id))
+            if turn == 1 or turn % max(turns // 10, 1) == 0:
+                print(f"  {turn:>5} {conversation_memory.estimate_tokens(full):>16} {conversation_memory.estimate_tokens(history):>15}")
+            db_utils.add_message_to_session(session_id, "bot", text=f"Answer {turn}: staircases often stand for progress and effort. " * 6)
+        print(f"  Summary updates: {summaries} over {turns} turns")
+        db_utils.close_connections()
+
+# --- Concurrent submissions ---
+async def _time_submissions(base_url, requests):
+    import httpx
+    import loadtest
+    await loadtest.wait_until_ready(base_url, 120)
+    credentials = {"email": "concurrency@example.com", "password": "benchmark-password"}
+    async with httpx.AsyncClient(base_url=base_url, timeout=120) as client:
+        await client.post("/register", data=credentials)
+        await client.post("/login", data=credentials)
+
+        async def submit(i):
+            # Distinct texts, so the submissions are not coalesced into one
+            symbol = loadtest.SYMBOLS[i % len(loadtest.SYMBOLS)]
+            response = await client.post("/submit_message", json={"dream_text": f"I dreamt of {symbol}, night {i}."})
+            response.raise_for_status()
+
+        async def timed(*submissions):
+            start = time.perf_counter()
+            await asyncio.gather(*submissions)
+            return time.perf_counter() - start
+
+        await submit(0) # Warm-up: the first request pays for lazy imports and connection setup
+        single = await timed(submit(1))
+        concurrent = await timed(*(submit(i) for i in range(2, requests + 2)))
+    return single, concurrent
+
+def check_concurrency(requests, llm_latency, max_slowdown):
+    """
+    Serves the app on the load-test stubs and checks that `requests` concurrent /submit_message calls
+    finish in roughly the time of one. Returns False if they take more than `max_slowdown` times as long,
+    which means something on the request path is blocking the event loop.
+    """
+    import loadtest
+    stub_args = argparse.Namespace(
+        image_latency=0.5, image_size=256, llm_latency=llm_latency, token_delay=0.0, reply_words=40, embedding_latency=0.05
+    )
+    # Upstream limits high enough that no call queues in the limiter: this measures the server, not the quota
+    limits = {
+        f"{provider}_{limit}": str(requests * 4)
+        for provider in ("GEMINI", "EMBEDDINGS") for limit in ("CONCURRENCY", "RATE", "BURST", "MAX_QUEUE")
+    }
+    with tempfile.TemporaryDirectory() as workdir:
+        server, stability_stub, base_url = loadtest.start_app(stub_args, workdir, **limits)
+        try:
+            single, concurrent = asyncio.run(_time_submissions(base_url, requests))
+        except Exception:
+            loadtest.print_server_log(workdir)
+            raise
+        finally:
+            loadtest.stop_app(server, stability_stub)
+    slowdown = concurrent / single
+    print(f"Stubbed LLM latency {llm_latency * 1000:.0f} ms:")
+    print(f"  1 submission                        {single * 1000:8.1f} ms")
+    print(f"  {requests} concurrent submissions{' ' * (13 - len(str(requests)))}{concurrent * 1000:8.1f} ms   ({slowdown:.2f}x one)")
+    passed = slowdown <= max_slowdown
+    print(f"  {'ok  ' if passed else 'FAIL'} limit is {max_slowdown:.2f}x")
+    return passed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="OneiroMind microbenchmarks")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    db_parser = subparsers.add_parser("db", help="Per-call latency of the database connection layer")
+    db_parser.add_argument("--iterations", type=int, default=2000)
+    subparsers.add_parser("plans", help="Check that the hot queries use indexes (exits non-zero if not)")
+    memory_parser = subparsers.add_parser("memory", help="Therapy prompt history size with and without rolling memory")
+    memory_parser.add_argument("--turns", type=int, default=50)
+    writes_parser = subparsers.add_parser("writes", help="Dream-submission write throughput under concurrent writers")
+    writes_parser.add_argument("--writers", type=int, default=8)
+    writes_parser.add_argument("--submissions", type=int, default=200)
+    login_parser = subparsers.add_parser("login", help="Password verification throughput with and without the process pool")
+    login_parser.add_argument("--logins", type=int, default=64)
+    login_parser.add_argument("--rounds", type=int, default=12)
+    render_parser = subparsers.add_parser("render", help="Chat page render cost with and without stored message HTML")
+    render_parser.add_argument("--messages", type=int, default=2000)
+    render_parser.add_argument("--iterations", type=int, default=50)
+    images_parser = subparsers.add_parser("images", help="Payload size and encode time of the WebP image variants")
+    images_parser.add_argument("--image", help="Image to encode (defaults to a synthetic 1024x1024 render)")
+    images_parser.add_argument("--iterations", type=int, default=5)
+    index_parser = subparsers.add_parser("index", help="Per-worker startup time and memory of the pickled and shared knowledge base")
+    index_parser.add_argument("--workers", type=int, default=4)
+    index_parser.add_argument("--chunks", type=int, default=20000)
+    retrieval_parser = subparsers.add_parser("retrieval", help="Latency and result overlap of vector, lexical and hybrid retrieval")
+    retrieval_parser.add_argument("--index", help="A built index to use with the real embeddings API (default: synthetic, offline)")
+    retrieval_parser.add_argument("--embedding-latency", type=float, default=0.15, help="Simulated embedding call latency for the offline run")
+    concurrency_parser = subparsers.add_parser("concurrency", help="Check that concurrent submissions don't serialize (exits non-zero if they do)")
+    concurrency_parser.add_argument("--requests", type=int, default=10)
+    concurrency_parser.add_argument("--llm-latency", type=float, default=1.0, help="Seconds the stubbed LLM takes per call")
+    concurrency_parser.add_argument("--max-slowdown", type=float, default=2.0, help="Fail if the batch takes longer than this many single requests")
+    args = parser.parse_args()
+
+    if args.command == "db":
+        bench_db(args.iterations)
+    elif args.command == "plans":
+        sys.exit(0 if check_query_plans() else 1)
+    elif args.command == "memory":
+        bench_memory(args.turns)
+    elif args.command == "writes":
+        bench_writes(args.writers, args.submissions)
+    elif args.command == "login":
+        bench_login(args.logins, args.rounds)
+    elif args.command == "render":
+        bench_render(args.messages, args.iterations)
+    elif args.command == "images":
+        bench_images(args.image, args.iterations)
+    elif args.command == "index":
+        bench_index(args.workers, args.chunks)
+    elif args.command == "retrieval":
+        bench_retrieval(args.index, args.embedding_latency)
+    elif args.command == "concurrency":
+        sys.exit(0 if check_concurrency(args.requests, args.llm_latency, args.max_slowdown) else 1)
+    else:
+        sys.exit(1)
@@ -0,0 +1,154 @@
+"""
+Incremental builder for the dream-dictionary FAISS index.
+
+Each chunk of the dictionary is identified by the SHA-256 of its text. A manifest next to the
+index records which chunks it holds, so a rebuild only embeds chunks that were added or changed
+and deletes the ones that disappeared. Embedding runs in bounded-concurrency batches, and the
+index and manifest are checkpointed after every batch, so an interrupted build resumes where it
+stopped. A finished build is also exported to the memory-mapped form the server loads (see shared_index).
+
+Usage:
+    python build_index.py [--file DreamDictionary.txt] [--index dream_dictionary_index.faiss]
+                          [--batch-size 32] [--concurrency 4]
+"""
+import os
+import json
+import fcntl
+import hashlib
+import argparse
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from langchain_community.document_loaders import TextLoader
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain_community.vectorstores import FAISS
+
+import shared_index
+
+MANIFEST_NAME = "manifest.json"
+CHUNK_SIZE = 1500
+CHUNK_OVERLAP = 200
+BATCH_SIZE = 32
+CONCURRENCY = 4
+
+def split_dictionary(file_path):
+    """Loads the dictionary and splits it into chunks keyed by content hash (duplicates collapse)."""
+    documents = TextLoader(file_path, encoding='utf-8').load()
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
+    chunks = {}
+    for split in text_splitter.split_documents(documents):
+        chunks.setdefault(chunk_hash(split.page_content), split)
+    return chunks
+
+def chunk_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def _manifest_path(index_path):
+    return os.path.join(index_path, MANIFEST_NAME)
+
+def load_manifest(index_path):
+    """Returns the manifest of an existing index, or None if there isn't one."""
+    try:
+        with open(_manifest_path(index_path), encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+@contextmanager
+def build_lock(index_path):
+    """
+    Holds an exclusive lock on the index while it is built or exported, so server workers starting
+    together (or a concurrent `python build_index.py`) don't embed and write the same index at once.
+    """
+    with open(f"{os.path.normpath(index_path)}.lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+def _save_checkpoint(vector_store, index_path, model_name, chunk_ids):
+    """Saves the index, then atomically replaces the manifest so it never lists unsaved chunks."""
+    vector_store.save_local(index_path)
+    tmp_path = f"{_manifest_path(index_path)}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"embedding_model": model_name, "chunks": chunk_ids}, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, _manifest_path(index_path))
+
+def _load_existing(index_path, embeddings, model_name):
+    """
+    Loads the current index and its chunk-hash -> docstore-id map. The map is rebuilt by hashing
+    the stored texts rather than read from the manifest: a crash between saving the index and
+    replacing the manifest leaves the two out of step, and the index is what the next batch adds
+    to. This also adopts indexes built before manifests existed. One built with another model is discarded.
+    """
+    if not os.path.exists(os.path.join(index_path, "index.faiss")):
+        return None, {}
+    manifest = load_manifest(index_path)
+    if manifest and manifest.get("embedding_model") != model_name:
+        print(f"Embedding model changed from '{manifest.get('embedding_model')}'; rebuilding from scratch.")
+        return None, {}
+
+    vector_store = FAISS.load_local(index_path, embeddings, allow_dangerous_deserialization=True)
+    chunk_ids = {}
+    for docstore_id in vector_store.index_to_docstore_id.values():
+        chunk_ids[chunk_hash(vector_store.docstore.search(docstore_id).page_content)] = docstore_id
+    return vector_store, chunk_ids
+
+def update_index(file_path, index_path, embeddings, model_name, batch_size=BATCH_SIZE, concurrency=CONCURRENCY):
+    """
+    Brings the index at `index_path` in line with the dictionary at `file_path`, embedding only
+    new or changed chunks. Returns the up-to-date FAISS vector store.
+    """
+    chunks = split_dictionary(file_path)
+    vector_store, chunk_ids = _load_existing(index_path, embeddings, model_name)
+
+    removed = [hash_ for hash_ in chunk_ids if hash_ not in chunks]
+    added = [hash_ for hash_ in chunks if hash_ not in chunk_ids]
+    print(f"Knowledge base: {len(chunks)} chunks, {len(added)} to embed, {len(removed)} to remove.")
+
+    if removed and vector_store is not None:
+        vector_store.delete([chunk_ids.pop(hash_) for hash_ in removed])
+        _save_checkpoint(vector_store, index_path, model_name, chunk_ids)
+
+    batches = [added[i:i + batch_size] for i in range(0, len(added), batch_size)]
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {
+            executor.submit(embeddings.embed_documents, [chunks[hash_].page_content for hash_ in batch]): batch
+            for batch in batches
+        }
+        for done_count, future in enumerate(as_completed(futures), start=1):
+            batch = futures[future]
+            text_embeddings = list(zip([chunks[hash_].page_content for hash_ in batch], future.result()))
+            metadatas = [chunks[hash_].metadata for hash_ in batch]
+            if vector_store is None:
+                vector_store = FAISS.from_embeddings(text_embeddings, embeddings, metadatas=metadatas, ids=batch)
+            else:
+                vector_store.add_embeddings(text_embeddings, metadatas=metadatas, ids=batch)
+            chunk_ids.update({hash_: hash_ for hash_ in batch})
+            _save_checkpoint(vector_store, index_path, model_name, chunk_ids)
+            print(f"  Embedded batch {done_count}/{len(batches)} ({len(chunk_ids)}/{len(chunks)} chunks indexed)")
+
+    if vector_store is None:
+        raise ValueError(f"'{file_path}' produced no chunks to index.")
+    if load_manifest(index_path) != {"embedding_model": model_name, "chunks": chunk_ids}:
+        # An adopted legacy index, or one whose last checkpoint was interrupted, gets a matching manifest
+        _save_checkpoint(vector_store, index_path, model_name, chunk_ids)
+    if not shared_index.is_current(index_path):
+        shared_index.export(vector_store, index_path, model_name)
+    return vector_store
+
+if __name__ == "__main__":
+    import dream_image
+
+    parser = argparse.ArgumentParser(description="Incrementally rebuild the dream-dictionary FAISS index.")
+    parser.add_argument("--file", default="DreamDictionary.txt")
+    parser.add_argument("--index", default="dream_dictionary_index.faiss")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY)
+    args = parser.parse_args()
+
+    dream_image.setup_ssl_certs()
+    google_api_key, _ = dream_image.get_api_keys()
+    with build_lock(args.index):
+        update_index(
+            args.file, args.index, dream_image.create_embeddings(google_api_key), dream_image.EMBEDDING_MODEL,
+            batch_size=args.batch_size, concurrency=args.concurrency
+        )
+    print("✅ Knowledge base is up to date.")
@@ -0,0 +1,60 @@
+import os
+
+import db_utils
+
+# --- Conversation Memory Settings (overridable through the environment) ---
+RECENT_MESSAGES = int(os.environ.get("MEMORY_RECENT_MESSAGES", "6"))     # Kept verbatim after every fold
+FOLD_THRESHOLD = int(os.environ.get("MEMORY_FOLD_THRESHOLD", "12"))      # Unsummarized messages that trigger a fold
+TOKEN_BUDGET = int(os.environ.get("MEMORY_TOKEN_BUDGET", "2000"))        # Summary plus verbatim messages
+
+def estimate_tokens(text):
+    """A tokenizer-free estimate (~4 characters per token), good enough to enforce a budget."""
+    return len(text) // 4 + 1
+
+def format_messages(messages):
+    return "\n".join(f"{'User' if msg['sender'] == 'user' else 'AI'}: {msg['text']}" for msg in messages)
+
+def compose_history(summary, messages):
+    """Renders the summary of older turns followed by the recent turns verbatim."""
+    transcript = format_messages(messages)
+    if not summary:
+        return transcript
+    return f"Summary of the earlier conversation: {summary}\n\n{transcript}"
+
+def _messages_to_fold(summary, messages):
+    """
+    Decides how many of the oldest unsummarized messages to fold into the summary. Folding happens
+    in batches (down to RECENT_MESSAGES once FOLD_THRESHOLD is reached) so the summarizer runs every
+    few turns rather than every turn, and earlier whenever the history would exceed TOKEN_BUDGET.
+    The newest message is never folded.
+    """
+    fold_count = len(messages) - RECENT_MESSAGES if len(messages) >= FOLD_THRESHOLD else 0
+    while fold_count < len(messages) - 1 and estimate_tokens(compose_history(summary, messages[fold_count:])) > TOKEN_BUDGET:
+        fold_count += 1
+    return max(fold_count, 0)
+
+async def build_history(session_id, summarize):
+    """
+    Returns the therapy history for a session: a rolling summary of older turns plus the most
+    recent turns verbatim. Only messages newer than the stored summary are loaded. When they
+    grow past the fold threshold or the token budget, the oldest are merged into the summary
+    with `summarize(summary, new_lines)`, and the result is persisted for the next turn.
+    """
+    memory = await db_utils.run_async(db_utils.get_session_memory, session_id)
+    summary = memory['summary'] if memory else ""
+    summarized_upto = memory['summarized_upto'] if memory else 0
+    messages = await db_utils.run_async(db_utils.get_message_texts_for_session, session_id, after_id=summarized_upto)
+
+    fold_count = _messages_to_fold(summary, messages)
+    if fold_count:
+        folded = messages[:fold_count]
+        try:
+            summary = await summarize(summary, format_messages(folded))
+        except Exception as e:
+            # Keep the turn going with the unsummarized history; the fold is retried next turn
+            print(f"Conversation summary update failed for session {session_id}: {e}")
+            return compose_history(summary, messages)
+        await db_utils.run_async(db_utils.save_session_memory, session_id, summary, folded[-1]['id'])
+        messages = messages[fold_count:]
+
+    return compose_history(summary, messages)
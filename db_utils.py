@@ -1,20 +1,139 @@
+import time
 import sqlite3
-import bcrypt
+import asyncio
+import functools
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 
+import metrics
+import rendering
+
 DATABASE_NAME = "oneiromind.db"
 
-def get_db_connection():
-    """Establishes a connection to the SQLite database."""
-    conn = sqlite3.connect(DATABASE_NAME)
+# Bounded pool of threads that run the blocking sqlite3 work off the event loop
+DB_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix="oneiromind-db")
+
+# Connection tuning, applied once when a thread opens its connection
+STATEMENT_CACHE_SIZE = 256
+CONNECTION_PRAGMAS = (
+    "PRAGMA auto_vacuum = INCREMENTAL", # Takes effect on new databases only; see maintenance.py for existing ones
+    "PRAGMA journal_mode = WAL",        # Readers no longer block on a writer
+    "PRAGMA synchronous = NORMAL",      # Safe with WAL; fsync on checkpoint instead of every commit
+    "PRAGMA cache_size = -16000",       # ~16 MB page cache per connection
+    "PRAGMA mmap_size = 268435456",     # Memory-map up to 256 MB of the database file
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA busy_timeout = 5000",       # Wait for a competing writer instead of failing with 'database is locked'
+    "PRAGMA foreign_keys = ON",         # Needed for ON DELETE CASCADE
+)
+
+# Where a chat session stands, persisted on chat_sessions.state by the write paths; chat.js uses the same names
+SESSION_ENDED = "session_ended"                      # Nothing to continue (still being interpreted, failed, or finished)
+AWAITING_THERAPY_START = "awaiting_therapy_start"    # Interpretation shown, follow-up offer pending
+IN_THERAPY_SESSION = "in_therapy_session"
+
+_local = threading.local()
+_connections = []
+_connections_lock = threading.Lock()
+
+async def run_async(func, *args, **kwargs):
+    """Runs a blocking database function on the bounded executor and awaits its result, timing it per function."""
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    try:
+        return await loop.run_in_executor(DB_EXECUTOR, functools.partial(func, *args, **kwargs))
+    finally:
+        metrics.observe_db_call(func.__name__, time.perf_counter() - started)
+
+def _open_connection():
+    conn = sqlite3.connect(DATABASE_NAME, cached_statements=STATEMENT_CACHE_SIZE, check_same_thread=False)
     conn.row_factory = sqlite3.Row
+    for pragma in CONNECTION_PRAGMAS:
+        conn.execute(pragma)
+    with _connections_lock:
+        _connections.append(conn)
+    return conn
+
+def get_db_connection():
+    """
+    Returns this thread's connection to the SQLite database, opening and tuning it on first use.
+    Connections are reused across calls, so callers must not close them.
+    """
+    conn = getattr(_local, "conn", None)
+    if conn is None or _local.database != DATABASE_NAME:
+        conn = _open_connection()
+        _local.conn = conn
+        _local.database = DATABASE_NAME
     return conn
 
-def create_tables():
-    """Creates all necessary tables if they don't exist."""
+@contextmanager
+def transaction():
+    """Yields a cursor on this thread's connection, committing on success and rolling back on error."""
     conn = get_db_connection()
-    cursor = conn.cursor()
-    
+    with conn:
+        yield conn.cursor()
+
+def close_connections():
+    """Closes every pooled connection; threads reopen one on their next call."""
+    with _connections_lock:
+        for conn in _connections:
+            conn.close()
+        _connections.clear()
+    _local.__dict__.clear()
+
+class UnitOfWork:
+    """
+    Writes that commit together. Each method runs on the cursor of an open transaction and uses
+    RETURNING to hand back what it inserted, so a batch costs one commit and no follow-up SELECTs.
+    """
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def create_chat_session(self, user_id):
+        """Creates a new chat session for a user, saving the timestamp in UTC, and returns its id."""
+        self.cursor.execute(
+            "INSERT INTO chat_sessions (user_id, created_at) VALUES (?, ?) RETURNING id",
+            (user_id, datetime.now(timezone.utc))
+        )
+        return self.cursor.fetchone()['id']
+
+    def add_message(self, session_id, sender, text=None, image_data=None):
+        """Adds a message to a chat session, with its text rendered to HTML once, and returns the stored row."""
+        text_html = rendering.markdown_to_html(text) if text else None
+        self.cursor.execute(
+            "INSERT INTO messages (session_id, sender, text, text_html, html_version, image_data, timestamp) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?) RETURNING *",
+            (session_id, sender, text, text_html, rendering.RENDERER_VERSION, image_data, datetime.now(timezone.utc))
+        )
+        return dict(self.cursor.fetchone())
+
+    def set_session_state(self, session_id, state):
+        """Moves a chat session to a new state (see SESSION_ENDED and friends)."""
+        self.cursor.execute("UPDATE chat_sessions SET state = ? WHERE id = ?", (state, session_id))
+
+    def create_image_job(self, session_id, message_id, interpretation, visual_prompt=None):
+        """Queues a deferred image generation job for a placeholder message and returns its id."""
+        now_utc = datetime.now(timezone.utc)
+        self.cursor.execute(
+            "INSERT INTO image_jobs (session_id, message_id, interpretation, visual_prompt, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?) RETURNING id",
+            (session_id, message_id, interpretation, visual_prompt, now_utc, now_utc)
+        )
+        return self.cursor.fetchone()['id']
+
+@contextmanager
+def unit_of_work():
+    """Yields a UnitOfWork whose writes are committed together, or rolled back together on error."""
+    with transaction() as cursor:
+        yield UnitOfWork(cursor)
+
+# --- Schema Migrations ---
+# Each migration upgrades the schema by one version; PRAGMA user_version records how far a database has got.
+# Never edit a migration that has shipped; append a new one instead.
+
+def _migration_1_initial_schema(cursor):
+    """The original tables (created with IF NOT EXISTS so pre-versioning databases adopt them as-is)."""
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS users (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -26,7 +145,7 @@ def create_tables():
             life_stage TEXT
         )
     ''')
-    
+
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS chat_sessions (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -47,136 +166,557 @@ def create_tables():
             FOREIGN KEY (session_id) REFERENCES chat_sessions (id)
         )
     ''')
-    
-    conn.commit()
-    conn.close()
 
-def add_user(email, password):
-    """Adds a new user to the database."""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS image_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_id INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            interpretation TEXT NOT NULL,
+            visual_prompt TEXT,
+            status TEXT NOT NULL DEFAULT 'pending', -- 'pending', 'running', 'done' or 'failed'
+            attempts INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (session_id) REFERENCES chat_sessions (id),
+            FOREIGN KEY (message_id) REFERENCES messages (id)
+        )
+    ''')
+
+def _migration_2_cascades_and_indexes(cursor):
+    """Rebuilds the child tables with ON DELETE CASCADE and adds indexes for the hot lookups."""
+    # SQLite can't alter a foreign key in place, so each table is copied into a new definition
+    cursor.execute('''
+        CREATE TABLE chat_sessions_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
+        )
+    ''')
+    cursor.execute("INSERT INTO chat_sessions_new (id, user_id, created_at) SELECT id, user_id, created_at FROM chat_sessions")
+    cursor.execute("DROP TABLE chat_sessions")
+    cursor.execute("ALTER TABLE chat_sessions_new RENAME TO chat_sessions")
+
+    cursor.execute('''
+        CREATE TABLE messages_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_id INTEGER NOT NULL,
+            sender TEXT NOT NULL, -- 'user' or 'bot'
+            text TEXT,
+            image_data TEXT,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (session_id) REFERENCES chat_sessions (id) ON DELETE CASCADE
+        )
+    ''')
+    cursor.execute(
+        "INSERT INTO messages_new (id, session_id, sender, text, image_data, timestamp) "
+        "SELECT id, session_id, sender, text, image_data, timestamp FROM messages"
+    )
+    cursor.execute("DROP TABLE messages")
+    cursor.execute("ALTER TABLE messages_new RENAME TO messages")
+
+    cursor.execute('''
+        CREATE TABLE image_jobs_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_id INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            interpretation TEXT NOT NULL,
+            visual_prompt TEXT,
+            status TEXT NOT NULL DEFAULT 'pending', -- 'pending', 'running', 'done' or 'failed'
+            attempts INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (session_id) REFERENCES chat_sessions (id) ON DELETE CASCADE,
+            FOREIGN KEY (message_id) REFERENCES messages (id) ON DELETE CASCADE
+        )
+    ''')
+    cursor.execute("INSERT INTO image_jobs_new SELECT * FROM image_jobs")
+    cursor.execute("DROP TABLE image_jobs")
+    cursor.execute("ALTER TABLE image_jobs_new RENAME TO image_jobs")
+
+    # (user_id, created_at) also covers the session list, since id is the rowid
+    cursor.execute("CREATE INDEX idx_chat_sessions_user_created ON chat_sessions (user_id, created_at)")
+    cursor.execute("CREATE INDEX idx_messages_session_timestamp ON messages (session_id, timestamp)")
+    cursor.execute("CREATE INDEX idx_image_jobs_session_status ON image_jobs (session_id, status)")
+    cursor.execute("CREATE INDEX idx_image_jobs_message ON image_jobs (message_id)")
+    cursor.execute("CREATE INDEX idx_image_jobs_status ON image_jobs (status)")
+
+def _migration_3_session_memory(cursor):
+    """Adds the rolling conversation summary kept for each therapy session."""
+    cursor.execute('''
+        CREATE TABLE session_memory (
+            session_id INTEGER PRIMARY KEY,
+            summary TEXT NOT NULL,
+            summarized_upto INTEGER NOT NULL, -- id of the newest message folded into the summary
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (session_id) REFERENCES chat_sessions (id) ON DELETE CASCADE
+        )
+    ''')
+
+def _migration_4_rendered_message_html(cursor):
+    """Stores each message's rendered HTML; rows written before this are rendered lazily on first read."""
+    cursor.execute("ALTER TABLE messages ADD COLUMN text_html TEXT")
+    cursor.execute("ALTER TABLE messages ADD COLUMN html_version INTEGER")
+
+def _migration_5_session_state(cursor):
+    """
+    Adds chat_sessions.state, backfilled from the last bot message with text the way the chat page
+    used to work it out: the follow-up offer means the therapy hasn't started, an error ends the
+    session, and anything else is an ongoing therapy session.
+    """
+    cursor.execute(f'''
+        ALTER TABLE chat_sessions ADD COLUMN state TEXT NOT NULL DEFAULT '{SESSION_ENDED}'
+            CHECK (state IN ('{SESSION_ENDED}', '{AWAITING_THERAPY_START}', '{IN_THERAPY_SESSION}'))
+    ''')
+    cursor.execute(f'''
+        UPDATE chat_sessions SET state = coalesce((
+            SELECT CASE
+                WHEN instr(m.text, 'Would you like to ask some follow-up questions') > 0 THEN '{AWAITING_THERAPY_START}'
+                WHEN instr(m.text, 'Great. What is your first question?') > 0 THEN '{IN_THERAPY_SESSION}'
+                WHEN instr(m.text, 'Sorry, an error occurred') > 0 THEN '{SESSION_ENDED}'
+                ELSE '{IN_THERAPY_SESSION}'
+            END
+            FROM messages m
+            WHERE m.session_id = chat_sessions.id AND m.sender = 'bot' AND m.text IS NOT NULL
+            ORDER BY m.timestamp DESC LIMIT 1
+        ), '{SESSION_ENDED}')
+    ''')
+
+MIGRATIONS = [
+    _migration_1_initial_schema,
+    _migration_2_cascades_and_indexes,
+    _migration_3_session_memory,
+    _migration_4_rendered_message_html,
+    _migration_5_session_state,
+]
+
+def get_schema_version():
+    """Returns the schema version recorded in the database file."""
+    return get_db_connection().execute("PRAGMA user_version").fetchone()[0]
+
+def migrate():
+    """
+    Brings the database schema up to date by applying every pending migration in order,
+    each in its own transaction together with the user_version bump.
+    """
     conn = get_db_connection()
-    cursor = conn.cursor()
-    
+    # Table rebuilds must not trigger cascades; this pragma is a no-op inside a transaction, so set it first
+    conn.execute("PRAGMA foreign_keys = OFF")
     try:
-        hashed_password = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
-        cursor.execute("INSERT INTO users (email, password_hash) VALUES (?, ?)", (email, hashed_password.decode('utf-8')))
-        conn.commit()
-        new_user_id = cursor.lastrowid
-        conn.close()
-        return new_user_id
+        while True:
+            with transaction() as cursor:
+                # IMMEDIATE takes the write lock up front, so concurrent workers migrate one at a time
+                cursor.execute("BEGIN IMMEDIATE")
+                version = cursor.execute("PRAGMA user_version").fetchone()[0]
+                if version >= len(MIGRATIONS):
+                    return
+                MIGRATIONS[version](cursor)
+                cursor.execute(f"PRAGMA user_version = {version + 1}")
+            print(f"Database schema migrated to version {version + 1}.")
+    finally:
+        conn.execute("PRAGMA foreign_keys = ON")
+
+def add_user(email, password_hash):
+    """Adds a new user with an already hashed password (see passwords.py); returns None if the email is taken."""
+    try:
+        with transaction() as cursor:
+            cursor.execute("INSERT INTO users (email, password_hash) VALUES (?, ?)", (email, password_hash))
+            return cursor.lastrowid
     except sqlite3.IntegrityError:
-        conn.close()
         return None
 
-def check_user(email, password):
-    """Checks if a user exists and the password is correct."""
-    conn = get_db_connection()
-    cursor = conn.cursor()
+def get_user_by_email(email):
+    """Retrieves a user by email, including the password hash to verify against."""
+    cursor = get_db_connection().cursor()
     cursor.execute("SELECT * FROM users WHERE email = ?", (email,))
     user = cursor.fetchone()
-    conn.close()
-    
-    if user and bcrypt.checkpw(password.encode('utf-8'), user['password_hash'].encode('utf-8')):
-        return dict(user)
-    return None
+    return dict(user) if user else None
+
+def set_password_hash(user_id, password_hash):
+    """Replaces a user's password hash, e.g. after rehashing at a new cost factor."""
+    with transaction() as cursor:
+        cursor.execute("UPDATE users SET password_hash = ? WHERE id = ?", (password_hash, user_id))
 
 def add_demographics(user_id, age_range, gender, country, life_stage):
     """Adds demographic information for a user."""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        UPDATE users 
-        SET age_range = ?, gender = ?, country = ?, life_stage = ?
-        WHERE id = ?
-    ''', (age_range, gender, country, life_stage, user_id))
-    conn.commit()
-    conn.close()
+    with transaction() as cursor:
+        cursor.execute('''
+            UPDATE users
+            SET age_range = ?, gender = ?, country = ?, life_stage = ?
+            WHERE id = ?
+        ''', (age_range, gender, country, life_stage, user_id))
 
 def create_chat_session(user_id):
     """Creates a new chat session for a user, saving the timestamp in UTC."""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    created_at_utc = datetime.now(timezone.utc)
-    cursor.execute("INSERT INTO chat_sessions (user_id, created_at) VALUES (?, ?)", (user_id, created_at_utc))
-    conn.commit()
-    new_session_id = cursor.lastrowid
-    conn.close()
-    return new_session_id
-
-def add_message_to_session(session_id, sender, text=None, image_data=None):
-    """Adds a message to a specific chat session, returning the new message for API responses."""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    timestamp_utc = datetime.now(timezone.utc)
-    cursor.execute(
-        "INSERT INTO messages (session_id, sender, text, image_data, timestamp) VALUES (?, ?, ?, ?, ?)",
-        (session_id, sender, text, image_data, timestamp_utc)
-    )
-    new_message_id = cursor.lastrowid
-    conn.commit()
-    
-    # Fetch the newly created message to return it
-    cursor.execute("SELECT * FROM messages WHERE id = ?", (new_message_id,))
-    new_message = dict(cursor.fetchone())
-    conn.close()
-    return new_message
+    with unit_of_work() as uow:
+        return uow.create_chat_session(user_id)
+
+def add_message_to_session(session_id, sender, text=None, image_data=None, state=None):
+    """
+    Adds a message to a specific chat session, returning the new message for API responses.
+    If `state` is given, the session moves to it in the same transaction.
+    """
+    with unit_of_work() as uow:
+        message = uow.add_message(session_id, sender, text=text, image_data=image_data)
+        if state:
+            uow.set_session_state(session_id, state)
+        return message
+
+def start_chat_session(user_id, text):
+    """Creates a chat session together with its opening user message; returns the session id."""
+    with unit_of_work() as uow:
+        session_id = uow.create_chat_session(user_id)
+        uow.add_message(session_id, 'user', text=text)
+        return session_id
+
+def add_messages_to_session(session_id, messages, state=None):
+    """Appends several (sender, text) messages in one transaction, optionally moving the session to `state`; returns the stored rows in order."""
+    with unit_of_work() as uow:
+        rows = [uow.add_message(session_id, sender, text=text) for sender, text in messages]
+        if state:
+            uow.set_session_state(session_id, state)
+        return rows
+
+def store_interpretation(session_id, interpretation, follow_up, visual_prompt=None):
+    """
+    Writes a finished interpretation in one transaction: the placeholder message its image will fill,
+    the interpretation, the follow-up prompt and the image job, and moves the session on to the
+    follow-up offer. Returns the image job id.
+    """
+    with unit_of_work() as uow:
+        image_message = uow.add_message(session_id, 'bot')
+        uow.add_message(session_id, 'bot', text=interpretation)
+        uow.add_message(session_id, 'bot', text=follow_up)
+        uow.set_session_state(session_id, AWAITING_THERAPY_START)
+        return uow.create_image_job(session_id, image_message['id'], interpretation, visual_prompt)
 
 def get_user_chat_sessions(user_id):
     """Retrieves all chat sessions for a specific user."""
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    cursor = get_db_connection().cursor()
     cursor.execute("SELECT * FROM chat_sessions WHERE user_id = ? ORDER BY created_at DESC", (user_id,))
-    sessions = [dict(row) for row in cursor.fetchall()]
-    conn.close()
-    return sessions
+    return [dict(row) for row in cursor.fetchall()]
+
+# A session's title is the start of its first user message; the correlated lookup uses idx_messages_session_timestamp
+SESSION_SUMMARY_COLUMNS = '''
+    s.id, s.created_at, s.state,
+    (SELECT substr(m.text, 1, 60) FROM messages m
+     WHERE m.session_id = s.id AND m.sender = 'user' AND m.text IS NOT NULL
+     ORDER BY m.timestamp ASC LIMIT 1) AS title
+'''
+
+def get_user_chat_sessions_page(user_id, limit, before=None):
+    """
+    Retrieves one page of a user's sessions, newest first, with their titles. `before` is the
+    (created_at, id) of the last session on the previous page; the keyset comparison lets the
+    index seek straight to the page instead of skipping over everything before it.
+    """
+    cursor = get_db_connection().cursor()
+    if before is None:
+        cursor.execute(
+            f"SELECT {SESSION_SUMMARY_COLUMNS} FROM chat_sessions s WHERE s.user_id = ? ORDER BY s.created_at DESC, s.id DESC LIMIT ?",
+            (user_id, limit)
+        )
+    else:
+        cursor.execute(
+            f"SELECT {SESSION_SUMMARY_COLUMNS} FROM chat_sessions s WHERE s.user_id = ? AND (s.created_at, s.id) < (?, ?) "
+            "ORDER BY s.created_at DESC, s.id DESC LIMIT ?",
+            (user_id, before[0], before[1], limit)
+        )
+    return [dict(row) for row in cursor.fetchall()]
+
+def get_chat_session(user_id, session_id):
+    """Retrieves a single session with its title, or None if it doesn't exist or belongs to another user."""
+    cursor = get_db_connection().cursor()
+    cursor.execute(f"SELECT {SESSION_SUMMARY_COLUMNS} FROM chat_sessions s WHERE s.id = ? AND s.user_id = ?", (session_id, user_id))
+    session = cursor.fetchone()
+    return dict(session) if session else None
 
 def get_messages_for_session(session_id):
     """Retrieves all messages for a specific session."""
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    cursor = get_db_connection().cursor()
     cursor.execute("SELECT * FROM messages WHERE session_id = ? ORDER BY timestamp ASC", (session_id,))
-    messages = [dict(row) for row in cursor.fetchall()]
-    conn.close()
-    return messages
+    return [dict(row) for row in cursor.fetchall()]
+
+def get_messages_page(session_id, limit, before=None):
+    """
+    Retrieves one page of a session's messages, newest first. `before` is the (timestamp, id) of
+    the oldest message already shown, so each older page is an index seek rather than an OFFSET.
+    """
+    cursor = get_db_connection().cursor()
+    if before is None:
+        cursor.execute(
+            "SELECT * FROM messages WHERE session_id = ? ORDER BY timestamp DESC, id DESC LIMIT ?",
+            (session_id, limit)
+        )
+    else:
+        cursor.execute(
+            "SELECT * FROM messages WHERE session_id = ? AND (timestamp, id) < (?, ?) ORDER BY timestamp DESC, id DESC LIMIT ?",
+            (session_id, before[0], before[1], limit)
+        )
+    return [dict(row) for row in cursor.fetchall()]
+
+def set_messages_html(rendered):
+    """Stores freshly rendered HTML for messages whose stored copy was missing or stale; takes (id, html) pairs."""
+    with transaction() as cursor:
+        cursor.executemany(
+            "UPDATE messages SET text_html = ?, html_version = ? WHERE id = ?",
+            [(html, rendering.RENDERER_VERSION, message_id) for message_id, html in rendered]
+        )
+
+def get_message_texts_for_session(session_id, after_id=0):
+    """Retrieves the id, sender and text of a session's messages newer than `after_id`, skipping image-only rows."""
+    cursor = get_db_connection().cursor()
+    cursor.execute(
+        "SELECT id, sender, text FROM messages WHERE session_id = ? AND id > ? AND text IS NOT NULL ORDER BY timestamp ASC",
+        (session_id, after_id)
+    )
+    return [dict(row) for row in cursor.fetchall()]
+
+def get_inline_image_messages(after_id, limit):
+    """Retrieves a batch of messages that still hold a base64 data URI instead of an image reference."""
+    cursor = get_db_connection().cursor()
+    cursor.execute(
+        "SELECT id, image_data FROM messages WHERE id > ? AND image_data LIKE 'data:%' ORDER BY id ASC LIMIT ?",
+        (after_id, limit)
+    )
+    return [dict(row) for row in cursor.fetchall()]
+
+def set_message_image_data(message_id, image_data):
+    """Replaces the image of a single message."""
+    with transaction() as cursor:
+        cursor.execute("UPDATE messages SET image_data = ? WHERE id = ?", (image_data, message_id))
 
 # MODIFIED FUNCTION
 def get_user_demographics(user_id):
     """
     Retrieves demographic information for a given user_id from the users table.
     """
-    conn = get_db_connection()
-    conn.row_factory = sqlite3.Row 
-    cursor = conn.cursor()
-    
+    cursor = get_db_connection().cursor()
+
     # Corrected to query the 'users' table instead of a non-existent 'demographics' table
     cursor.execute(
         "SELECT age_range, gender, country, life_stage FROM users WHERE id = ?",
         (user_id,)
     )
-    
+
     demographics = cursor.fetchone()
-    conn.close()
-    
+
     if demographics:
         return dict(demographics)
     return None
 
 def is_user_session(user_id, session_id):
     """Checks if a given chat session belongs to the specified user."""
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    cursor = get_db_connection().cursor()
     cursor.execute(
         "SELECT 1 FROM chat_sessions WHERE id = ? AND user_id = ?",
         (session_id, user_id)
     )
-    session_exists_for_user = cursor.fetchone()
-    conn.close()
-    return session_exists_for_user is not None
+    return cursor.fetchone() is not None
 
 def delete_chat_session(session_id):
-    """Deletes a chat session and all its messages."""
+    """Deletes a chat session; its messages and image jobs go with it through ON DELETE CASCADE."""
+    with transaction() as cursor:
+        cursor.execute("DELETE FROM chat_sessions WHERE id = ?", (session_id,))
+
+def create_image_job(session_id, message_id, interpretation, visual_prompt=None):
+    """
+    Queues a deferred image generation job that will fill in the given placeholder message.
+    A known visual prompt (e.g. from a cached interpretation) spares the job its LLM call.
+    """
+    with unit_of_work() as uow:
+        return uow.create_image_job(session_id, message_id, interpretation, visual_prompt)
+
+def get_image_job(job_id):
+    """Retrieves an image job together with the image of the message it fills in."""
+    cursor = get_db_connection().cursor()
+    cursor.execute(
+        "SELECT image_jobs.*, messages.image_data FROM image_jobs JOIN messages ON messages.id = image_jobs.message_id WHERE image_jobs.id = ?",
+        (job_id,)
+    )
+    job = cursor.fetchone()
+    return dict(job) if job else None
+
+def claim_image_job(job_id):
+    """Atomically moves a pending job to 'running'; returns False if another worker already owns it."""
+    with transaction() as cursor:
+        cursor.execute(
+            "UPDATE image_jobs SET status = 'running', attempts = attempts + 1, updated_at = ? WHERE id = ? AND status = 'pending'",
+            (datetime.now(timezone.utc), job_id)
+        )
+        return cursor.rowcount == 1
+
+def set_image_job_visual_prompt(job_id, visual_prompt):
+    """Stores the visual prompt so a retried job doesn't have to call the LLM again."""
+    with transaction() as cursor:
+        cursor.execute(
+            "UPDATE image_jobs SET visual_prompt = ?, updated_at = ? WHERE id = ?",
+            (visual_prompt, datetime.now(timezone.utc), job_id)
+        )
+
+def finish_image_job(job_id, status, image_data, error=None):
+    """Marks a job as 'done' or 'failed' and writes the resulting image into its message in one transaction."""
+    with transaction() as cursor:
+        cursor.execute(
+            "UPDATE image_jobs SET status = ?, error = ?, updated_at = ? WHERE id = ?",
+            (status, error, datetime.now(timezone.utc), job_id)
+        )
+        cursor.execute(
+            "UPDATE messages SET image_data = ? WHERE id = (SELECT message_id FROM image_jobs WHERE id = ?)",
+            (image_data, job_id)
+        )
+
+def release_image_job(job_id, error):
+    """Returns a failed attempt to 'pending' so it can be retried."""
+    with transaction() as cursor:
+        cursor.execute(
+            "UPDATE image_jobs SET status = 'pending', error = ?, updated_at = ? WHERE id = ?",
+            (error, datetime.now(timezone.utc), job_id)
+        )
+
+def get_unfinished_image_job_ids(stale_before):
+    """
+    Returns the ids of jobs to resume after a restart: all pending jobs, plus running
+    jobs whose last update is older than `stale_before` (their worker died mid-attempt).
+    """
+    with transaction() as cursor:
+        cursor.execute(
+            "UPDATE image_jobs SET status = 'pending' WHERE status = 'running' AND updated_at < ?",
+            (stale_before,)
+        )
+        cursor.execute("SELECT id FROM image_jobs WHERE status = 'pending' ORDER BY id ASC")
+        return [row['id'] for row in cursor.fetchall()]
+
+def get_pending_image_jobs_for_session(session_id):
+    """Maps placeholder message ids to the id of the image job that is still working on them."""
+    cursor = get_db_connection().cursor()
+    cursor.execute(
+        "SELECT id, message_id FROM image_jobs WHERE session_id = ? AND status IN ('pending', 'running')",
+        (session_id,)
+    )
+    return {row['message_id']: row['id'] for row in cursor.fetchall()}
+
+def get_session_memory(session_id):
+    """Retrieves the rolling conversation summary of a session, if one has been written."""
+    cursor = get_db_connection().cursor()
+    cursor.execute("SELECT summary, summarized_upto FROM session_memory WHERE session_id = ?", (session_id,))
+    memory = cursor.fetchone()
+    return dict(memory) if memory else None
+
+def save_session_memory(session_id, summary, summarized_upto):
+    """Stores a session's updated summary and the id of the newest message it covers."""
+    with transaction() as cursor:
+        cursor.execute('''
+            INSERT INTO session_memory (session_id, summary, summarized_upto, updated_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT (session_id) DO UPDATE SET
+                summary = excluded.summary, summarized_upto = excluded.summarized_upto, updated_at = excluded.updated_at
+        ''', (session_id, summary, summarized_upto, datetime.now(timezone.utc)))
+
+# --- Maintenance (see maintenance.py) ---
+AUTO_VACUUM_INCREMENTAL = 2 # PRAGMA auto_vacuum value when freed pages can be handed back with incremental_vacuum
+
+# A session is idle if nothing has touched it since the cutoff: created before it, with no newer
+# message and no image job still pending or running. Takes the cutoff twice.
+_IDLE_SESSION_CONDITION = '''
+    s.created_at < ?
+    AND NOT EXISTS (SELECT 1 FROM messages m WHERE m.session_id = s.id AND m.timestamp >= ?)
+    AND NOT EXISTS (SELECT 1 FROM image_jobs j WHERE j.session_id = s.id AND j.status IN ('pending', 'running'))
+'''
+
+def get_archivable_session_ids(inactive_before, limit):
+    """Ids of up to `limit` sessions, oldest first, with no activity since `inactive_before`."""
+    cursor = get_db_connection().cursor()
+    cursor.execute(
+        f"SELECT s.id FROM chat_sessions s WHERE {_IDLE_SESSION_CONDITION} ORDER BY s.id ASC LIMIT ?",
+        (inactive_before, inactive_before, limit)
+    )
+    return [row['id'] for row in cursor.fetchall()]
+
+def export_chat_sessions(session_ids):
+    """Returns the given sessions with their owner's email, messages and conversation summary, ready to archive."""
+    if not session_ids:
+        return []
+    conn = get_db_connection()
+    placeholders = ",".join("?" * len(session_ids))
+    sessions = {
+        row['id']: {**dict(row), "messages": [], "memory": None}
+        for row in conn.execute(
+            f"SELECT s.*, u.email AS user_email FROM chat_sessions s JOIN users u ON u.id = s.user_id WHERE s.id IN ({placeholders})",
+            session_ids
+        )
+    }
+    # The rendered HTML is left out: it is derived from the text and re-rendered on demand
+    for row in conn.execute(
+        f"SELECT id, session_id, sender, text, image_data, timestamp FROM messages WHERE session_id IN ({placeholders}) ORDER BY id ASC",
+        session_ids
+    ):
+        sessions[row['session_id']]["messages"].append(dict(row))
+    for row in conn.execute(f"SELECT * FROM session_memory WHERE session_id IN ({placeholders})", session_ids):
+        sessions[row['session_id']]["memory"] = dict(row)
+    return [sessions[session_id] for session_id in session_ids if session_id in sessions]
+
+def archive_idle_sessions(inactive_before, limit, archive):
+    """
+    Selects up to `limit` idle sessions, passes their export to `archive(sessions)` and deletes those
+    still idle afterwards. Only the final delete takes the write lock, so messages and image jobs
+    keep flowing while the archive is written. A session that became active meanwhile is kept (and
+    archived again, newer copy last, once it goes idle). If `archive` raises, nothing is deleted.
+    Returns the number of sessions deleted.
+    """
+    # A read transaction gives the select and the export one consistent snapshot without blocking writers
+    with transaction() as cursor:
+        cursor.execute("BEGIN")
+        session_ids = get_archivable_session_ids(inactive_before, limit)
+        sessions = export_chat_sessions(session_ids)
+    if not sessions:
+        return 0
+    archive(sessions)
+
+    with transaction() as cursor:
+        cursor.execute("BEGIN IMMEDIATE")
+        # Messages, image jobs and the session summary go with each session through ON DELETE CASCADE
+        cursor.execute(
+            f"DELETE FROM chat_sessions AS s WHERE s.id IN ({','.join('?' * len(session_ids))}) AND {_IDLE_SESSION_CONDITION}",
+            (*session_ids, inactive_before, inactive_before)
+        )
+        return cursor.rowcount
+
+def get_referenced_image_urls():
+    """The distinct image references (e.g. /images/{hash}) still held by any message."""
+    cursor = get_db_connection().cursor()
+    cursor.execute("SELECT DISTINCT image_data FROM messages WHERE image_data IS NOT NULL AND image_data NOT LIKE 'data:%'")
+    return {row['image_data'] for row in cursor.fetchall()}
+
+def get_storage_stats():
+    """Page size, page count, free pages and auto_vacuum mode of the database file."""
+    conn = get_db_connection()
+    return {
+        pragma: conn.execute(f"PRAGMA {pragma}").fetchone()[0]
+        for pragma in ("page_size", "page_count", "freelist_count", "auto_vacuum")
+    }
+
+def incremental_vacuum(pages):
+    """Returns up to `pages` free pages to the filesystem in one short write transaction; returns how many it freed."""
+    conn = get_db_connection()
+    before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    # The pragma frees one page per step and returns no rows, so execute() would stop after the first
+    # page; executescript steps it to completion
+    conn.executescript(f"PRAGMA incremental_vacuum({int(pages)})")
+    return before - conn.execute("PRAGMA freelist_count").fetchone()[0]
+
+def checkpoint_wal():
+    """Copies the WAL back into the database file and truncates it, so freed pages leave the disk too."""
+    busy, _, _ = get_db_connection().execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+    return not busy
+
+def enable_incremental_vacuum():
+    """
+    Switches an existing database to incremental auto-vacuum. This rewrites the whole file with
+    VACUUM, blocking every writer while it runs, so it is meant for a one-off offline run.
+    """
     conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
-    cursor.execute("DELETE FROM chat_sessions WHERE id = ?", (session_id,))
-    conn.commit()
-    conn.close()
\ No newline at end of file
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    conn.execute("VACUUM")
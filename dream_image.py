@@ -2,24 +2,36 @@ import os
 import sys
 import certifi
 import time
-import io
-import requests
+import httpx
 import base64
-from PIL import Image
+from operator import itemgetter
 from langchain_google_genai import ChatGoogleGenerativeAI, GoogleGenerativeAIEmbeddings
-from langchain_community.document_loaders import TextLoader
-from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_community.vectorstores import FAISS
 from langchain.prompts import ChatPromptTemplate
-from langchain_core.runnables import RunnablePassthrough
+from langchain_core.runnables import RunnablePassthrough, RunnableLambda
 from langchain_core.output_parsers import StrOutputParser
 
+import embedding_cache
+import build_index
+import shared_index
+import upstream
+import metrics
+
 # --- Global Variables for AI components ---
 llm = None
 interpretation_chain = None
 therapy_chain = None
 visual_prompt_chain = None
+summary_chain = None
 stability_api_key = None # To be loaded at startup
+http_client = None # Pooled async HTTP client, created on first use
+embeddings = None # Cached embeddings used by the knowledge base retriever
+
+EMBEDDING_MODEL = "models/embedding-001"
+# Overridable so the load test can point image generation at a local stub
+STABILITY_API_URL = os.environ.get(
+    "STABILITY_API_URL", "https://api.stability.ai/v1/generation/stable-diffusion-xl-1024-v1-0/text-to-image"
+)
 
 def setup_ssl_certs(use_college_cert=False):
     """
@@ -53,79 +65,138 @@ def get_api_keys():
         sys.exit(1)
     return google_api_key, stability_api_key
 
-def setup_llm(google_api_key):
+def _create_llm(google_api_key):
+    # upstream.gemini owns the retry policy; the client's own retries would multiply with it
+    return ChatGoogleGenerativeAI(model="gemini-1.5-flash-latest", temperature=0.7, google_api_key=google_api_key, transport="rest", max_retries=0)
+
+def setup_llm(google_api_key, probe=False):
     """
-    Initializes and returns the Language Model, handling potential SSL errors.
+    Initializes and returns the Language Model. Construction makes no network call; with
+    probe=True a test call verifies the connection first, retrying with the alternate SSL
+    configuration on certificate errors. Raises RuntimeError if the probe fails.
     """
-    local_llm = None
+    setup_ssl_certs(use_college_cert=False)
+    local_llm = _create_llm(google_api_key)
+    if not probe:
+        return local_llm
+
     try:
-        setup_ssl_certs(use_college_cert=False)
-        local_llm = ChatGoogleGenerativeAI(model="gemini-1.5-flash-latest", temperature=0.7, google_api_key=google_api_key, transport="rest")
-        local_llm.invoke("test") 
+        local_llm.invoke("test")
     except Exception as e:
-        if "SSL" in str(e) or "CERTIFICATE_VERIFY_FAILED" in str(e):
-            print("\n⚠️ Network connection failed. Retrying with alternate configuration...")
-            setup_ssl_certs(use_college_cert=True)
-            try:
-                local_llm = ChatGoogleGenerativeAI(model="gemini-1.5-flash-latest", temperature=0.7, google_api_key=google_api_key, transport="rest")
-                local_llm.invoke("test")
-            except Exception as final_e:
-                print(f"\n🚨 Critical Error: Connection failed. Error: {final_e}")
-                sys.exit(1)
-        else:
-            print(f"\n🚨 An unexpected error occurred during LLM initialization: {e}")
-            sys.exit(1)
+        if "SSL" not in str(e) and "CERTIFICATE_VERIFY_FAILED" not in str(e):
+            raise RuntimeError(f"An unexpected error occurred during LLM initialization: {e}") from e
+        print("\n⚠️ Network connection failed. Retrying with alternate configuration...")
+        setup_ssl_certs(use_college_cert=True)
+        local_llm = _create_llm(google_api_key)
+        try:
+            local_llm.invoke("test")
+        except Exception as final_e:
+            raise RuntimeError(f"Connection failed. Error: {final_e}") from final_e
     return local_llm
 
+def create_embeddings(api_key):
+    """
+    Creates the embeddings model. Query and document embeddings go through a persistent cache,
+    so repeated texts skip the embedding API.
+    """
+    global embeddings
+    embeddings = embedding_cache.CachedEmbeddings(
+        # Cache hits never reach the provider, so only misses count against its limits
+        upstream.LimitedEmbeddings(
+            GoogleGenerativeAIEmbeddings(model=EMBEDDING_MODEL, google_api_key=api_key, transport="rest"),
+            upstream.embeddings
+        ),
+        model_name=EMBEDDING_MODEL
+    )
+    return embeddings
+
 def load_or_create_knowledge_base(file_path, index_path, api_key):
     """
-    Loads or creates the FAISS knowledge base.
+    Returns a retriever over the knowledge base, building the index first if it doesn't exist yet.
+    Dictionary edits are picked up by running `python build_index.py`, not at startup.
+    The index is memory-mapped read-only (see shared_index), so every worker shares one copy.
     """
-    embeddings = GoogleGenerativeAIEmbeddings(model="models/embedding-001", google_api_key=api_key, transport="rest")
-    if os.path.exists(index_path):
-        vector_store = FAISS.load_local(index_path, embeddings, allow_dangerous_deserialization=True)
-        return vector_store.as_retriever(search_kwargs={"k": 5})
-    
-    print(f"\nCreating new knowledge base from '{file_path}'...")
-    loader = TextLoader(file_path, encoding='utf-8')
-    documents = loader.load()
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=1500, chunk_overlap=200)
-    splits = text_splitter.split_documents(documents)
-    
-    vector_store = FAISS.from_documents(splits, embeddings)
-    vector_store.save_local(index_path)
-    print("✅ Knowledge base created and saved.")
-    return vector_store.as_retriever(search_kwargs={"k": 5})
+    create_embeddings(api_key)
+    # With several workers, the first to get the lock builds or exports; the others wait and then find it done
+    with build_index.build_lock(index_path):
+        if not os.path.exists(index_path):
+            print(f"\nCreating new knowledge base from '{file_path}'...")
+            build_index.update_index(file_path, index_path, embeddings, EMBEDDING_MODEL)
+            print("✅ Knowledge base created and saved.")
+        elif not shared_index.is_current(index_path):
+            # Built before the shared export existed, or by an older build_index: export it once
+            vector_store = FAISS.load_local(index_path, embeddings, allow_dangerous_deserialization=True)
+            shared_index.export(vector_store, index_path, EMBEDDING_MODEL)
+    return shared_index.load_retriever(index_path, embeddings, k=5)
+
+def get_http_client():
+    """
+    Returns the shared async HTTP client, creating it on first use so connections are pooled across requests.
+    """
+    global http_client
+    if http_client is None:
+        http_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(120.0, connect=10.0),
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=10)
+        )
+    return http_client
+
+async def close_http_client():
+    """
+    Closes the shared async HTTP client and its pooled connections.
+    """
+    global http_client
+    if http_client is not None:
+        await http_client.aclose()
+        http_client = None
 
-def generate_dream_image_data(text_prompt):
+async def generate_dream_image_data(text_prompt):
     """
-    Generates an image using Stability AI and returns it as a base64 data URI.
+    Generates an image using Stability AI and returns the decoded PNG bytes.
     """
     global stability_api_key
     if not stability_api_key:
         print("Error: Stability AI API key not found.")
         return None
 
-    url = "https://api.stability.ai/v1/generation/stable-diffusion-xl-1024-v1-0/text-to-image"
     headers = {"Accept": "application/json", "Authorization": f"Bearer {stability_api_key}"}
     payload = {"text_prompts": [{"text": text_prompt}], "cfg_scale": 7, "height": 1024, "width": 1024, "samples": 1, "steps": 30}
 
+    async def request():
+        response = await get_http_client().post(STABILITY_API_URL, headers=headers, json=payload)
+        if response.status_code in upstream.RETRYABLE_STATUS_CODES:
+            response.raise_for_status() # Rate limited or a server error: let the scheduler retry it
+        return response
+
     try:
-        response = requests.post(url, headers=headers, json=payload)
+        with metrics.timer("stability"):
+            response = await upstream.stability.call(request)
         if response.status_code != 200:
             print(f"🚨 Error from Stability AI: {response.text}")
             return None
         data = response.json()
         image = data["artifacts"][0]
-        base64_image = image["base64"]
-        return f"data:image/png;base64,{base64_image}"
+        return base64.b64decode(image["base64"])
     except Exception as e:
         print(f"\nAn error occurred during image generation: {e}")
         return None
 
+def timed_retriever(retriever):
+    """Wraps the knowledge base retriever so each lookup is timed as the 'retrieval' stage."""
+    def retrieve(query):
+        with metrics.timer("retrieval"):
+            return retriever.invoke(query)
+
+    async def aretrieve(query):
+        with metrics.timer("retrieval"):
+            return await retriever.ainvoke(query)
+
+    return RunnableLambda(retrieve, afunc=aretrieve)
+
 # MODIFIED FUNCTION
 def create_chains(llm_instance, knowledge_base_retriever):
     """Creates all necessary LangChain chains for the application."""
+    knowledge_base_retriever = timed_retriever(knowledge_base_retriever)
     
     # MODIFIED Interpretation prompt to include demographics
     interpret_prompt = ChatPromptTemplate.from_template(
@@ -151,7 +222,7 @@ def create_chains(llm_instance, knowledge_base_retriever):
     # MODIFIED Interpretation chain to accept a dictionary with dream_text and demographics
     interpretation_chain = (
         {
-            "context": lambda x: knowledge_base_retriever.invoke(x["dream_text"]),
+            "context": itemgetter("dream_text") | knowledge_base_retriever,
             "dream_text": lambda x: x["dream_text"],
             "demographics": lambda x: x["demographics"]
         }
@@ -188,7 +259,7 @@ def create_chains(llm_instance, knowledge_base_retriever):
         """
     )
     therapy_chain = (
-        {"context": lambda x: knowledge_base_retriever.invoke(x["question"]), "question": lambda x: x["question"], "history": lambda x: x["history"]}
+        {"context": itemgetter("question") | knowledge_base_retriever, "question": lambda x: x["question"], "history": lambda x: x["history"]}
         | therapy_prompt | llm_instance | StrOutputParser()
     )
     
@@ -197,5 +268,27 @@ def create_chains(llm_instance, knowledge_base_retriever):
         "Distill this dream interpretation into a concise, visually descriptive prompt for an AI image generator, focusing on concrete nouns, vivid adjectives, and mood as a comma-separated list: {interpretation}"
     )
     visual_prompt_chain = visual_prompt_template | llm_instance | StrOutputParser()
+
+    # Summary Chain: folds older therapy turns into a running summary so the history stays bounded
+    summary_prompt = ChatPromptTemplate.from_template(
+        """Progressively summarize a conversation between a user and a dream therapist. Extend the current summary with the new lines, keeping the dream, its interpretation, the user's feelings and any open questions. Stay under 200 words and write only the summary.
+
+        Current summary:
+        {summary}
+
+        New lines of conversation:
+        {new_lines}
+
+        New summary:
+        """
+    )
+    summary_chain = summary_prompt | llm_instance | StrOutputParser()
     
-    return interpretation_chain, therapy_chain, visual_prompt_chain
\ No newline at end of file
+    return interpretation_chain, therapy_chain, visual_prompt_chain, summary_chain
+
+async def summarize_conversation(summary, new_lines):
+    """
+    Folds new conversation lines into a running summary using the summary chain.
+    """
+    with metrics.timer("summary"):
+        return await upstream.gemini.call(summary_chain.ainvoke, {"summary": summary or "(none yet)", "new_lines": new_lines})
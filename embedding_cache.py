@@ -0,0 +1,147 @@
+import time
+import array
+import asyncio
+import sqlite3
+import hashlib
+import threading
+from langchain_core.embeddings import Embeddings
+
+CACHE_PATH = "embedding_cache.db"
+MAX_ENTRIES = 50000
+TOUCH_FLUSH_SECONDS = 60 # Hits are remembered in memory and their last_used written at most this often
+
+def normalize_text(text):
+    """Collapses whitespace so trivially different copies of a text share a cache entry."""
+    return " ".join(text.split())
+
+class CachedEmbeddings(Embeddings):
+    """
+    Wraps an embeddings model with a persistent on-disk cache.
+
+    Entries are keyed by a hash of the model name, the kind of embedding (query or document,
+    since some providers embed them differently) and the normalized text. The least recently
+    used entries are evicted once the cache holds more than `max_entries` vectors. Cache hits are
+    read-only: their last_used times are batched and written with the next store or flush, so
+    several server workers sharing the file don't queue up on its write lock for every lookup.
+    """
+
+    def __init__(self, embeddings, model_name, path=CACHE_PATH, max_entries=MAX_ENTRIES):
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._touched = {} # key -> time of its latest hit, not yet written to last_used
+        self._touched_since = time.monotonic()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode = WAL")
+        self._conn.execute("PRAGMA synchronous = NORMAL")
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS embeddings (
+                key TEXT PRIMARY KEY,
+                vector BLOB NOT NULL,
+                last_used REAL NOT NULL
+            )
+        ''')
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_last_used ON embeddings (last_used)")
+        self._conn.commit()
+
+    def _key(self, kind, text):
+        return hashlib.sha256(f"{self.model_name}\0{kind}\0{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+    def _lookup(self, keys):
+        """Returns the cached vectors for the given keys, noting them as recently used."""
+        found = {}
+        with self._lock:
+            for key in set(keys):
+                row = self._conn.execute("SELECT vector FROM embeddings WHERE key = ?", (key,)).fetchone()
+                if row:
+                    found[key] = array.array("f", row[0]).tolist()
+            now = time.time()
+            self._touched.update((key, now) for key in found)
+            if self._touched and time.monotonic() - self._touched_since >= TOUCH_FLUSH_SECONDS:
+                self._flush_touched()
+                self._conn.commit()
+        return found
+
+    def _flush_touched(self):
+        """Writes the batched last_used times; the caller holds the lock and commits."""
+        self._conn.executemany("UPDATE embeddings SET last_used = ? WHERE key = ?", [(now, key) for key, now in self._touched.items()])
+        self._touched.clear()
+        self._touched_since = time.monotonic()
+
+    def _store(self, items):
+        """Persists (key, vector) pairs, then evicts the least recently used entries beyond the size bound."""
+        now = time.time()
+        with self._lock:
+            # Pending hits go first, so eviction sees them as recently used
+            self._flush_touched()
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)",
+                [(key, array.array("f", vector).tobytes(), now) for key, vector in items]
+            )
+            excess = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0] - self.max_entries
+            if excess > 0:
+                self._conn.execute(
+                    "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY last_used ASC LIMIT ?)",
+                    (excess,)
+                )
+            self._conn.commit()
+
+    def _split(self, kind, texts):
+        keys = [self._key(kind, text) for text in texts]
+        cached = self._lookup(keys)
+        missing = list(dict.fromkeys(key for key in keys if key not in cached))
+        self.hits += len(keys) - sum(1 for key in keys if key not in cached)
+        self.misses += len(missing)
+        return keys, cached, missing
+
+    def embed_documents(self, texts):
+        keys, cached, missing = self._split("document", texts)
+        if missing:
+            missing_texts = [texts[keys.index(key)] for key in missing]
+            new_items = list(zip(missing, self.embeddings.embed_documents(missing_texts)))
+            self._store(new_items)
+            cached.update(new_items)
+        return [cached[key] for key in keys]
+
+    def embed_query(self, text):
+        keys, cached, missing = self._split("query", [text])
+        if missing:
+            vector = self.embeddings.embed_query(text)
+            self._store([(keys[0], vector)])
+            return vector
+        return cached[keys[0]]
+
+    # The async variants run the cache reads and writes on a thread: another worker process can hold the
+    # cache file's write lock, and waiting out its busy timeout must not stall the event loop
+    async def aembed_documents(self, texts):
+        keys, cached, missing = await asyncio.to_thread(self._split, "document", texts)
+        if missing:
+            missing_texts = [texts[keys.index(key)] for key in missing]
+            new_items = list(zip(missing, await self.embeddings.aembed_documents(missing_texts)))
+            await asyncio.to_thread(self._store, new_items)
+            cached.update(new_items)
+        return [cached[key] for key in keys]
+
+    async def aembed_query(self, text):
+        keys, cached, missing = await asyncio.to_thread(self._split, "query", [text])
+        if missing:
+            vector = await self.embeddings.aembed_query(text)
+            await asyncio.to_thread(self._store, [(keys[0], vector)])
+            return vector
+        return cached[keys[0]]
+
+    def stats(self):
+        """Returns hit/miss counters and the current size of the cache."""
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": entries,
+            "max_entries": self.max_entries,
+        }
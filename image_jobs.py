@@ -0,0 +1,96 @@
+import asyncio
+import random
+from datetime import datetime, timedelta, timezone
+
+import dream_image
+import db_utils
+import image_store
+import upstream
+import metrics
+
+# --- Job Queue Settings ---
+NUM_WORKERS = 2
+MAX_ATTEMPTS = 3
+RETRY_BASE_DELAY = 5.0 # Seconds; doubled after every failed attempt
+JOB_LEASE = timedelta(minutes=10) # A 'running' job older than this is assumed abandoned
+FAILED_IMAGE_URL = "https://placehold.co/512x512/000000/bbff00?text=Image+Gen+Failed"
+
+# --- Global Variables for the worker pool ---
+job_queue = None
+worker_tasks = []
+ai_ready = None # Event set once the chains the workers need are initialized
+
+async def start_workers(ready_event, num_workers=NUM_WORKERS):
+    """
+    Starts the worker pool and re-queues any jobs left unfinished by a previous run.
+    Workers hold off processing until `ready_event` is set.
+    """
+    global job_queue, ai_ready
+    ai_ready = ready_event
+    job_queue = asyncio.Queue()
+    stale_before = datetime.now(timezone.utc) - JOB_LEASE
+    for job_id in await db_utils.run_async(db_utils.get_unfinished_image_job_ids, stale_before):
+        job_queue.put_nowait(job_id)
+    for worker_number in range(num_workers):
+        worker_tasks.append(asyncio.create_task(_worker(worker_number)))
+    print(f"Image job workers started ({num_workers} workers, {job_queue.qsize()} jobs resumed).")
+
+async def stop_workers():
+    """
+    Cancels the worker pool. Jobs that were in flight stay 'running' and are resumed after their lease expires.
+    """
+    for task in worker_tasks:
+        task.cancel()
+    await asyncio.gather(*worker_tasks, return_exceptions=True)
+    worker_tasks.clear()
+
+def enqueue(job_id, delay=0):
+    """
+    Hands a persisted job to the worker pool, optionally after a delay.
+    """
+    if delay:
+        asyncio.get_running_loop().call_later(delay, job_queue.put_nowait, job_id)
+    else:
+        job_queue.put_nowait(job_id)
+
+async def _worker(worker_number):
+    await ai_ready.wait()
+    while True:
+        job_id = await job_queue.get()
+        try:
+            await process_job(job_id)
+        except Exception as e:
+            print(f"🚨 Image job worker {worker_number} crashed on job {job_id}: {e}")
+        finally:
+            job_queue.task_done()
+
+async def process_job(job_id):
+    """
+    Runs one attempt of an image job: visual prompt, image generation, then storing the result.
+    """
+    if not await db_utils.run_async(db_utils.claim_image_job, job_id):
+        return
+    job = await db_utils.run_async(db_utils.get_image_job, job_id)
+
+    try:
+        visual_prompt = job['visual_prompt']
+        if not visual_prompt:
+            with metrics.timer("visual_prompt"):
+                visual_prompt = await upstream.gemini.call(dream_image.visual_prompt_chain.ainvoke, {"interpretation": job['interpretation']})
+            await db_utils.run_async(db_utils.set_image_job_visual_prompt, job_id, visual_prompt)
+
+        image_bytes = await dream_image.generate_dream_image_data(visual_prompt)
+        if not image_bytes:
+            raise RuntimeError("Stability AI returned no image.")
+
+        with metrics.timer("image_save"):
+            image_hash = await asyncio.to_thread(image_store.save_image, image_bytes)
+        await db_utils.run_async(db_utils.finish_image_job, job_id, 'done', image_store.image_url(image_hash))
+    except Exception as e:
+        if job['attempts'] >= MAX_ATTEMPTS:
+            print(f"🚨 Image job {job_id} failed after {job['attempts']} attempts: {e}")
+            await db_utils.run_async(db_utils.finish_image_job, job_id, 'failed', FAILED_IMAGE_URL, error=str(e))
+            return
+        delay = RETRY_BASE_DELAY * (2 ** (job['attempts'] - 1)) * random.uniform(0.8, 1.2)
+        await db_utils.run_async(db_utils.release_image_job, job_id, str(e))
+        enqueue(job_id, delay=delay)
@@ -0,0 +1,78 @@
+import os
+import re
+import sys
+import base64
+import hashlib
+
+import db_utils
+
+# Generated images live on disk, addressed by the SHA-256 of their bytes
+IMAGE_DIR = "generated_images"
+IMAGE_URL_PREFIX = "/images/"
+IMAGE_MEDIA_TYPE = "image/png"
+HASH_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+def is_valid_hash(image_hash):
+    """Checks that a string is a well-formed content hash (and therefore safe to use in a path)."""
+    return bool(HASH_PATTERN.match(image_hash))
+
+def image_path(image_hash):
+    """Returns the on-disk location of an image, sharded by the first two hex digits."""
+    return os.path.join(IMAGE_DIR, image_hash[:2], f"{image_hash}.png")
+
+def image_url(image_hash):
+    """Returns the URL a message stores as its reference to an image."""
+    return f"{IMAGE_URL_PREFIX}{image_hash}"
+
+def variant_url(url, size):
+    """
+    Points a stored image URL at one of its resized variants (see image_variants.VARIANTS).
+    Other URLs, like the placeholder for a failed image, are returned unchanged.
+    """
+    if url and url.startswith(IMAGE_URL_PREFIX):
+        return f"{url}?size={size}"
+    return url
+
+def save_image(image_bytes):
+    """
+    Stores image bytes under their content hash and returns the hash.
+    Writing the same image twice is a no-op.
+    """
+    image_hash = hashlib.sha256(image_bytes).hexdigest()
+    path = image_path(image_hash)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(image_bytes)
+        os.replace(tmp_path, path)
+    return image_hash
+
+def save_data_uri(data_uri):
+    """Decodes a base64 data URI once and stores its bytes, returning the content hash."""
+    _, encoded = data_uri.split(",", 1)
+    return save_image(base64.b64decode(encoded))
+
+def migrate_inline_images(batch_size=20):
+    """
+    Moves base64 data URIs still stored in messages.image_data into the blob store,
+    replacing each with an /images/{hash} reference. Returns the number of rows migrated.
+    """
+    migrated = 0
+    last_id = 0
+    while True:
+        rows = db_utils.get_inline_image_messages(last_id, batch_size)
+        if not rows:
+            return migrated
+        for row in rows:
+            image_hash = save_data_uri(row['image_data'])
+            db_utils.set_message_image_data(row['id'], image_url(image_hash))
+            last_id = row['id']
+            migrated += 1
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["migrate"]:
+        print("Usage: python image_store.py migrate")
+        sys.exit(1)
+    db_utils.migrate()
+    print(f"✅ Migrated {migrate_inline_images()} inline images to '{IMAGE_DIR}'.")
@@ -0,0 +1,81 @@
+import os
+import time
+import asyncio
+from PIL import Image
+
+import image_store
+import metrics
+import process_pool
+
+# --- Image Variant Settings (overridable through the environment) ---
+THUMBNAIL_SIZE = int(os.environ.get("IMAGE_THUMBNAIL_SIZE", "512"))        # Longest side of the chat thumbnail, in pixels
+THUMBNAIL_QUALITY = int(os.environ.get("IMAGE_THUMBNAIL_QUALITY", "80"))   # WebP quality, 0-100
+FULL_QUALITY = int(os.environ.get("IMAGE_FULL_QUALITY", "90"))
+ENCODE_WORKERS = int(os.environ.get("IMAGE_ENCODE_WORKERS", str(os.cpu_count() or 1)))
+
+# Variant name -> (longest side in pixels or None to keep the original size, WebP quality)
+VARIANTS = {
+    "thumb": (THUMBNAIL_SIZE, THUMBNAIL_QUALITY),
+    "full": (None, FULL_QUALITY),
+}
+VARIANT_MEDIA_TYPE = "image/webp"
+
+# Decoding, resizing and encoding are CPU-bound, so they run in worker processes rather than on
+# the event loop or the default thread pool
+_pool = process_pool.LazyProcessPool()
+_pending = {} # (image hash, variant) -> encode in progress, shared by concurrent first requests
+
+def variant_path(image_hash, variant):
+    """Returns where a variant is cached: next to the original PNG, named after the variant."""
+    return os.path.join(image_store.IMAGE_DIR, image_hash[:2], f"{image_hash}.{variant}.webp")
+
+def encode_variant(source_path, dest_path, max_side, quality):
+    """Writes a WebP copy of an image, downscaled to `max_side` if given. Returns (bytes written, encode seconds)."""
+    started = time.perf_counter()
+    with Image.open(source_path) as image:
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+        if max_side:
+            image.thumbnail((max_side, max_side), Image.LANCZOS)
+        tmp_path = f"{dest_path}.{os.getpid()}.tmp"
+        image.save(tmp_path, format="WEBP", quality=quality, method=4)
+    os.replace(tmp_path, dest_path)
+    return os.path.getsize(dest_path), time.perf_counter() - started
+
+async def _encode(image_hash, variant, path):
+    max_side, quality = VARIANTS[variant]
+    source_path = image_store.image_path(image_hash)
+    loop = asyncio.get_running_loop()
+    with metrics.timer("image_encode"):
+        size, seconds = await loop.run_in_executor(_pool.get(ENCODE_WORKERS), encode_variant, source_path, path, max_side, quality)
+    source_size = os.path.getsize(source_path)
+    image_encode_seconds.observe(seconds, variant=variant)
+    image_variant_bytes.observe(size, variant=variant)
+    image_bytes_saved.inc(source_size - size, variant=variant)
+    print(f"🖼️ Encoded {variant} variant of {image_hash[:12]}: {source_size} → {size} bytes in {seconds * 1000:.0f} ms")
+    return path
+
+async def get_variant(image_hash, variant):
+    """
+    Returns the path of an image variant, encoding and caching it on first request.
+    Concurrent first requests for the same variant wait on a single encode.
+    """
+    path = variant_path(image_hash, variant)
+    if os.path.exists(path):
+        return path
+    key = (image_hash, variant)
+    if key not in _pending:
+        _pending[key] = asyncio.ensure_future(_encode(image_hash, variant, path))
+        _pending[key].add_done_callback(lambda _: _pending.pop(key, None))
+    # Shielded so one client disconnecting doesn't cancel the encode the others are waiting on
+    return await asyncio.shield(_pending[key])
+
+def shutdown():
+    """Stops the worker processes; the pool is recreated on next use."""
+    _pool.shutdown()
+
+# --- Metrics ---
+BYTE_BUCKETS = (16_384, 32_768, 65_536, 131_072, 262_144, 524_288, 1_048_576, 2_097_152, 4_194_304)
+image_encode_seconds = metrics.Histogram("oneiromind_image_encode_seconds", "Time to decode, resize and encode one image variant.", ("variant",))
+image_variant_bytes = metrics.Histogram("oneiromind_image_variant_bytes", "Size of each encoded image variant.", ("variant",), buckets=BYTE_BUCKETS)
+image_bytes_saved = metrics.Counter("oneiromind_image_bytes_saved_total", "Bytes saved per variant compared to the original PNG.", ("variant",))
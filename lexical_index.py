@@ -0,0 +1,59 @@
+"""
+BM25 keyword index over the dream-dictionary chunks, stored in the shared chunk store.
+
+Most dreams name concrete dictionary symbols (snakes, water, teeth), which a local full-text
+lookup finds in well under a millisecond with no embedding call. The index is an SQLite FTS5
+table built beside the `chunks` table by shared_index.export; rows are keyed by the chunk's
+FAISS position, so keyword and vector hits can be merged with reciprocal rank fusion.
+"""
+import re
+
+TOKEN_PATTERN = re.compile(r"[a-z]+")
+MAX_QUERY_TERMS = 32
+RRF_CONSTANT = 60 # The usual damping constant; keeps one retriever's top hit from dominating the fused ranking
+
+STOPWORDS = frozenset("""
+    a about above after again against all am an and any are as at be because been before being below
+    between both but by can could did do does doing down during each few for from further had has
+    have having he her here hers herself him himself his how i if in into is it its itself just me
+    more most my myself no nor not now of off on once only or other our ours ourselves out over own
+    same she should so some such than that the their theirs them themselves then there these they
+    this those through to too under until up very was we were what when where which while who whom
+    why will with would you your yours yourself yourselves dream dreamt dreamed dreaming dreams
+    like felt feel saw see seemed got went suddenly also still really
+""".split())
+
+def query_terms(text):
+    """The distinct non-stopword terms of a text, in order of first appearance."""
+    terms = []
+    for token in TOKEN_PATTERN.findall(text.lower()):
+        if len(token) > 2 and token not in STOPWORDS and token not in terms:
+            terms.append(token)
+    return terms[:MAX_QUERY_TERMS]
+
+def build(conn):
+    """Creates the FTS5 index over an export's `chunks` table (porter stemming, so 'snakes' matches 'snake')."""
+    conn.execute(
+        "CREATE VIRTUAL TABLE chunks_fts USING fts5(text, content='chunks', content_rowid='position', tokenize='porter unicode61')"
+    )
+    conn.execute("INSERT INTO chunks_fts(chunks_fts) VALUES ('rebuild')")
+
+def search(conn, text, k):
+    """Returns the positions of the `k` chunks that best match the text's terms, best first (by BM25)."""
+    terms = query_terms(text)
+    if not terms:
+        return []
+    # Quoted terms are matched literally, so nothing in the dream text is read as FTS query syntax
+    expression = " OR ".join(f'"{term}"' for term in terms)
+    rows = conn.execute(
+        "SELECT rowid FROM chunks_fts WHERE chunks_fts MATCH ? ORDER BY rank LIMIT ?", (expression, k)
+    ).fetchall()
+    return [row[0] for row in rows]
+
+def reciprocal_rank_fusion(rankings, k):
+    """Merges ranked lists of positions: each list adds 1 / (RRF_CONSTANT + rank) to a position's score."""
+    scores = {}
+    for ranking in rankings:
+        for rank, position in enumerate(ranking, start=1):
+            scores[position] = scores.get(position, 0.0) + 1.0 / (RRF_CONSTANT + rank)
+    return sorted(scores, key=scores.get, reverse=True)[:k]
@@ -0,0 +1,552 @@
+"""
+Offline load test for OneiroMind.
+
+Runs the app against local stand-ins for every upstream (a chat model with configurable latency
+and token streaming, deterministic embeddings, and an HTTP server that answers like Stability's
+text-to-image endpoint) and drives it with concurrent virtual users. Each user registers and
+logs in, then repeats a journey: submit a dream, take a few therapy turns while the dream image
+renders, and browse its history. Per-endpoint p50/p95/p99 latency and requests/sec are written
+as JSON, so runs can be compared with `compare`.
+
+Usage:
+    python loadtest.py run [--users 20] [--iterations 3] [--therapy-turns 3] [--ramp-up 2]
+                           [--llm-latency 0.8] [--token-delay 0.02] [--reply-words 120]
+                           [--embedding-latency 0.05] [--image-latency 3.0] [--image-size 1024]
+                           [--url http://127.0.0.1:8000] [--output results.json]
+    python loadtest.py compare baseline.json candidate.json
+
+`run` starts the app with the stubs in a subprocess (`loadtest.py serve`) on a throwaway database,
+image directory and embedding cache. With --url it drives a server that is already running instead;
+start that one with STABILITY_API_URL pointing at a stub, or image jobs will call the real API.
+Upstream limits come from the usual environment variables (GEMINI_RATE, STABILITY_CONCURRENCY,
+BCRYPT_ROUNDS, ...), which the server subprocess inherits.
+"""
+import os
+import io
+import re
+import sys
+import json
+import math
+import time
+import uuid
+import base64
+import socket
+import shutil
+import asyncio
+import hashlib
+import argparse
+import tempfile
+import threading
+import subprocess
+from datetime import datetime, timezone
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import httpx
+import numpy as np
+from PIL import Image
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+SYMBOLS = (
+    "falling", "flying", "water", "teeth", "snakes", "being chased", "exams", "houses", "doors", "fire",
+    "death", "babies", "cars", "trains", "bridges", "mountains", "the ocean", "storms", "mirrors", "keys",
+    "dogs", "cats", "birds", "spiders", "money", "school", "weddings", "hospitals", "forests", "stairs",
+)
+PLACES = ("my childhood home", "an empty train station", "a crowded market", "my old school", "a forest at night", "the beach")
+QUESTIONS = (
+    "Why do you think the dream keeps coming back?",
+    "What does the feeling of being lost say about me?",
+    "Could this be connected to stress at work?",
+    "How can I stop having this dream?",
+    "No, I am satisfied, thank you.",
+)
+
+# --- Upstream Stubs ---
+def _reply_text(words):
+    """An interpretation-shaped reply (the headings and bullets the renderer handles) of roughly `words` words."""
+    filler = ("The dream points to a period of change and uncertainty in waking life. " * math.ceil(words / 12)).split()
+    third = max(1, len(filler[:words]) // 3)
+    parts = [filler[i:i + third] for i in range(0, len(filler[:words]), third)]
+    sections = ("**Direct Meaning:**", "**Symbolic Meaning:**", "**Combined Interpretation:**")
+    return "\n".join(f"{heading}\n* {' '.join(part)}" for heading, part in zip(sections, parts))
+
+class FakeChatModel(BaseChatModel):
+    """
+    A chat model that answers every prompt with `reply`. It waits `latency` seconds before the
+    first token and `token_delay` seconds between tokens, for both invoke and stream.
+    """
+    reply: str
+    latency: float = 0.8
+    token_delay: float = 0.02
+
+    @property
+    def _llm_type(self):
+        return "loadtest-fake"
+
+    def _tokens(self):
+        return re.findall(r"\S+\s*", self.reply)
+
+    def _result(self):
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self.reply))])
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        time.sleep(self.latency + self.token_delay * len(self._tokens()))
+        return self._result()
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        await asyncio.sleep(self.latency + self.token_delay * len(self._tokens()))
+        return self._result()
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        await asyncio.sleep(self.latency)
+        for token in self._tokens():
+            await asyncio.sleep(self.token_delay)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=token))
+
+class FakeEmbeddings(Embeddings):
+    """
+    Deterministic embeddings: every text maps to a fixed unit vector seeded from its hash, so equal
+    texts embed identically across runs. The async methods add `latency` to stand in for the network.
+    """
+
+    def __init__(self, size=768, latency=0.0):
+        self.size = size
+        self.latency = latency
+
+    def _vector(self, text):
+        seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+        vector = np.random.default_rng(seed).standard_normal(self.size)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+    def embed_documents(self, texts):
+        return [self._vector(text) for text in texts]
+
+    def embed_query(self, text):
+        return self._vector(text)
+
+    async def aembed_documents(self, texts):
+        await asyncio.sleep(self.latency)
+        return self.embed_documents(texts)
+
+    async def aembed_query(self, text):
+        await asyncio.sleep(self.latency)
+        return self.embed_query(text)
+
+def _dictionary_entries():
+    """A synthetic dream dictionary, with chunks about the size the index builder produces."""
+    return [
+        f"{symbol.title()} ({variant}): " + f"Dreaming of {symbol} often reflects how the dreamer feels about control, change and safety. " * 12
+        for symbol in SYMBOLS for variant in range(10)
+    ]
+
+def _stub_image(size):
+    """A PNG of noise, which compresses about as badly as a real generated image."""
+    buffer = io.BytesIO()
+    Image.effect_noise((size, size), 48).convert("RGB").save(buffer, format="PNG")
+    return buffer.getvalue()
+
+def start_stability_stub(latency, image_size):
+    """Serves Stability-style text-to-image responses from a background thread; returns the server."""
+    body = json.dumps({
+        "artifacts": [{"base64": base64.b64encode(_stub_image(image_size)).decode("ascii"), "seed": 0, "finishReason": "SUCCESS"}]
+    }).encode("utf-8")
+
+    class StabilityHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            time.sleep(latency)
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            try:
+                self.wfile.write(body)
+            except (BrokenPipeError, ConnectionResetError):
+                pass # The app was stopped while an image job was still waiting on us
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StabilityHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+# --- Server ---
+def serve(args):
+    """Runs the app with every upstream replaced by a local stub, keeping all state under args.workdir."""
+    import uvicorn
+    from langchain_community.vectorstores import FAISS
+    import main
+    import db_utils
+    import dream_image
+    import image_store
+    import embedding_cache
+    import shared_index
+    import upstream
+
+    db_utils.DATABASE_NAME = os.path.join(args.workdir, "loadtest.db")
+    image_store.IMAGE_DIR = os.path.join(args.workdir, "images")
+
+    def get_api_keys():
+        dream_image.stability_api_key = "loadtest"
+        return "loadtest", "loadtest"
+
+    def setup_llm(google_api_key, probe=False):
+        return FakeChatModel(reply=_reply_text(args.reply_words), latency=args.llm_latency, token_delay=args.token_delay)
+
+    def load_or_create_knowledge_base(file_path, index_path, api_key):
+        dream_image.embeddings = embedding_cache.CachedEmbeddings(
+            upstream.LimitedEmbeddings(FakeEmbeddings(latency=args.embedding_latency), upstream.embeddings),
+            model_name="loadtest-fake",
+            path=os.path.join(args.workdir, "embedding_cache.db")
+        )
+        # Served the way production serves it: saved, exported and memory-mapped
+        index_path = os.path.join(args.workdir, "index")
+        vector_store = FAISS.from_texts(_dictionary_entries(), dream_image.embeddings)
+        vector_store.save_local(index_path)
+        shared_index.export(vector_store, index_path, "loadtest-fake")
+        return shared_index.load_retriever(index_path, dream_image.embeddings, k=5)
+
+    dream_image.get_api_keys = get_api_keys
+    dream_image.setup_llm = setup_llm
+    dream_image.load_or_create_knowledge_base = load_or_create_knowledge_base
+    uvicorn.run(main.app, host="127.0.0.1", port=args.port, log_level="warning", access_log=False)
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+# --- Load Generator ---
+class Recorder:
+    """Collects per-endpoint latencies (seconds), time-to-first-token for streams, and error counts."""
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.ttfts = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def record(self, name, elapsed, ok=True, ttft=None):
+        self.latencies[name].append(elapsed)
+        if ttft is not None:
+            self.ttfts[name].append(ttft)
+        if not ok:
+            self.errors[name] += 1
+
+    def fail(self, name):
+        """Counts a request that never completed (timeout, dropped connection)."""
+        self.errors[name] += 1
+
+async def _request(client, recorder, name, method, url, ok=None, **kwargs):
+    """Sends one request and records it; `ok(response)` overrides the default success test (status < 400)."""
+    started = time.perf_counter()
+    try:
+        response = await client.request(method, url, **kwargs)
+    except httpx.HTTPError:
+        recorder.fail(name)
+        return None
+    recorder.record(name, time.perf_counter() - started, ok(response) if ok else response.status_code < 400)
+    return response
+
+async def _stream(client, recorder, name, url, body):
+    """Posts to a server-sent events endpoint, recording total time and time to the first token; returns the 'done' event."""
+    started = time.perf_counter()
+    ttft = None
+    done = None
+    try:
+        async with client.stream("POST", url, json=body) as response:
+            if response.status_code >= 400:
+                await response.aread()
+                recorder.record(name, time.perf_counter() - started, ok=False)
+                return None
+            async for line in response.aiter_lines():
+                if not line.startswith("data: "):
+                    continue
+                event = json.loads(line[len("data: "):])
+                if event["type"] == "token" and ttft is None:
+                    ttft = time.perf_counter() - started
+                elif event["type"] in ("done", "error"):
+                    done = event if event["type"] == "done" else None
+    except httpx.HTTPError:
+        recorder.fail(name)
+        return None
+    recorder.record(name, time.perf_counter() - started, ok=done is not None, ttft=ttft)
+    return done
+
+async def _wait_for_image(client, recorder, job_id, submitted_at, timeout):
+    """Polls an image job the way the chat page does, then fetches the chat thumbnail once it is ready."""
+    while time.perf_counter() - submitted_at < timeout:
+        await asyncio.sleep(3)
+        response = await _request(client, recorder, "image_job_status", "GET", f"/image_jobs/{job_id}")
+        if response is None or response.status_code >= 400:
+            continue
+        job = response.json()
+        if job["image_url"]:
+            recorder.record("image_ready", time.perf_counter() - submitted_at, ok=job["status"] == "done")
+            if job["image_url"].startswith("/images/"):
+                await _request(client, recorder, "image_thumb", "GET", job["image_url"], params={"size": "thumb"})
+            return
+    recorder.fail("image_ready")
+
+async def _browse_history(client, recorder, max_pages):
+    """Opens the home page, scrolls the sidebar, then opens the newest chat and scrolls back through it."""
+    await _request(client, recorder, "home_page", "GET", "/")
+    cursor = None
+    newest_session_id = None
+    for _ in range(max_pages):
+        response = await _request(client, recorder, "sessions_page", "GET", "/api/sessions", params={"cursor": cursor} if cursor else None)
+        if response is None or response.status_code >= 400:
+            return
+        page = response.json()
+        if newest_session_id is None and page["sessions"]:
+            newest_session_id = page["sessions"][0]["id"]
+        cursor = page["next_cursor"]
+        if not cursor:
+            break
+    if newest_session_id is None:
+        return
+
+    await _request(client, recorder, "chat_page", "GET", f"/chat/{newest_session_id}")
+    cursor = None
+    for _ in range(max_pages):
+        response = await _request(
+            client, recorder, "messages_page", "GET", f"/api/sessions/{newest_session_id}/messages", params={"cursor": cursor} if cursor else None
+        )
+        if response is None or response.status_code >= 400:
+            return
+        cursor = response.json()["next_cursor"]
+        if not cursor:
+            break
+
+async def virtual_user(base_url, run_id, user_number, args, recorder):
+    """One simulated user: register and log in, then `iterations` dream journeys."""
+    await asyncio.sleep(args.ramp_up * user_number / args.users)
+    email = f"loadtest-{run_id}-{user_number}@example.com"
+    credentials = {"email": email, "password": "loadtest-password"}
+    async with httpx.AsyncClient(base_url=base_url, timeout=args.timeout) as client:
+        response = await _request(client, recorder, "register", "POST", "/register", data=credentials)
+        user_id = re.search(r"user_id=(\d+)", response.headers.get("location", "")) if response is not None else None
+        if not user_id:
+            return
+        await _request(client, recorder, "demographics", "POST", "/submit_demographics", data={
+            "user_id": user_id.group(1), "age_range": "25-34", "gender": "Prefer not to say",
+            "country": "India", "life_stage": "Working professional"
+        })
+        await _request(client, recorder, "login", "POST", "/login", data=credentials, ok=lambda r: "access_token" in r.cookies)
+        if "access_token" not in client.cookies:
+            return
+
+        for iteration in range(args.iterations):
+            symbol = SYMBOLS[(user_number + iteration) % len(SYMBOLS)]
+            place = PLACES[(user_number * 7 + iteration) % len(PLACES)]
+            dream_text = f"I dreamt of {symbol} in {place}. User {user_number} night {iteration}: I woke up unsettled."
+            done = await _stream(client, recorder, "submit_dream", "/submit_message/stream", {"dream_text": dream_text})
+            if done:
+                image_wait = asyncio.create_task(
+                    _wait_for_image(client, recorder, done["job_id"], time.perf_counter(), args.image_timeout)
+                )
+                await _request(client, recorder, "start_therapy", "POST", "/start_therapy", json={"session_id": done["session_id"]})
+                for turn in range(args.therapy_turns):
+                    # The last turn closes the conversation the way most real sessions end
+                    question = QUESTIONS[-1] if turn == args.therapy_turns - 1 else QUESTIONS[turn % (len(QUESTIONS) - 1)]
+                    await _stream(client, recorder, "therapy", "/therapy/stream", {"session_id": done["session_id"], "question": question})
+                await image_wait
+            await _browse_history(client, recorder, args.max_pages)
+
+async def wait_until_ready(base_url, timeout):
+    async with httpx.AsyncClient(base_url=base_url) as client:
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                if (await client.get("/readyz")).status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.25)
+    raise RuntimeError(f"Server at {base_url} was not ready after {timeout} seconds")
+
+async def _server_stats(base_url):
+    try:
+        async with httpx.AsyncClient(base_url=base_url) as client:
+            return (await client.get("/stats")).json()
+    except (httpx.HTTPError, ValueError):
+        return None
+
+def _percentile(sorted_values, percent):
+    """Nearest-rank percentile of an already sorted list."""
+    return sorted_values[max(0, math.ceil(percent / 100 * len(sorted_values)) - 1)]
+
+def _latency_summary(values):
+    values = sorted(values)
+    return {
+        "p50_ms": round(_percentile(values, 50) * 1000, 1),
+        "p95_ms": round(_percentile(values, 95) * 1000, 1),
+        "p99_ms": round(_percentile(values, 99) * 1000, 1),
+        "max_ms": round(values[-1] * 1000, 1),
+        "mean_ms": round(sum(values) / len(values) * 1000, 1),
+    }
+
+def summarize(recorder, elapsed):
+    """Builds the per-endpoint report: request count, errors, requests/sec and latency percentiles."""
+    endpoints = {}
+    for name in sorted(set(recorder.latencies) | set(recorder.errors)):
+        latencies = recorder.latencies[name]
+        entry = {"count": len(latencies), "errors": recorder.errors[name], "rps": round(len(latencies) / elapsed, 2)}
+        if latencies:
+            entry.update(_latency_summary(latencies))
+        if recorder.ttfts[name]:
+            entry["ttft"] = _latency_summary(recorder.ttfts[name])
+        endpoints[name] = entry
+    # image_ready is the background render finishing, not an HTTP request
+    requests = sum(entry["count"] for name, entry in endpoints.items() if name != "image_ready")
+    return {
+        "duration_seconds": round(elapsed, 2),
+        "requests": requests,
+        "errors": sum(entry["errors"] for entry in endpoints.values()),
+        "rps": round(requests / elapsed, 2),
+        "endpoints": endpoints,
+    }
+
+async def _drive(base_url, args):
+    await wait_until_ready(base_url, args.startup_timeout)
+    recorder = Recorder()
+    run_id = uuid.uuid4().hex[:8]
+    started = time.perf_counter()
+    await asyncio.gather(*(virtual_user(base_url, run_id, user_number, args, recorder) for user_number in range(args.users)))
+    results = summarize(recorder, time.perf_counter() - started)
+    results["server"] = await _server_stats(base_url)
+    return results
+
+STUB_OPTIONS = ("llm_latency", "token_delay", "reply_words", "embedding_latency")
+
+def start_app(args, workdir, **env_overrides):
+    """
+    Starts the Stability stub and the app on stubs (`loadtest.py serve`) in a subprocess logging to
+    workdir/server.log. Returns (server process, Stability stub, base URL); the caller stops both.
+    """
+    stability_stub = start_stability_stub(args.image_latency, args.image_size)
+    port = _free_port()
+    env = dict(
+        os.environ,
+        STABILITY_API_URL=f"http://127.0.0.1:{stability_stub.server_port}/v1/generation/stub/text-to-image",
+        **env_overrides
+    )
+    command = [sys.executable, os.path.abspath(__file__), "serve", "--port", str(port), "--workdir", workdir]
+    for option in STUB_OPTIONS:
+        command += [f"--{option.replace('_', '-')}", str(getattr(args, option))]
+    with open(os.path.join(workdir, "server.log"), "w") as server_log:
+        server = subprocess.Popen(command, env=env, cwd=os.path.dirname(os.path.abspath(__file__)), stdout=server_log, stderr=subprocess.STDOUT)
+    return server, stability_stub, f"http://127.0.0.1:{port}"
+
+def stop_app(server, stability_stub):
+    if server is not None:
+        server.terminate()
+        server.wait(timeout=30)
+    if stability_stub is not None:
+        stability_stub.shutdown()
+
+def print_server_log(workdir):
+    with open(os.path.join(workdir, "server.log")) as f:
+        print(f.read()[-4000:], file=sys.stderr)
+
+def run(args):
+    """Starts the stubs and (unless --url is given) the app, runs the virtual users and writes the JSON report."""
+    stability_stub = None
+    server = None
+    workdir = None
+    base_url = args.url
+    try:
+        if not base_url:
+            workdir = tempfile.mkdtemp(prefix="oneiromind-loadtest-")
+            server, stability_stub, base_url = start_app(args, workdir)
+
+        print(f"🚦 {args.users} users x {args.iterations} journeys against {base_url}...", file=sys.stderr)
+        try:
+            results = asyncio.run(_drive(base_url, args))
+        except RuntimeError:
+            if workdir:
+                print_server_log(workdir)
+            raise
+    finally:
+        stop_app(server, stability_stub)
+        if workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    results = {
+        "started_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "config": {
+            name: getattr(args, name)
+            for name in ("users", "iterations", "therapy_turns", "ramp_up", "image_latency", "image_size", "url") + STUB_OPTIONS
+        },
+        **results,
+    }
+    report = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(report + "\n")
+        print(f"✅ {results['requests']} requests, {results['errors']} errors, {results['rps']} req/s; report written to {args.output}", file=sys.stderr)
+    else:
+        print(report)
+
+def compare(baseline_path, candidate_path):
+    """Prints each endpoint's p50/p95/p99 and requests/sec side by side with the relative change."""
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)
+    with open(candidate_path, encoding="utf-8") as f:
+        candidate = json.load(f)
+
+    def change(old, new):
+        return f"{(new - old) / old * 100:+6.1f}%" if old else "    n/a"
+
+    print(f"{'endpoint':<18} {'metric':<7} {'baseline':>10} {'candidate':>10} {'change':>8}")
+    for name in sorted(set(baseline["endpoints"]) | set(candidate["endpoints"])):
+        old, new = baseline["endpoints"].get(name, {}), candidate["endpoints"].get(name, {})
+        for metric in ("p50_ms", "p95_ms", "p99_ms", "rps", "errors"):
+            if metric in old and metric in new:
+                print(f"{name:<18} {metric:<7} {old[metric]:>10} {new[metric]:>10} {change(old[metric], new[metric]):>8}")
+    print(f"{'overall':<18} {'rps':<7} {baseline['rps']:>10} {candidate['rps']:>10} {change(baseline['rps'], candidate['rps']):>8}")
+
+def _add_stub_options(parser):
+    parser.add_argument("--llm-latency", type=float, default=0.8, help="Seconds before the fake LLM's first token")
+    parser.add_argument("--token-delay", type=float, default=0.02, help="Seconds between streamed tokens")
+    parser.add_argument("--reply-words", type=int, default=120, help="Length of every fake LLM reply")
+    parser.add_argument("--embedding-latency", type=float, default=0.05, help="Seconds per fake embedding call")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="OneiroMind offline load test")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="Drive the app with concurrent virtual users and report latency percentiles")
+    run_parser.add_argument("--users", type=int, default=20, help="Concurrent virtual users")
+    run_parser.add_argument("--iterations", type=int, default=3, help="Dream journeys per user")
+    run_parser.add_argument("--therapy-turns", type=int, default=3, help="Therapy questions per dream")
+    run_parser.add_argument("--ramp-up", type=float, default=2.0, help="Seconds over which users start")
+    run_parser.add_argument("--max-pages", type=int, default=3, help="Sidebar and message pages scrolled per history visit")
+    run_parser.add_argument("--image-latency", type=float, default=3.0, help="Seconds the Stability stub takes per image")
+    run_parser.add_argument("--image-size", type=int, default=1024, help="Side of the stub image in pixels")
+    run_parser.add_argument("--image-timeout", type=float, default=120.0, help="Seconds to wait for a dream image before counting an error")
+    run_parser.add_argument("--timeout", type=float, default=120.0, help="Per-request timeout in seconds")
+    run_parser.add_argument("--startup-timeout", type=float, default=120.0, help="Seconds to wait for /readyz")
+    run_parser.add_argument("--url", help="Drive an already running server instead of starting one")
+    run_parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    _add_stub_options(run_parser)
+
+    serve_parser = subparsers.add_parser("serve", help="Run the app with stubbed upstreams (started by `run`)")
+    serve_parser.add_argument("--port", type=int, default=8000)
+    serve_parser.add_argument("--workdir", required=True, help="Directory for the throwaway database, images and caches")
+    _add_stub_options(serve_parser)
+
+    compare_parser = subparsers.add_parser("compare", help="Compare two JSON reports")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("candidate")
+
+    args = parser.parse_args()
+    if args.command == "run":
+        run(args)
+    elif args.command == "serve":
+        serve(args)
+    elif args.command == "compare":
+        compare(args.baseline, args.candidate)
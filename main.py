@@ -1,40 +1,196 @@
 import uvicorn
-from fastapi import FastAPI, Request, Form, Depends, HTTPException, status
-from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse
+from fastapi import FastAPI, Request, Form, Depends, HTTPException, Header, status
+from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse, FileResponse, Response, StreamingResponse, PlainTextResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from pydantic import BaseModel
 from jose import JWTError, jwt
 from datetime import datetime, timedelta, timezone
 import pytz
-import re
+import os
+import json
+import argparse
+import base64
+import time
+import asyncio
 
 import dream_image
 import db_utils
+import image_jobs
+import image_store
+import image_variants
+import maintenance
+import semantic_cache
+import singleflight
+import conversation_memory
+import passwords
+import rendering
+import upstream
+import metrics
 
 # --- Security and App Setup ---
 SECRET_KEY = "a_very_secret_key_for_jwt"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60
 
+FOLLOW_UP_PROMPT = "Would you like to ask some follow-up questions about this interpretation?"
+LLM_BUSY_MESSAGE = "The dream interpreter is very busy right now. Please try again shortly."
+# Stop proxies from buffering server-sent events, which would defeat token streaming
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+# Sidebar sessions and chat messages are rendered a page at a time; the rest load from the JSON APIs as the user scrolls
+SESSION_PAGE_SIZE = 30
+MESSAGE_PAGE_SIZE = 30
+MAX_PAGE_SIZE = 100
+IST_TIMEZONE = pytz.timezone("Asia/Kolkata")
+
+# Duplicate dream submissions from the same user attach to the first one while it runs and for this long after.
+# This state is per worker process: with several workers, a duplicate or Idempotency-Key retry that lands on a
+# different worker than the original is not coalesced and starts its own submission
+SUBMISSION_COALESCE_SECONDS = float(os.environ.get("SUBMISSION_COALESCE_SECONDS", "300"))
+submissions = singleflight.SingleFlight(ttl_seconds=SUBMISSION_COALESCE_SECONDS)
+submission_requests = metrics.Counter(
+    "oneiromind_submission_requests_total", "Dream submissions, by whether they started work, joined a duplicate or reused an Idempotency-Key.", ("outcome",)
+)
+
 app = FastAPI()
 
 app.mount("/static", StaticFiles(directory="static"), name="static")
 templates = Jinja2Templates(directory="templates")
+templates.env.filters["image_variant"] = image_store.variant_url
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    """Tracks in-flight requests and per-route latency, and adds a Server-Timing breakdown if enabled."""
+    metrics.http_requests_in_flight.inc()
+    timings = metrics.start_request_timings()
+    started = time.perf_counter()
+    status_code = 500
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+    finally:
+        elapsed = time.perf_counter() - started
+        metrics.http_requests_in_flight.dec()
+        route = request.scope.get("route")
+        metrics.http_request_seconds.observe(
+            elapsed, method=request.method, route=route.path if route else "unmatched", status=status_code
+        )
+    if metrics.SERVER_TIMING_ENABLED:
+        response.headers["Server-Timing"] = metrics.server_timing_header(timings, elapsed)
+    return response
 
 # --- AI Agent Initialization ---
-@app.on_event("startup")
-def startup_event():
+# Startup only migrates the database, so login and static pages are served at once. The AI
+# components warm up concurrently in the background and report their progress through /readyz.
+LLM_STARTUP_PROBE = os.environ.get("LLM_STARTUP_PROBE", "false").lower() in ("1", "true", "yes")
+# A failed step is retried with exponential backoff (2s, 4s, 8s, ...). Once a worker gives up, /healthz
+# reports it as failed, so the process supervisor restarts it instead of it answering 503 forever
+INIT_ATTEMPTS = int(os.environ.get("INIT_ATTEMPTS", "5"))
+INIT_BACKOFF_SECONDS = float(os.environ.get("INIT_BACKOFF_SECONDS", "2"))
+AI_COMPONENTS = ("llm", "knowledge_base", "chains")
+
+component_status = {name: {"ready": False, "error": None} for name in ("database",) + AI_COMPONENTS}
+ai_ready = asyncio.Event()
+ai_init_task = None
+image_migration_task = None
+maintenance_task = None
+
+async def _init_component(name, start):
+    """
+    Runs one initialization step, `start()` returning the awaitable to wait on, and retries it with
+    backoff if it fails. Records the outcome and duration for /readyz; returns None if every attempt failed.
+    """
+    for attempt in range(1, INIT_ATTEMPTS + 1):
+        started = time.perf_counter()
+        try:
+            result = await start()
+        except Exception as e:
+            component_status[name] = {"ready": False, "error": str(e), "attempts": attempt}
+            print(f"\n🚨 Failed to initialize {name} (attempt {attempt}/{INIT_ATTEMPTS}): {e}")
+            if attempt < INIT_ATTEMPTS:
+                await asyncio.sleep(INIT_BACKOFF_SECONDS * 2 ** (attempt - 1))
+            continue
+        component_status[name] = {"ready": True, "error": None, "seconds": round(time.perf_counter() - started, 3)}
+        return result
+    return None
+
+async def _initialize_ai():
     google_api_key, _ = dream_image.get_api_keys()
-    dream_image.llm = dream_image.setup_llm(google_api_key)
-    kb_retriever = dream_image.load_or_create_knowledge_base(
-        file_path="DreamDictionary.txt",
-        index_path="dream_dictionary_index.faiss",
-        api_key=google_api_key
+    llm, kb_retriever = await asyncio.gather(
+        _init_component("llm", lambda: asyncio.to_thread(dream_image.setup_llm, google_api_key, probe=LLM_STARTUP_PROBE)),
+        _init_component("knowledge_base", lambda: asyncio.to_thread(
+            dream_image.load_or_create_knowledge_base,
+            file_path="DreamDictionary.txt",
+            index_path="dream_dictionary_index.faiss",
+            api_key=google_api_key
+        ))
     )
-    dream_image.interpretation_chain, dream_image.therapy_chain, dream_image.visual_prompt_chain = dream_image.create_chains(dream_image.llm, kb_retriever)
-    db_utils.create_tables()
-    print("AI Agent and Database initialized.")
+    if llm is None or kb_retriever is None:
+        component_status["chains"]["error"] = "Waiting on a component that failed to initialize."
+        return
+
+    dream_image.llm = llm
+    chains = await _init_component("chains", lambda: asyncio.to_thread(dream_image.create_chains, llm, kb_retriever))
+    if chains:
+        dream_image.interpretation_chain, dream_image.therapy_chain, dream_image.visual_prompt_chain, dream_image.summary_chain = chains
+        ai_ready.set()
+        print("AI Agent initialized.")
+
+@app.on_event("startup")
+async def startup_event():
+    global ai_init_task, image_migration_task, maintenance_task
+    await _init_component("database", lambda: db_utils.run_async(db_utils.migrate))
+    ai_init_task = asyncio.create_task(_initialize_ai())
+    await image_jobs.start_workers(ai_ready)
+    image_migration_task = asyncio.create_task(_migrate_inline_images())
+    if maintenance.MAINTENANCE_ENABLED:
+        maintenance_task = asyncio.create_task(maintenance.run_periodically())
+    print("Database initialized; serving requests.")
+
+async def _migrate_inline_images():
+    try:
+        migrated_images = await db_utils.run_async(image_store.migrate_inline_images)
+    except Exception as e:
+        # Rows that were not moved keep their inline data and are retried at the next startup
+        print(f"🚨 Moving inline images to the image store failed: {e}")
+        return
+    if migrated_images:
+        print(f"Moved {migrated_images} inline images to the image store.")
+
+async def require_ai_ready():
+    """Rejects AI routes with 503 until the chains are warm, instead of failing mid-request."""
+    if not ai_ready.is_set():
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="The dream interpreter is still starting up. Please try again in a moment.",
+            headers={"Retry-After": "5"}
+        )
+
+async def require_llm_capacity():
+    """Turns new AI requests away with 503 while the LLM queue is full, rather than letting them time out in it."""
+    if upstream.gemini.is_saturated():
+        rejection = upstream.gemini.reject()
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=LLM_BUSY_MESSAGE,
+            headers={"Retry-After": str(rejection.retry_after)}
+        )
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    if ai_init_task and not ai_init_task.done():
+        ai_init_task.cancel()
+    if image_migration_task and not image_migration_task.done():
+        image_migration_task.cancel()
+    if maintenance_task:
+        maintenance_task.cancel()
+    await image_jobs.stop_workers()
+    await dream_image.close_http_client()
+    db_utils.DB_EXECUTOR.shutdown(wait=True)
+    passwords.shutdown()
+    image_variants.shutdown()
+    db_utils.close_connections()
 
 # --- Pydantic Models for API ---
 class DreamInput(BaseModel):
@@ -42,7 +198,7 @@ class DreamInput(BaseModel):
 
 class TherapyInput(BaseModel):
     question: str
-    history: str
+    history: str = "" # Ignored; the server keeps its own conversation memory
     session_id: int
 
 class TherapyStartInput(BaseModel):
@@ -54,39 +210,68 @@ def parse_datetime(date_string):
         return datetime.fromisoformat(date_string)
     return date_string
 
-def markdown_to_html(text):
-    if not text: return ""
-    text = re.sub(r'\*\*(.*?)\*\*', r'<strong>\1</strong>', text)
-    text = re.sub(r'^\* (.*)', r'<li>\1</li>', text, flags=re.MULTILINE)
-    text = re.sub(r'((\r\n|\n)?<li>.*</li>)+', r'<ul>\g<0></ul>', text, flags=re.DOTALL)
-    return text.replace('\n', '<br>')
-
 def process_messages_for_template(messages):
+    """Swaps each message's text for its stored HTML; returns the messages and the (id, html) of any re-rendered."""
     processed = []
+    rerendered = []
     for msg in messages:
         msg_dict = dict(msg)
-        msg_dict['text'] = markdown_to_html(msg_dict.get('text'))
+        msg_dict['text'] = rendering.message_html(msg_dict)
+        if rendering.is_stale(msg):
+            rerendered.append((msg_dict['id'], msg_dict['text']))
         processed.append(msg_dict)
-    return processed
-
-def _get_enriched_sessions(user_id: int):
-    """Fetches and processes all chat sessions for a user."""
-    chat_sessions = db_utils.get_user_chat_sessions(user_id)
-    enriched_sessions = []
-    ist_timezone = pytz.timezone("Asia/Kolkata")
-    
-    for session in chat_sessions:
-        parsed_date_utc = parse_datetime(session['created_at'])
-        if parsed_date_utc.tzinfo is None:
-            parsed_date_utc = pytz.utc.localize(parsed_date_utc)
-        
-        parsed_date_ist = parsed_date_utc.astimezone(ist_timezone)
-        
-        enriched_sessions.append({
-            "id": session['id'], 
-            "created_at": parsed_date_ist
-        })
-    return enriched_sessions
+    return processed, rerendered
+
+def _enrich_session(session):
+    """Converts a session row's UTC timestamp to IST for display."""
+    parsed_date_utc = parse_datetime(session['created_at'])
+    if parsed_date_utc.tzinfo is None:
+        parsed_date_utc = pytz.utc.localize(parsed_date_utc)
+    return {
+        "id": session['id'],
+        "title": session['title'],
+        "created_at": parsed_date_utc.astimezone(IST_TIMEZONE)
+    }
+
+def _encode_cursor(sort_value, row_id):
+    """Encodes the keyset (sort column, id) of a page's last row as an opaque cursor."""
+    return base64.urlsafe_b64encode(json.dumps([sort_value, row_id]).encode()).decode()
+
+def _decode_cursor(cursor: str):
+    try:
+        sort_value, row_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return str(sort_value), int(row_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+async def _get_enriched_sessions(user_id: int, cursor: str = None, limit: int = SESSION_PAGE_SIZE):
+    """Fetches one page of a user's chat sessions; returns the sessions and the cursor of the next page (or None)."""
+    before = _decode_cursor(cursor) if cursor else None
+    # One extra row tells us whether another page follows
+    chat_sessions = await db_utils.run_async(db_utils.get_user_chat_sessions_page, user_id, limit + 1, before)
+    next_cursor = None
+    if len(chat_sessions) > limit:
+        next_cursor = _encode_cursor(chat_sessions[limit - 1]['created_at'], chat_sessions[limit - 1]['id'])
+    return [_enrich_session(session) for session in chat_sessions[:limit]], next_cursor
+
+async def _get_message_page(session_id: int, cursor: str = None, limit: int = MESSAGE_PAGE_SIZE):
+    """
+    Fetches the newest page of a session's messages older than `cursor`, rendered for display and in
+    chronological order; returns the messages and the cursor of the next older page (or None).
+    """
+    before = _decode_cursor(cursor) if cursor else None
+    messages = await db_utils.run_async(db_utils.get_messages_page, session_id, limit + 1, before)
+    next_cursor = None
+    if len(messages) > limit:
+        next_cursor = _encode_cursor(messages[limit - 1]['timestamp'], messages[limit - 1]['id'])
+    processed_messages, rerendered = process_messages_for_template(reversed(messages[:limit]))
+    if rerendered:
+        # Written before rendering was stored, or by an older renderer; save the HTML so this happens once
+        await db_utils.run_async(db_utils.set_messages_html, rerendered)
+    pending_jobs = await db_utils.run_async(db_utils.get_pending_image_jobs_for_session, session_id)
+    for msg in processed_messages:
+        msg['job_id'] = pending_jobs.get(msg['id'])
+    return processed_messages, next_cursor
 
 # --- JWT Token and User Authentication ---
 def create_access_token(data: dict):
@@ -115,11 +300,12 @@ async def read_root(request: Request, current_user: dict = Depends(get_current_u
         return RedirectResponse(url="/login", status_code=status.HTTP_302_FOUND)
     
     user_id = current_user["id"]
-    enriched_sessions = _get_enriched_sessions(user_id)
+    enriched_sessions, next_cursor = await _get_enriched_sessions(user_id)
 
     return templates.TemplateResponse("home.html", {
         "request": request, 
         "chat_sessions": enriched_sessions, 
+        "next_sessions_cursor": next_cursor,
         "selected_session": None, 
         "selected_session_messages": None, 
         "session_state": "initial_dream"
@@ -131,30 +317,23 @@ async def read_chat_session(request: Request, session_id: int, current_user: dic
         return RedirectResponse(url="/login", status_code=status.HTTP_302_FOUND)
         
     user_id = current_user["id"]
-    if not db_utils.is_user_session(user_id, session_id):
+    selected_session = await db_utils.run_async(db_utils.get_chat_session, user_id, session_id)
+    if not selected_session:
         raise HTTPException(status_code=403, detail="Forbidden: You do not have access to this chat session.")
 
-    enriched_sessions = _get_enriched_sessions(user_id)
-    selected_session_messages = db_utils.get_messages_for_session(session_id)
-    
-    session_state = "session_ended" # Default to a safe state
-    if selected_session_messages:
-        last_bot_message = next((msg for msg in reversed(selected_session_messages) if msg['sender'] == 'bot' and msg['text']), None)
-        if last_bot_message:
-            last_message_text = last_bot_message['text']
-            if "Would you like to ask some follow-up questions" in last_message_text:
-                session_state = "awaiting_therapy_start"
-            elif "Great. What is your first question?" in last_message_text or "Sorry, an error occurred" not in last_message_text:
-                 session_state = "in_therapy_session"
-    
-    selected_session = next((s for s in enriched_sessions if s['id'] == session_id), None)
-    processed_selected_messages = process_messages_for_template(selected_session_messages)
+    session_state = selected_session['state'] # Kept up to date by the write paths
+    selected_session = _enrich_session(selected_session)
+    enriched_sessions, next_cursor = await _get_enriched_sessions(user_id)
+    # Only the newest page is rendered; chat.js fetches older ones from /api/sessions/{id}/messages on scroll
+    selected_session_messages, next_messages_cursor = await _get_message_page(session_id)
 
     return templates.TemplateResponse("home.html", {
         "request": request, 
         "chat_sessions": enriched_sessions, 
+        "next_sessions_cursor": next_cursor,
         "selected_session": selected_session, 
-        "selected_session_messages": processed_selected_messages,
+        "selected_session_messages": selected_session_messages,
+        "next_messages_cursor": next_messages_cursor,
         "session_state": session_state
     })
 
@@ -164,8 +343,12 @@ async def login_page(request: Request, message: str = None):
 
 @app.post("/login")
 async def login_user(request: Request, email: str = Form(...), password: str = Form(...)):
-    user = db_utils.check_user(email, password)
-    if user:
+    user = await db_utils.run_async(db_utils.get_user_by_email, email)
+    if user and await passwords.verify_password(password, user['password_hash']):
+        if passwords.needs_rehash(user['password_hash']):
+            # The cost factor changed since this hash was made; upgrade it while we have the password
+            new_hash = await passwords.hash_password(password)
+            await db_utils.run_async(db_utils.set_password_hash, user['id'], new_hash)
         access_token = create_access_token(data={"sub": user["email"], "id": user["id"]})
         response = RedirectResponse(url="/", status_code=status.HTTP_303_SEE_OTHER)
         response.set_cookie(key="access_token", value=access_token, httponly=True)
@@ -179,7 +362,8 @@ async def register_page(request: Request):
 
 @app.post("/register")
 async def register_user(request: Request, email: str = Form(...), password: str = Form(...)):
-    new_user_id = db_utils.add_user(email, password)
+    password_hash = await passwords.hash_password(password)
+    new_user_id = await db_utils.run_async(db_utils.add_user, email, password_hash)
     if new_user_id:
         return RedirectResponse(url=f"/demographics?user_id={new_user_id}", status_code=status.HTTP_303_SEE_OTHER)
     else:
@@ -198,7 +382,7 @@ async def submit_demographics(
     country: str = Form(...),
     life_stage: str = Form(...)
 ):
-    db_utils.add_demographics(user_id, age_range, gender, country, life_stage)
+    await db_utils.run_async(db_utils.add_demographics, user_id, age_range, gender, country, life_stage)
     return RedirectResponse(url="/login?message=Registration+complete.+Please+log+in.", status_code=status.HTTP_303_SEE_OTHER)
 
 @app.get("/logout")
@@ -213,55 +397,320 @@ async def delete_chat(session_id: int, current_user: dict = Depends(get_current_
         raise HTTPException(status_code=401, detail="Not authenticated")
     
     user_id = current_user["id"]
-    if not db_utils.is_user_session(user_id, session_id):
+    if not await db_utils.run_async(db_utils.is_user_session, user_id, session_id):
         raise HTTPException(status_code=403, detail="Forbidden")
         
-    db_utils.delete_chat_session(session_id)
+    await db_utils.run_async(db_utils.delete_chat_session, session_id)
+    _forget_session_submissions(session_id)
     return RedirectResponse(url="/", status_code=status.HTTP_303_SEE_OTHER)
 
 # --- API Routes for Chat Logic ---
-@app.post("/submit_message")
-async def submit_message(dream_input: DreamInput, current_user: dict = Depends(get_current_user)):
+async def _get_demographics_str(user_id: int):
+    """Formats a user's demographics for the interpretation prompt."""
+    demographics_dict = await db_utils.run_async(db_utils.get_user_demographics, user_id)
+    if demographics_dict:
+        return (
+            f"Age Range: {demographics_dict.get('age_range', 'N/A')}, "
+            f"Gender: {demographics_dict.get('gender', 'N/A')}, "
+            f"Country/Cultural Background: {demographics_dict.get('country', 'N/A')}, "
+            f"Life Stage: {demographics_dict.get('life_stage', 'N/A')}"
+        )
+    return "No demographic information provided."
+
+async def _find_cached_interpretation(dream_text: str, demographics_str: str):
+    """
+    Looks the dream up in the semantic cache. Returns the dream's embedding (needed to cache
+    a fresh result) and the cached interpretation and visual prompt, or None on a miss.
+    """
+    if not semantic_cache.ENABLED:
+        return None, None
+    try:
+        with metrics.timer("semantic_cache_lookup"):
+            dream_vector = await dream_image.embeddings.aembed_query(dream_text)
+    except Exception as e:
+        print(f"Semantic cache lookup skipped: {e}")
+        return None, None
+
+    entry = semantic_cache.cache.lookup(dream_vector, demographics_str)
+    if not entry:
+        return dream_vector, None
+    # The visual prompt lives on the original image job, once that job has produced it
+    source_job = await db_utils.run_async(db_utils.get_image_job, entry['job_id'])
+    visual_prompt = source_job['visual_prompt'] if source_job else None
+    return dream_vector, {"interpretation": entry['interpretation'], "visual_prompt": visual_prompt}
+
+def _remember_interpretation(dream_vector, demographics_str: str, interpretation: str, job_id: int, compute_seconds: float):
+    """Adds a freshly computed interpretation to the semantic cache."""
+    if dream_vector is not None:
+        semantic_cache.cache.put(dream_vector, demographics_str, interpretation, job_id, compute_seconds)
+
+async def _store_interpretation(session_id: int, interpretation: str, visual_prompt: str = None):
+    """Persists a finished interpretation and queues its image; returns the image job id."""
+    # The image is generated in the background into a placeholder message written alongside the text
+    job_id = await db_utils.run_async(db_utils.store_interpretation, session_id, interpretation, FOLLOW_UP_PROMPT, visual_prompt)
+    image_jobs.enqueue(job_id)
+    return job_id
+
+async def _get_therapy_history(session_id: int):
+    """Builds the token-budgeted history (running summary plus recent turns) the therapy chain sees."""
+    with metrics.timer("conversation_memory"):
+        return await conversation_memory.build_history(session_id, dream_image.summarize_conversation)
+
+def _sse_event(payload: dict):
+    """Encodes one server-sent event."""
+    return f"data: {json.dumps(payload)}\n\n"
+
+class SubmissionFailed(Exception):
+    """A dream submission failed after its session was created; the message has been recorded in that session."""
+
+    def __init__(self, message, session_id):
+        super().__init__(message)
+        self.session_id = session_id
+
+def _normalize_dream_text(dream_text: str):
+    """Folds the whitespace and case differences that don't make a resubmission a different dream."""
+    return " ".join(dream_text.split()).casefold()
+
+def _submission_keys(user_id: int, dream_text: str, idempotency_key: str = None):
+    """Keys a submission by user and normalized dream text and, when the client sent one, by its Idempotency-Key."""
+    keys = [("text", user_id, _normalize_dream_text(dream_text))]
+    if idempotency_key:
+        keys.append(("idempotency_key", user_id, idempotency_key))
+    return keys
+
+async def _run_submission(flight, user_id: int, dream_text: str, stream: bool):
+    """
+    Runs one dream submission end to end: creates the session, interprets the dream (publishing
+    chunks to the flight as they stream in) and queues its image. Returns the session and job ids.
+    """
+    session_id = await db_utils.run_async(db_utils.start_chat_session, user_id, dream_text)
+    try:
+        demographics_str = await _get_demographics_str(user_id)
+        dream_vector, cached = await _find_cached_interpretation(dream_text, demographics_str)
+        if cached:
+            flight.publish(cached['interpretation'])
+            job_id = await _store_interpretation(session_id, cached['interpretation'], cached['visual_prompt'])
+            return {"session_id": session_id, "job_id": job_id}
+
+        started = time.perf_counter()
+        inputs = {"dream_text": dream_text, "demographics": demographics_str}
+        with metrics.timer("interpretation"):
+            if stream:
+                async with upstream.gemini.slot():
+                    async for chunk in dream_image.interpretation_chain.astream(inputs):
+                        flight.publish(chunk)
+            else:
+                flight.publish(await upstream.gemini.call(dream_image.interpretation_chain.ainvoke, inputs))
+        interpretation = "".join(flight.chunks)
+        compute_seconds = time.perf_counter() - started
+        job_id = await _store_interpretation(session_id, interpretation)
+        _remember_interpretation(dream_vector, demographics_str, interpretation, job_id, compute_seconds)
+        return {"session_id": session_id, "job_id": job_id}
+    except upstream.UpstreamOverloaded:
+        # Nothing was interpreted, so the session is dropped and the client is told to retry later
+        await db_utils.run_async(db_utils.delete_chat_session, session_id)
+        raise
+    except Exception as e:
+        error_message = f"Sorry, an error occurred during AI processing: {e}"
+        await db_utils.run_async(db_utils.add_message_to_session, session_id, 'bot', text=error_message, state=db_utils.SESSION_ENDED)
+        raise SubmissionFailed(error_message, session_id) from e
+
+def _forget_session_submissions(session_id: int):
+    """Stops new requests from being coalesced into submissions that created a now-deleted session."""
+    submissions.forget(lambda flight: flight.result is not None and flight.result["session_id"] == session_id)
+
+async def _join_submission(user_id: int, dream_text: str, idempotency_key: str, stream: bool):
+    """
+    Attaches the request to the matching in-flight or recent submission, or starts a new one.
+    Double-clicks, retries after a timeout and identical resubmissions share one session, one
+    LLM call and one image instead of each paying for their own.
+    """
+    keys = _submission_keys(user_id, dream_text, idempotency_key)
+    finished = submissions.find(keys)
+    if finished is not None and finished.result is not None:
+        # Its session may have been deleted since (e.g. by retention maintenance), and a new one is needed
+        if not await db_utils.run_async(db_utils.is_user_session, user_id, finished.result["session_id"]):
+            _forget_session_submissions(finished.result["session_id"])
+    try:
+        flight, joined = submissions.join(
+            keys, lambda flight: _run_submission(flight, user_id, dream_text, stream), payload=_normalize_dream_text(dream_text)
+        )
+    except singleflight.KeyReused:
+        submission_requests.inc(outcome="rejected")
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="This Idempotency-Key was already used for a different dream.")
+    submission_requests.inc(outcome="coalesced" if joined else "started")
+    return flight, joined
+
+@app.post("/submit_message", dependencies=[Depends(require_ai_ready), Depends(require_llm_capacity)])
+async def submit_message(dream_input: DreamInput, idempotency_key: str = Header(None), current_user: dict = Depends(get_current_user)):
     if not current_user:
         raise HTTPException(status_code=401, detail="Not authenticated")
 
-    user_id = current_user["id"]
-    session_id = db_utils.create_chat_session(user_id)
-    db_utils.add_message_to_session(session_id, 'user', text=dream_input.dream_text)
-    
+    flight, joined = await _join_submission(current_user["id"], dream_input.dream_text, idempotency_key, stream=False)
     try:
-        demographics_dict = db_utils.get_user_demographics(user_id)
-        if demographics_dict:
-            demographics_str = (
-                f"Age Range: {demographics_dict.get('age_range', 'N/A')}, "
-                f"Gender: {demographics_dict.get('gender', 'N/A')}, "
-                f"Country/Cultural Background: {demographics_dict.get('country', 'N/A')}, "
-                f"Life Stage: {demographics_dict.get('life_stage', 'N/A')}"
-            )
-        else:
-            demographics_str = "No demographic information provided."
-
-        interpretation = dream_image.interpretation_chain.invoke({
-            "dream_text": dream_input.dream_text,
-            "demographics": demographics_str
+        result = await flight.wait()
+    except upstream.UpstreamOverloaded as e:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=LLM_BUSY_MESSAGE,
+            headers={"Retry-After": str(e.retry_after)}
+        )
+    except SubmissionFailed as e:
+        return JSONResponse(status_code=500, content={"error": str(e), "session_id": e.session_id})
+    return {**result, "coalesced": joined}
+
+@app.post("/submit_message/stream", dependencies=[Depends(require_ai_ready), Depends(require_llm_capacity)])
+async def submit_message_stream(dream_input: DreamInput, idempotency_key: str = Header(None), current_user: dict = Depends(get_current_user)):
+    """Streams the interpretation as server-sent events while the LLM writes it."""
+    if not current_user:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+
+    flight, joined = await _join_submission(current_user["id"], dream_input.dream_text, idempotency_key, stream=True)
+
+    async def event_stream():
+        # The submission runs in its own task, so a client that disconnects doesn't cancel it and can reattach on retry
+        started = time.perf_counter()
+        time_to_first_token = None
+        async for chunk in flight.follow():
+            if time_to_first_token is None:
+                time_to_first_token = time.perf_counter() - started
+            yield _sse_event({"type": "token", "text": chunk})
+        try:
+            result = await flight.wait()
+        except upstream.UpstreamOverloaded as e:
+            # The 200 status has already been sent, so the back-off travels in the event instead of a Retry-After header
+            yield _sse_event({"type": "error", "error": LLM_BUSY_MESSAGE, "retry_after": e.retry_after})
+            return
+        except SubmissionFailed as e:
+            yield _sse_event({"type": "error", "error": str(e), "session_id": e.session_id})
+            return
+        yield _sse_event({
+            "type": "done",
+            **result,
+            "coalesced": joined,
+            "ttft_ms": round((time_to_first_token or 0) * 1000)
         })
-        
-        visual_prompt = dream_image.visual_prompt_chain.invoke({"interpretation": interpretation})
-        image_url = dream_image.generate_dream_image_data(visual_prompt)
-        
-        if not image_url:
-            image_url = f"https://placehold.co/512x512/000000/bbff00?text=Image+Gen+Failed"
 
-        db_utils.add_message_to_session(session_id, 'bot', image_data=image_url)
-        db_utils.add_message_to_session(session_id, 'bot', text=interpretation)
-        follow_up_prompt = "Would you like to ask some follow-up questions about this interpretation?"
-        db_utils.add_message_to_session(session_id, 'bot', text=follow_up_prompt)
-        
-        return {"session_id": session_id}
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+@app.get("/api/sessions")
+async def list_sessions(cursor: str = None, limit: int = SESSION_PAGE_SIZE, current_user: dict = Depends(get_current_user)):
+    """Returns the next page of the sidebar's sessions, newest first."""
+    if not current_user:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+
+    sessions, next_cursor = await _get_enriched_sessions(current_user["id"], cursor, max(1, min(limit, MAX_PAGE_SIZE)))
+    return {
+        "sessions": [
+            {
+                "id": session['id'],
+                "title": session['title'],
+                "created_at": session['created_at'].isoformat(),
+                "display_time": session['created_at'].strftime('%d %b, %I:%M %p')
+            }
+            for session in sessions
+        ],
+        "next_cursor": next_cursor
+    }
+
+@app.get("/api/sessions/{session_id}/messages")
+async def list_messages(session_id: int, cursor: str = None, limit: int = MESSAGE_PAGE_SIZE, current_user: dict = Depends(get_current_user)):
+    """Returns the page of a session's messages just older than `cursor` (the newest page without one)."""
+    if not current_user:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    if not await db_utils.run_async(db_utils.is_user_session, current_user["id"], session_id):
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+    messages, next_cursor = await _get_message_page(session_id, cursor, max(1, min(limit, MAX_PAGE_SIZE)))
+    return {
+        "messages": [
+            {
+                "id": msg['id'],
+                "sender": msg['sender'],
+                "html": msg['text'],
+                "image_url": msg['image_data'],
+                "job_id": msg['job_id']
+            }
+            for msg in messages
+        ],
+        "next_cursor": next_cursor
+    }
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics():
+    """Exposes stage, database, HTTP and upstream metrics in the Prometheus text format."""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/healthz")
+async def healthz():
+    """Liveness: the process is up and serving, and hasn't given up on initializing the AI components."""
+    if ai_init_task and ai_init_task.done() and not ai_ready.is_set():
+        return JSONResponse(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            content={"status": "failed", "components": component_status}
+        )
+    return {"status": "ok"}
+
+@app.get("/readyz")
+async def readyz():
+    """Readiness: 200 once the database and every AI component are warm, 503 with per-component detail until then."""
+    ready = all(component["ready"] for component in component_status.values())
+    return JSONResponse(
+        status_code=status.HTTP_200_OK if ready else status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"ready": ready, "components": component_status}
+    )
+
+@app.get("/stats")
+async def cache_stats():
+    """Reports cache effectiveness (embedding cache hits, semantic cache hit rate and time saved), coalesced submissions and upstream queueing."""
+    return {
+        "embedding_cache": await asyncio.to_thread(dream_image.embeddings.stats) if dream_image.embeddings else None,
+        "semantic_cache": semantic_cache.cache.stats(),
+        "submissions": submissions.stats(),
+        "upstream": upstream.stats(),
+        # Per worker: with several workers, each request is answered by whichever one accepted it
+        "process": {"pid": os.getpid(), "rss_bytes": metrics.resident_memory_bytes()},
+    }
+
+@app.get("/images/{image_hash}")
+async def get_image(request: Request, image_hash: str, size: str = None, current_user: dict = Depends(get_current_user)):
+    """Serves a stored image: the original PNG, or with ?size=thumb|full a WebP variant encoded on first request."""
+    if not current_user:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    if size is not None and size not in image_variants.VARIANTS:
+        raise HTTPException(status_code=400, detail="Unknown image size")
+
+    path = image_store.image_path(image_hash) if image_store.is_valid_hash(image_hash) else None
+    if not path or not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="Image not found")
+
+    # Content-addressed images never change, so the hash (plus the variant) is a perfect ETag
+    etag = f'"{image_hash}-{size}"' if size else f'"{image_hash}"'
+    headers = {"ETag": etag, "Cache-Control": "private, max-age=31536000, immutable"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    if not size:
+        return FileResponse(path, media_type=image_store.IMAGE_MEDIA_TYPE, headers=headers)
+
+    try:
+        variant_path = await image_variants.get_variant(image_hash, size)
     except Exception as e:
-        error_message = f"Sorry, an error occurred during AI processing: {e}"
-        db_utils.add_message_to_session(session_id, 'bot', text=error_message)
-        return JSONResponse(status_code=500, content={"error": error_message, "session_id": session_id})
+        # Fall back to the original, uncached, so the variant is retried on the next request
+        print(f"🚨 Could not encode the {size} variant of image {image_hash}: {e}")
+        return FileResponse(path, media_type=image_store.IMAGE_MEDIA_TYPE)
+    return FileResponse(variant_path, media_type=image_variants.VARIANT_MEDIA_TYPE, headers=headers)
+
+@app.get("/image_jobs/{job_id}")
+async def image_job_status(job_id: int, current_user: dict = Depends(get_current_user)):
+    if not current_user:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+
+    job = await db_utils.run_async(db_utils.get_image_job, job_id)
+    if not job or not await db_utils.run_async(db_utils.is_user_session, current_user["id"], job['session_id']):
+        raise HTTPException(status_code=404, detail="Image job not found")
+
+    image_url = job['image_data'] if job['status'] in ('done', 'failed') else None
+    return {"job_id": job_id, "status": job['status'], "image_url": image_url}
 
 @app.post("/start_therapy")
 async def start_therapy(therapy_start_input: TherapyStartInput, current_user: dict = Depends(get_current_user)):
@@ -270,39 +719,115 @@ async def start_therapy(therapy_start_input: TherapyStartInput, current_user: di
     
     session_id = therapy_start_input.session_id
     user_id = current_user["id"]
-    if not db_utils.is_user_session(user_id, session_id):
+    if not await db_utils.run_async(db_utils.is_user_session, user_id, session_id):
         raise HTTPException(status_code=403, detail="Forbidden")
 
-    db_utils.add_message_to_session(session_id, 'user', text="Yes")
-    
     bot_response_text = "Great. What is your first question?"
-    bot_message = db_utils.add_message_to_session(session_id, 'bot', text=bot_response_text)
-    return {"bot_message": {"text": markdown_to_html(bot_message['text']), "sender": "bot"}}
+    _, bot_message = await db_utils.run_async(
+        db_utils.add_messages_to_session, session_id, [('user', "Yes"), ('bot', bot_response_text)], db_utils.IN_THERAPY_SESSION
+    )
+    return {"bot_message": {"text": rendering.message_html(bot_message), "sender": "bot"}}
 
-@app.post("/therapy")
+@app.post("/therapy", dependencies=[Depends(require_ai_ready), Depends(require_llm_capacity)])
 async def therapy_follow_up(therapy_input: TherapyInput, current_user: dict = Depends(get_current_user)):
     if not current_user:
         raise HTTPException(status_code=401, detail="Not authenticated")
         
     session_id = therapy_input.session_id
     user_id = current_user["id"]
-    if not db_utils.is_user_session(user_id, session_id):
+    if not await db_utils.run_async(db_utils.is_user_session, user_id, session_id):
         raise HTTPException(status_code=403, detail="Forbidden")
 
-    db_utils.add_message_to_session(session_id, 'user', text=therapy_input.question)
+    await db_utils.run_async(db_utils.add_message_to_session, session_id, 'user', text=therapy_input.question)
 
     try:
-        messages = db_utils.get_messages_for_session(session_id)
-        history = "\n".join([f"{'User' if msg['sender'] == 'user' else 'AI'}: {msg['text']}" for msg in messages if msg.get('text')])
-
-        answer = dream_image.therapy_chain.invoke({"question": therapy_input.question, "history": history})
-        formatted_answer = markdown_to_html(answer)
-        db_utils.add_message_to_session(session_id, 'bot', text=answer)
-        return {"answer": formatted_answer}
+        history = await _get_therapy_history(session_id)
+        with metrics.timer("therapy"):
+            answer = await upstream.gemini.call(dream_image.therapy_chain.ainvoke, {"question": therapy_input.question, "history": history})
+        bot_message = await db_utils.run_async(db_utils.add_message_to_session, session_id, 'bot', text=answer, state=db_utils.IN_THERAPY_SESSION)
+        return {"answer": rendering.message_html(bot_message)}
+    except upstream.UpstreamOverloaded as e:
+        # A full queue isn't a failed session; the question stays and the client can retry
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=LLM_BUSY_MESSAGE,
+            headers={"Retry-After": str(e.retry_after)}
+        )
     except Exception as e:
         error_message = f"Sorry, an error occurred during the therapy session: {e}"
-        db_utils.add_message_to_session(session_id, 'bot', text=error_message)
+        await db_utils.run_async(db_utils.add_message_to_session, session_id, 'bot', text=error_message, state=db_utils.SESSION_ENDED)
         return JSONResponse(status_code=500, content={"error": error_message})
 
+class TherapyReplyFailed(Exception):
+    """The therapist's reply failed; the error message has been recorded in the session."""
+
+async def _run_therapy_reply(flight, session_id: int, question: str):
+    """Streams the therapist's reply into the flight and saves it once complete; returns the stored bot message."""
+    try:
+        history = await _get_therapy_history(session_id)
+        with metrics.timer("therapy"):
+            async with upstream.gemini.slot():
+                async for chunk in dream_image.therapy_chain.astream({"question": question, "history": history}):
+                    flight.publish(chunk)
+        answer = "".join(flight.chunks)
+        return await db_utils.run_async(db_utils.add_message_to_session, session_id, 'bot', text=answer, state=db_utils.IN_THERAPY_SESSION)
+    except upstream.UpstreamOverloaded:
+        raise
+    except Exception as e:
+        error_message = f"Sorry, an error occurred during the therapy session: {e}"
+        await db_utils.run_async(db_utils.add_message_to_session, session_id, 'bot', text=error_message, state=db_utils.SESSION_ENDED)
+        raise TherapyReplyFailed(error_message) from e
+
+@app.post("/therapy/stream", dependencies=[Depends(require_ai_ready), Depends(require_llm_capacity)])
+async def therapy_follow_up_stream(therapy_input: TherapyInput, current_user: dict = Depends(get_current_user)):
+    """Streams the therapist's reply as server-sent events while the LLM writes it."""
+    if not current_user:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+
+    session_id = therapy_input.session_id
+    user_id = current_user["id"]
+    if not await db_utils.run_async(db_utils.is_user_session, user_id, session_id):
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+    await db_utils.run_async(db_utils.add_message_to_session, session_id, 'user', text=therapy_input.question)
+    # The reply runs in its own task, so a client that disconnects mid-stream doesn't stop it from being saved
+    flight = singleflight.run_detached(lambda flight: _run_therapy_reply(flight, session_id, therapy_input.question))
+
+    async def event_stream():
+        started = time.perf_counter()
+        time_to_first_token = None
+        async for chunk in flight.follow():
+            if time_to_first_token is None:
+                time_to_first_token = time.perf_counter() - started
+            yield _sse_event({"type": "token", "text": chunk})
+        try:
+            bot_message = await flight.wait()
+        except upstream.UpstreamOverloaded as e:
+            yield _sse_event({"type": "error", "error": LLM_BUSY_MESSAGE, "retry_after": e.retry_after})
+            return
+        except TherapyReplyFailed as e:
+            yield _sse_event({"type": "error", "error": str(e)})
+            return
+        yield _sse_event({
+            "type": "done",
+            "html": rendering.message_html(bot_message),
+            "ttft_ms": round((time_to_first_token or 0) * 1000)
+        })
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers=SSE_HEADERS)
+
 if __name__ == "__main__":
-    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Run the OneiroMind server")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("WEB_CONCURRENCY", "1")),
+                        help="Worker processes; more than one disables auto-reload")
+    args = parser.parse_args()
+    if args.workers > 1:
+        # Workers share the database and the memory-mapped knowledge base; this tells each one
+        # to take its share of the upstream rate limits. Submission coalescing and the semantic
+        # cache stay per worker, so they only catch duplicates that reach the same process
+        os.environ["WEB_CONCURRENCY"] = str(args.workers)
+        uvicorn.run("main:app", host=args.host, port=args.port, workers=args.workers)
+    else:
+        uvicorn.run("main:app", host=args.host, port=args.port, reload=True)
\ No newline at end of file
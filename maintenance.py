@@ -0,0 +1,286 @@
+"""
+Retention, archival and space reclamation for oneiromind.db and the image store.
+
+Deleting rows never shrinks an SQLite file: the pages go on a free list and the file stays as
+large as it ever was. A maintenance pass therefore
+  1. archives sessions idle for longer than the retention period to gzipped JSON Lines files
+     (one session with its messages per line) and deletes them in batches,
+  2. removes image files no message refers to any more, and
+  3. hands the free pages back to the filesystem with PRAGMA incremental_vacuum, a few hundred
+     pages per transaction, so the live server's writers are only ever held up for milliseconds.
+
+Usage:
+    python maintenance.py status
+    python maintenance.py run [--retention-days N] [--dry-run]
+    python maintenance.py vacuum [--enable]
+
+The pass can also run inside the server every MAINTENANCE_INTERVAL_HOURS (MAINTENANCE_ENABLED=true).
+"""
+import os
+import json
+import gzip
+import time
+import fcntl
+import shutil
+import asyncio
+import argparse
+from datetime import datetime, timedelta, timezone
+
+import db_utils
+import image_store
+import metrics
+
+# --- Maintenance Settings (overridable through the environment) ---
+MAINTENANCE_ENABLED = os.environ.get("MAINTENANCE_ENABLED", "false").lower() in ("1", "true", "yes")
+MAINTENANCE_INTERVAL_HOURS = float(os.environ.get("MAINTENANCE_INTERVAL_HOURS", "24"))
+SESSION_RETENTION_DAYS = int(os.environ.get("SESSION_RETENTION_DAYS", "0"))  # Archive sessions idle this long; 0 keeps them forever
+ARCHIVE_DIR = os.environ.get("ARCHIVE_DIR", "archives")
+ARCHIVE_BATCH_SIZE = int(os.environ.get("ARCHIVE_BATCH_SIZE", "100"))        # Sessions exported and deleted per transaction
+ORPHAN_IMAGE_GRACE_HOURS = float(os.environ.get("ORPHAN_IMAGE_GRACE_HOURS", "24"))  # Covers images saved by jobs that haven't committed yet
+VACUUM_STEP_PAGES = int(os.environ.get("VACUUM_STEP_PAGES", "256"))          # Pages freed per write transaction (1 MB at 4 KB pages)
+VACUUM_STEP_PAUSE = float(os.environ.get("VACUUM_STEP_PAUSE", "0.05"))       # Seconds between steps, leaving the write lock to the server
+
+LOCK_NAME = ".maintenance.lock"
+
+def _database_bytes():
+    """Size of the database on disk, including its write-ahead log."""
+    return sum(
+        os.path.getsize(path)
+        for path in (db_utils.DATABASE_NAME, f"{db_utils.DATABASE_NAME}-wal")
+        if os.path.exists(path)
+    )
+
+def _try_lock():
+    """Takes the maintenance lock without waiting, so only one worker or CLI run does a pass at a time."""
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    lock_file = open(os.path.join(ARCHIVE_DIR, LOCK_NAME), "w")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock_file.close()
+        return None
+    return lock_file
+
+# --- Archival ---
+
+def _archive_image(image_url):
+    """Keeps a copy of a session's image beside the archive: a hard link where possible, so it costs no space."""
+    image_hash = image_url[len(image_store.IMAGE_URL_PREFIX):]
+    if not image_url.startswith(image_store.IMAGE_URL_PREFIX) or not image_store.is_valid_hash(image_hash):
+        return
+    source = image_store.image_path(image_hash)
+    dest = os.path.join(ARCHIVE_DIR, "images", f"{image_hash}.png")
+    if os.path.exists(dest) or not os.path.exists(source):
+        return
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    try:
+        os.link(source, dest)
+    except OSError:
+        shutil.copy2(source, dest)
+
+def archive_batch(archive_path, inactive_before, batch_size=ARCHIVE_BATCH_SIZE):
+    """
+    Exports up to `batch_size` idle sessions to the archive file, then deletes the ones still idle.
+    The batch is flushed to disk before anything is deleted, so a crash or a session that wakes up
+    mid-batch can repeat a session in the archive but never lose one. Readers keep the last copy of
+    each session id. Returns the number of sessions archived.
+    """
+    def write(sessions):
+        for session in sessions:
+            for message in session["messages"]:
+                if message["image_data"]:
+                    _archive_image(message["image_data"])
+        # Each batch is appended as its own gzip member; gzip readers treat the members as one stream
+        with open(archive_path, "ab") as raw, gzip.GzipFile(fileobj=raw, mode="ab") as archive:
+            for session in sessions:
+                archive.write((json.dumps(session, ensure_ascii=False, default=str) + "\n").encode("utf-8"))
+            archive.flush()
+            raw.flush()
+            os.fsync(raw.fileno())
+
+    return db_utils.archive_idle_sessions(inactive_before, batch_size, write)
+
+# --- Orphaned images ---
+
+def find_orphan_images(grace_hours=ORPHAN_IMAGE_GRACE_HOURS):
+    """
+    Lists (path, bytes) for image files no message refers to: originals and their cached variants,
+    plus leftover temporary files. Files younger than the grace period are left alone.
+    """
+    if not os.path.isdir(image_store.IMAGE_DIR):
+        return []
+    referenced = {
+        url[len(image_store.IMAGE_URL_PREFIX):]
+        for url in db_utils.get_referenced_image_urls()
+        if url.startswith(image_store.IMAGE_URL_PREFIX)
+    }
+    cutoff = time.time() - grace_hours * 3600
+    orphans = []
+    for shard in os.scandir(image_store.IMAGE_DIR):
+        if not shard.is_dir():
+            continue
+        for entry in os.scandir(shard.path):
+            # Originals are {hash}.png and variants {hash}.{variant}.webp, so the hash is the first 64 characters
+            image_hash = entry.name[:64]
+            stat = entry.stat()
+            if stat.st_mtime >= cutoff:
+                continue
+            if entry.name.endswith(".tmp") or (image_store.is_valid_hash(image_hash) and image_hash not in referenced):
+                orphans.append((entry.path, stat.st_size))
+    return orphans
+
+def remove_orphan_images(orphans):
+    """Deletes the files found by find_orphan_images; returns (files removed, bytes freed)."""
+    removed = freed = 0
+    for path, size in orphans:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            continue
+        removed += 1
+        freed += size
+    return removed, freed
+
+# --- Space reclamation ---
+
+async def reclaim_free_pages(step_pages=VACUUM_STEP_PAGES, pause=VACUUM_STEP_PAUSE):
+    """
+    Gives the database's free pages back to the filesystem in small incremental_vacuum steps,
+    each its own short write transaction on the database executor. Returns (steps, pages freed).
+    """
+    stats = await db_utils.run_async(db_utils.get_storage_stats)
+    if stats["auto_vacuum"] != db_utils.AUTO_VACUUM_INCREMENTAL:
+        if stats["freelist_count"]:
+            print(
+                f"⚠️ {stats['freelist_count'] * stats['page_size']} bytes are free inside {db_utils.DATABASE_NAME}, but it predates "
+                "incremental vacuum. Stop the server and run 'python maintenance.py vacuum --enable' once."
+            )
+        return 0, 0
+    steps = pages = 0
+    while True:
+        freed = await db_utils.run_async(db_utils.incremental_vacuum, step_pages)
+        if not freed:
+            break
+        steps += 1
+        pages += freed
+        await asyncio.sleep(pause)
+    if pages and not await db_utils.run_async(db_utils.checkpoint_wal):
+        print("⚠️ WAL checkpoint was blocked by active readers; the file shrinks at the next checkpoint.")
+    return steps, pages
+
+# --- Passes ---
+
+async def run_pass(retention_days=SESSION_RETENTION_DAYS, dry_run=False):
+    """
+    Runs one maintenance pass (archive, remove orphaned images, reclaim free pages) and returns
+    a report of what it did, or would do with `dry_run`. Returns None if another pass holds the lock.
+    """
+    lock = _try_lock()
+    if lock is None:
+        print("Maintenance is already running elsewhere; skipping this pass.")
+        return None
+    try:
+        started = time.perf_counter()
+        bytes_before = _database_bytes()
+        report = {"dry_run": dry_run, "retention_days": retention_days, "sessions_archived": 0, "archive_file": None}
+
+        if retention_days > 0:
+            inactive_before = datetime.now(timezone.utc) - timedelta(days=retention_days)
+            if dry_run:
+                archivable = await db_utils.run_async(db_utils.get_archivable_session_ids, inactive_before, -1)
+                report["sessions_archived"] = len(archivable)
+            else:
+                archive_path = os.path.join(ARCHIVE_DIR, f"sessions-{datetime.now(timezone.utc):%Y%m%dT%H%M%SZ}.jsonl.gz")
+                while archived := await db_utils.run_async(archive_batch, archive_path, inactive_before):
+                    report["sessions_archived"] += archived
+                    sessions_archived.inc(archived)
+                if report["sessions_archived"]:
+                    report["archive_file"] = archive_path
+
+        orphans = await db_utils.run_async(find_orphan_images)
+        if dry_run:
+            report["images_removed"], report["image_bytes_freed"] = len(orphans), sum(size for _, size in orphans)
+        else:
+            report["images_removed"], report["image_bytes_freed"] = await asyncio.to_thread(remove_orphan_images, orphans)
+            bytes_reclaimed.inc(report["image_bytes_freed"], store="images")
+
+        stats = await db_utils.run_async(db_utils.get_storage_stats)
+        if dry_run:
+            report["vacuum_steps"] = 0
+            report["database_bytes_reclaimed"] = stats["freelist_count"] * stats["page_size"]
+        else:
+            report["vacuum_steps"], _ = await reclaim_free_pages()
+            report["database_bytes_reclaimed"] = max(bytes_before - _database_bytes(), 0)
+            bytes_reclaimed.inc(report["database_bytes_reclaimed"], store="database")
+        report["database_bytes"] = _database_bytes()
+        report["seconds"] = round(time.perf_counter() - started, 3)
+        return report
+    finally:
+        lock.close()
+
+def print_report(report):
+    verb = "Would archive" if report["dry_run"] else "Archived"
+    print(f"🗄️ {verb} {report['sessions_archived']} sessions" + (f" to '{report['archive_file']}'" if report["archive_file"] else "") + ".")
+    verb = "Would remove" if report["dry_run"] else "Removed"
+    print(f"🧹 {verb} {report['images_removed']} orphaned image files ({report['image_bytes_freed']} bytes).")
+    verb = "Reclaimable" if report["dry_run"] else f"Reclaimed in {report['vacuum_steps']} vacuum steps"
+    print(f"💾 {verb}: {report['database_bytes_reclaimed']} bytes; {db_utils.DATABASE_NAME} is now {report['database_bytes']} bytes.")
+    print(f"✅ Maintenance pass finished in {report['seconds']} s.")
+
+async def run_periodically(interval_hours=MAINTENANCE_INTERVAL_HOURS):
+    """Runs a maintenance pass every `interval_hours` until cancelled; started by the server when MAINTENANCE_ENABLED is set."""
+    while True:
+        await asyncio.sleep(interval_hours * 3600)
+        try:
+            report = await run_pass()
+            if report:
+                print_report(report)
+        except Exception as e:
+            print(f"🚨 Maintenance pass failed: {e}")
+
+def status():
+    """Prints how much space the database and image store use and how much a pass could reclaim."""
+    stats = db_utils.get_storage_stats()
+    mode = "incremental" if stats["auto_vacuum"] == db_utils.AUTO_VACUUM_INCREMENTAL else "off (run 'vacuum --enable' once)"
+    print(f"{db_utils.DATABASE_NAME}: {_database_bytes()} bytes on disk, {stats['page_count']} pages of {stats['page_size']} bytes")
+    print(f"  free pages: {stats['freelist_count']} ({stats['freelist_count'] * stats['page_size']} bytes), auto-vacuum: {mode}")
+    if SESSION_RETENTION_DAYS > 0:
+        inactive_before = datetime.now(timezone.utc) - timedelta(days=SESSION_RETENTION_DAYS)
+        print(f"  sessions idle for over {SESSION_RETENTION_DAYS} days: {len(db_utils.get_archivable_session_ids(inactive_before, -1))}")
+    else:
+        print("  session retention: off (set SESSION_RETENTION_DAYS)")
+    orphans = find_orphan_images()
+    print(f"{image_store.IMAGE_DIR}: {len(orphans)} orphaned files ({sum(size for _, size in orphans)} bytes)")
+
+# --- Metrics ---
+sessions_archived = metrics.Counter("oneiromind_maintenance_sessions_archived_total", "Chat sessions archived and deleted by maintenance.")
+bytes_reclaimed = metrics.Counter("oneiromind_maintenance_bytes_reclaimed_total", "Disk space given back by maintenance, by store.", ("store",))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="OneiroMind retention, archival and space reclamation")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("status", help="Show database and image store usage and what a pass would reclaim")
+    run_parser = subparsers.add_parser("run", help="Archive idle sessions, remove orphaned images and reclaim free pages")
+    run_parser.add_argument("--retention-days", type=int, default=SESSION_RETENTION_DAYS, help="Archive sessions idle this long (0 keeps them)")
+    run_parser.add_argument("--dry-run", action="store_true", help="Report what would be done without changing anything")
+    vacuum_parser = subparsers.add_parser("vacuum", help="Reclaim free database pages in small steps")
+    vacuum_parser.add_argument("--enable", action="store_true", help="Rewrite an existing database to enable incremental vacuum (stop the server first)")
+    args = parser.parse_args()
+
+    db_utils.migrate()
+    if args.command == "status":
+        status()
+    elif args.command == "run":
+        report = asyncio.run(run_pass(args.retention_days, args.dry_run))
+        if report:
+            print_report(report)
+    else:
+        if args.enable:
+            bytes_before = _database_bytes()
+            db_utils.enable_incremental_vacuum()
+            db_utils.checkpoint_wal()
+            print(f"✅ Incremental vacuum enabled; the rewrite reclaimed {bytes_before - _database_bytes()} bytes.")
+        else:
+            bytes_before = _database_bytes()
+            steps, pages = asyncio.run(reclaim_free_pages())
+            print(f"💾 Freed {pages} pages in {steps} steps; reclaimed {bytes_before - _database_bytes()} bytes.")
@@ -0,0 +1,174 @@
+"""
+Minimal in-process metrics with Prometheus text exposition.
+
+Counters, gauges and histograms register themselves in REGISTRY when created; `render()` turns
+them into the text format served at /metrics. `timer(stage)` times a block into the stage
+histogram and, while a request is being served, into that request's Server-Timing breakdown.
+"""
+import os
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+
+SERVER_TIMING_ENABLED = os.environ.get("METRICS_SERVER_TIMING", "false").lower() in ("1", "true", "yes")
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+REGISTRY = []
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock() # Stages can be timed from worker threads as well as the event loop
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        return tuple((name, labels[name]) for name in self.labelnames)
+
+    def _header(self):
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, help_text, labelnames=()):
+        super().__init__(name, help_text, labelnames)
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        with self._lock:
+            return self._header() + [f"{self.name}{_format_labels(key)} {_format_value(value)}" for key, value in self.values.items()]
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+class GaugeFunc(_Metric):
+    """A gauge read at scrape time from `func`, which returns (labels dict, value) pairs."""
+    kind = "gauge"
+
+    def __init__(self, name, help_text, func):
+        super().__init__(name, help_text)
+        self.func = func
+
+    def render(self):
+        return self._header() + [f"{self.name}{_format_labels(tuple(labels.items()))} {_format_value(value)}" for labels, value in self.func()]
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(buckets)
+        self.series = {} # labels -> [per-bucket counts, sum, count]
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            series = self.series.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = self._header()
+        with self._lock:
+            for key, (bucket_counts, total, count) in self.series.items():
+                for bound, bucket_count in zip(self.buckets, bucket_counts):
+                    lines.append(f"{self.name}_bucket{_format_labels(key + (('le', bound),))} {bucket_count}")
+                lines.append(f"{self.name}_bucket{_format_labels(key + (('le', '+Inf'),))} {count}")
+                lines.append(f"{self.name}_sum{_format_labels(key)} {_format_value(total)}")
+                lines.append(f"{self.name}_count{_format_labels(key)} {count}")
+        return lines
+
+def render():
+    """Returns every registered metric in the Prometheus text exposition format."""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+# --- Application Metrics ---
+stage_seconds = Histogram("oneiromind_stage_seconds", "Duration of each dream pipeline stage.", ("stage",))
+db_seconds = Histogram("oneiromind_db_call_seconds", "Duration of database calls, including the wait for a DB thread.", ("function",))
+http_request_seconds = Histogram(
+    "oneiromind_http_request_seconds", "Time until response headers, by route.", ("method", "route", "status")
+)
+http_requests_in_flight = Gauge("oneiromind_http_requests_in_flight", "Requests currently being handled.")
+upstream_errors = Counter("oneiromind_upstream_errors_total", "Failed upstream calls, by provider and whether they were retried.", ("provider", "retried"))
+
+def resident_memory_bytes():
+    """This process's resident set size in bytes, or None where /proc isn't available."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def _resident_memory_samples():
+    rss = resident_memory_bytes()
+    return [] if rss is None else [({}, rss)]
+
+GaugeFunc("process_resident_memory_bytes", "Resident memory of this worker process.", _resident_memory_samples)
+
+# --- Per-request Timing ---
+_request_timings = contextvars.ContextVar("request_timings", default=None)
+
+def start_request_timings():
+    """Begins collecting stage timings for the current request; returns the list they are appended to."""
+    timings = []
+    _request_timings.set(timings)
+    return timings
+
+def _record_request_timing(name, elapsed):
+    timings = _request_timings.get()
+    if timings is not None:
+        timings.append((name, elapsed))
+
+@contextmanager
+def timer(stage):
+    """Times the enclosed block as a pipeline stage."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        stage_seconds.observe(elapsed, stage=stage)
+        _record_request_timing(stage, elapsed)
+
+def observe_db_call(function, elapsed):
+    db_seconds.observe(elapsed, function=function)
+    _record_request_timing("db", elapsed)
+
+def server_timing_header(timings, total):
+    """Formats collected timings as a Server-Timing header, summing repeated stages (e.g. several DB calls)."""
+    totals = {}
+    for name, elapsed in timings:
+        totals[name] = totals.get(name, 0.0) + elapsed
+    entries = [f"{name};dur={elapsed * 1000:.1f}" for name, elapsed in totals.items()]
+    entries.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(entries)
@@ -0,0 +1,42 @@
+import os
+import asyncio
+import bcrypt
+
+import process_pool
+
+# --- Password Hashing Settings (overridable through the environment) ---
+BCRYPT_ROUNDS = int(os.environ.get("BCRYPT_ROUNDS", "12"))                          # Cost factor; each +1 doubles the work
+HASH_WORKERS = int(os.environ.get("PASSWORD_HASH_WORKERS", str(os.cpu_count() or 1)))
+
+# bcrypt is pure CPU work, so it runs in worker processes where it can use every core
+# without holding up the event loop or the database threads
+_pool = process_pool.LazyProcessPool()
+
+def hash_password_sync(password, rounds=BCRYPT_ROUNDS):
+    """Hashes a password with a fresh salt at the given cost factor."""
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds=rounds)).decode('utf-8')
+
+def verify_password_sync(password, password_hash):
+    """Checks a password against a stored hash."""
+    return bcrypt.checkpw(password.encode('utf-8'), password_hash.encode('utf-8'))
+
+def needs_rehash(password_hash):
+    """True if a stored hash ('$2b$<cost>$...') was made with a different cost factor than the configured one."""
+    try:
+        return int(password_hash.split("$")[2]) != BCRYPT_ROUNDS
+    except (IndexError, ValueError):
+        return True
+
+async def hash_password(password):
+    """Hashes a password in the worker pool."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_pool.get(HASH_WORKERS), hash_password_sync, password, BCRYPT_ROUNDS)
+
+async def verify_password(password, password_hash):
+    """Checks a password against a stored hash in the worker pool."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_pool.get(HASH_WORKERS), verify_password_sync, password, password_hash)
+
+def shutdown():
+    """Stops the worker processes; the pool is recreated on next use."""
+    _pool.shutdown()
@@ -0,0 +1,25 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+class LazyProcessPool:
+    """
+    A process pool for CPU-bound work that starts its workers on first use. The worker count is
+    read at that point, so a module-level setting changed before first use (or after `shutdown`)
+    takes effect.
+    """
+
+    def __init__(self):
+        self._executor = None
+
+    def get(self, max_workers):
+        """Returns the pool, starting it with `max_workers` processes if it isn't running."""
+        if self._executor is None:
+            # 'spawn' keeps workers from inheriting the server's threads and open sqlite connections
+            self._executor = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"))
+        return self._executor
+
+    def shutdown(self):
+        """Stops the worker processes; the pool is recreated on next use."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
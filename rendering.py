@@ -0,0 +1,26 @@
+import re
+
+# Bump whenever markdown_to_html's output changes; stored HTML from older versions is re-rendered on read
+RENDERER_VERSION = 1
+
+BOLD_PATTERN = re.compile(r'\*\*(.*?)\*\*')
+LIST_ITEM_PATTERN = re.compile(r'^\* (.*)', flags=re.MULTILINE)
+LIST_PATTERN = re.compile(r'((\r\n|\n)?<li>.*</li>)+', flags=re.DOTALL)
+
+def markdown_to_html(text):
+    """Renders the small subset of markdown the LLM uses (bold text and bullet lists) to HTML."""
+    if not text: return ""
+    text = BOLD_PATTERN.sub(r'<strong>\1</strong>', text)
+    text = LIST_ITEM_PATTERN.sub(r'<li>\1</li>', text)
+    text = LIST_PATTERN.sub(r'<ul>\g<0></ul>', text)
+    return text.replace('\n', '<br>')
+
+def is_stale(message):
+    """True if a stored message has no HTML from the current renderer."""
+    return bool(message.get('text')) and message.get('html_version') != RENDERER_VERSION
+
+def message_html(message):
+    """Returns a message's HTML, using the copy stored at write time unless the renderer has changed since."""
+    if is_stale(message):
+        return markdown_to_html(message['text'])
+    return message.get('text_html') or ""
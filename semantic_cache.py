@@ -0,0 +1,88 @@
+import os
+import time
+import itertools
+from collections import OrderedDict
+import numpy as np
+
+# --- Semantic Cache Settings (overridable through the environment) ---
+ENABLED = os.environ.get("SEMANTIC_CACHE_ENABLED", "false").lower() in ("1", "true", "yes")
+SIMILARITY_THRESHOLD = float(os.environ.get("SEMANTIC_CACHE_THRESHOLD", "0.95"))
+TTL_SECONDS = float(os.environ.get("SEMANTIC_CACHE_TTL_SECONDS", str(24 * 60 * 60)))
+MAX_ENTRIES = int(os.environ.get("SEMANTIC_CACHE_MAX_ENTRIES", "1000"))
+
+class SemanticCache:
+    """
+    An in-memory cache of dream interpretations keyed by dream embedding and demographics.
+
+    A lookup hits when a cached dream from a user with the same demographics has a cosine
+    similarity of at least `threshold` and is younger than `ttl_seconds`. The least
+    recently used entry is evicted once `max_entries` is exceeded. All methods are meant
+    to be called from the event loop, so no locking is needed. Each server worker process
+    has its own cache, so with several workers a dream only hits entries made by the same worker.
+    """
+
+    def __init__(self, threshold=SIMILARITY_THRESHOLD, ttl_seconds=TTL_SECONDS, max_entries=MAX_ENTRIES):
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.seconds_saved = 0.0
+        self._ids = itertools.count(1)
+
+    @staticmethod
+    def _normalize(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _expire(self):
+        cutoff = time.monotonic() - self.ttl_seconds
+        for entry_id in [entry_id for entry_id, entry in self.entries.items() if entry['created_at'] < cutoff]:
+            del self.entries[entry_id]
+
+    def lookup(self, vector, demographics):
+        """Returns the closest fresh entry for these demographics if it clears the threshold, else None."""
+        self._expire()
+        candidates = [(entry_id, entry) for entry_id, entry in self.entries.items() if entry['demographics'] == demographics]
+        if candidates:
+            similarities = np.stack([entry['vector'] for _, entry in candidates]) @ self._normalize(vector)
+            best = int(np.argmax(similarities))
+            if similarities[best] >= self.threshold:
+                entry_id, entry = candidates[best]
+                self.entries.move_to_end(entry_id)
+                self.hits += 1
+                self.seconds_saved += entry['compute_seconds']
+                return entry
+        self.misses += 1
+        return None
+
+    def put(self, vector, demographics, interpretation, job_id, compute_seconds):
+        """Caches a freshly computed interpretation along with the image job holding its visual prompt."""
+        self.entries[next(self._ids)] = {
+            "vector": self._normalize(vector),
+            "demographics": demographics,
+            "interpretation": interpretation,
+            "job_id": job_id,
+            "compute_seconds": compute_seconds,
+            "created_at": time.monotonic(),
+        }
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        """Returns hit rate and the LLM time saved by hits."""
+        lookups = self.hits + self.misses
+        return {
+            "enabled": ENABLED,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "seconds_saved": round(self.seconds_saved, 3),
+            "entries": len(self.entries),
+            "max_entries": self.max_entries,
+            "threshold": self.threshold,
+        }
+
+cache = SemanticCache()
@@ -0,0 +1,184 @@
+"""
+Read-only, memory-mapped form of the knowledge base for multi-worker deployments.
+
+FAISS.load_local unpickles the whole index and docstore into every worker process. `export`
+instead writes the vectors as a plain FAISS file, which workers map with IO_FLAG_MMAP_IFC so the
+OS page cache holds one copy shared by all of them, and the chunk texts into a SQLite file that
+each worker reads through read-only connections. Both files are written beside the index and
+swapped in with os.replace, so a rebuild never changes pages a running worker has mapped.
+"""
+import os
+import json
+import sqlite3
+import asyncio
+import threading
+import urllib.parse
+from typing import Any
+import numpy as np
+import faiss
+from pydantic import ConfigDict
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+import lexical_index
+import metrics
+
+# --- Retrieval Settings (overridable through the environment) ---
+# 'vector' (embeddings only), 'lexical' (BM25 only: no embedding call) or 'hybrid' (both, fused).
+# Stays 'vector' until hybrid results have been checked against the real embeddings (benchmarks.py retrieval --index)
+RETRIEVAL_MODE = os.environ.get("RETRIEVAL_MODE", "vector").lower()
+# In hybrid mode, answer from the keyword hits alone if the embedding call fails or takes longer than this
+HYBRID_VECTOR_TIMEOUT = float(os.environ.get("RETRIEVAL_VECTOR_TIMEOUT", "2.0"))
+CANDIDATES_PER_RETRIEVER = 20 # Hits taken from each side before fusing down to k
+RETRIEVAL_MODES = ("vector", "lexical", "hybrid")
+
+EXPORT_VERSION = 2 # Bump when the export format changes, so older exports are rebuilt at startup
+INDEX_NAME = "shared.faiss"
+CHUNKS_NAME = "chunks.db"
+SOURCE_INDEX_NAME = "index.faiss" # Written by FAISS.save_local; its mtime tells us whether the export is current
+
+def _paths(index_path):
+    return os.path.join(index_path, INDEX_NAME), os.path.join(index_path, CHUNKS_NAME)
+
+def _source_mtime(index_path):
+    return str(os.path.getmtime(os.path.join(index_path, SOURCE_INDEX_NAME)))
+
+def export(vector_store, index_path, model_name):
+    """Writes the shared index and chunk store for a FAISS vector store saved at `index_path`."""
+    index_file, chunks_file = _paths(index_path)
+    tmp_index_file = f"{index_file}.{os.getpid()}.tmp"
+    tmp_chunks_file = f"{chunks_file}.{os.getpid()}.tmp"
+    if os.path.exists(tmp_chunks_file):
+        os.remove(tmp_chunks_file)
+
+    faiss.write_index(vector_store.index, tmp_index_file)
+    conn = sqlite3.connect(tmp_chunks_file)
+    try:
+        conn.execute("CREATE TABLE chunks (position INTEGER PRIMARY KEY, docstore_id TEXT NOT NULL, text TEXT NOT NULL, metadata TEXT NOT NULL)")
+        conn.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        rows = []
+        for position, docstore_id in vector_store.index_to_docstore_id.items():
+            document = vector_store.docstore.search(docstore_id)
+            rows.append((position, docstore_id, document.page_content, json.dumps(document.metadata)))
+        conn.executemany("INSERT INTO chunks VALUES (?, ?, ?, ?)", rows)
+        lexical_index.build(conn)
+        conn.executemany("INSERT INTO meta VALUES (?, ?)", [
+            ("ntotal", str(vector_store.index.ntotal)),
+            ("embedding_model", model_name),
+            ("source_mtime", _source_mtime(index_path)),
+            ("export_version", str(EXPORT_VERSION)),
+        ])
+        conn.commit()
+    finally:
+        conn.close()
+    os.replace(tmp_chunks_file, chunks_file)
+    os.replace(tmp_index_file, index_file)
+    print(f"✅ Exported {len(rows)} chunks to the shared index in '{index_path}'.")
+
+class ChunkStore:
+    """Chunk texts by index position, read through one read-only SQLite connection per thread."""
+
+    def __init__(self, path):
+        # immutable=1 skips locking entirely; safe because the file is only ever replaced, never modified
+        self.uri = f"file:{urllib.parse.quote(os.path.abspath(path))}?mode=ro&immutable=1"
+        self._local = threading.local()
+        self.meta = dict(self._connection().execute("SELECT key, value FROM meta").fetchall())
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(self.uri, uri=True, check_same_thread=False)
+        return conn
+
+    def get(self, positions):
+        """Returns the chunks at the given index positions as Documents, in the same order."""
+        if not positions:
+            return []
+        placeholders = ",".join("?" * len(positions))
+        rows = self._connection().execute(
+            f"SELECT position, text, metadata FROM chunks WHERE position IN ({placeholders})", positions
+        ).fetchall()
+        by_position = {position: Document(page_content=text, metadata=json.loads(metadata)) for position, text, metadata in rows}
+        return [by_position[position] for position in positions if position in by_position]
+
+    def lexical_search(self, text, k):
+        """Positions of the `k` chunks that best match the text's keywords (BM25)."""
+        return lexical_index.search(self._connection(), text, k)
+
+def is_current(index_path):
+    """True if the shared export exists and was made from the index currently saved at `index_path`."""
+    index_file, chunks_file = _paths(index_path)
+    if not (os.path.exists(index_file) and os.path.exists(chunks_file)):
+        return False
+    try:
+        meta = ChunkStore(chunks_file).meta
+        return meta.get("source_mtime") == _source_mtime(index_path) and meta.get("export_version") == str(EXPORT_VERSION)
+    except (sqlite3.Error, OSError):
+        return False
+
+class SharedIndexRetriever(BaseRetriever):
+    """
+    Returns the `k` chunks for a query from the memory-mapped FAISS index, the BM25 keyword index,
+    or both merged with reciprocal rank fusion, depending on `mode`.
+    """
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    index: Any
+    chunks: Any
+    embeddings: Any
+    k: int = 5
+    mode: str = "vector"
+    vector_timeout: float = HYBRID_VECTOR_TIMEOUT
+
+    def _vector_positions(self, vector, k):
+        _, positions = self.index.search(np.asarray([vector], dtype=np.float32), k)
+        return [int(position) for position in positions[0] if position != -1]
+
+    def _lexical_positions(self, query, k):
+        with metrics.timer("retrieval_lexical"):
+            return self.chunks.lexical_search(query, k)
+
+    def _get_relevant_documents(self, query, *, run_manager):
+        if self.mode == "lexical":
+            return self.chunks.get(self._lexical_positions(query, self.k))
+        vector_positions = self._vector_positions(self.embeddings.embed_query(query), CANDIDATES_PER_RETRIEVER)
+        if self.mode == "vector":
+            return self.chunks.get(vector_positions[:self.k])
+        return self.chunks.get(lexical_index.reciprocal_rank_fusion(
+            [vector_positions, self._lexical_positions(query, CANDIDATES_PER_RETRIEVER)], self.k
+        ))
+
+    async def _avector_positions(self, query, k):
+        with metrics.timer("retrieval_vector"):
+            vector = await self.embeddings.aembed_query(query)
+            # A cold mapping can page-fault on first touch, so keep the scan off the event loop
+            return await asyncio.to_thread(self._vector_positions, vector, k)
+
+    async def _aget_relevant_documents(self, query, *, run_manager):
+        if self.mode == "lexical":
+            return await asyncio.to_thread(lambda: self.chunks.get(self._lexical_positions(query, self.k)))
+        if self.mode == "vector":
+            return self.chunks.get(await self._avector_positions(query, self.k))
+
+        lexical = asyncio.create_task(asyncio.to_thread(self._lexical_positions, query, CANDIDATES_PER_RETRIEVER))
+        try:
+            vector_positions = await asyncio.wait_for(self._avector_positions(query, CANDIDATES_PER_RETRIEVER), self.vector_timeout)
+        except Exception as e:
+            # Slow or unavailable embeddings shouldn't hold up the answer: the keyword hits still cover named symbols
+            print(f"⚠️ Vector retrieval unavailable ({type(e).__name__}: {e}); using keyword hits only.")
+            retrieval_fallbacks.inc()
+            vector_positions = []
+        return self.chunks.get(lexical_index.reciprocal_rank_fusion([vector_positions, await lexical], self.k))
+
+def load_retriever(index_path, embeddings, k=5, mode=RETRIEVAL_MODE):
+    """Maps the shared index read-only and returns a retriever over it in the given mode (see RETRIEVAL_MODE)."""
+    if mode not in RETRIEVAL_MODES:
+        raise ValueError(f"Unknown retrieval mode '{mode}'; expected one of {', '.join(RETRIEVAL_MODES)}.")
+    index_file, chunks_file = _paths(index_path)
+    index = faiss.read_index(index_file, faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY)
+    chunks = ChunkStore(chunks_file)
+    if int(chunks.meta["ntotal"]) != index.ntotal:
+        raise ValueError(f"Shared index in '{index_path}' has {index.ntotal} vectors but {chunks.meta['ntotal']} chunks; re-run build_index.py.")
+    return SharedIndexRetriever(index=index, chunks=chunks, embeddings=embeddings, k=k, mode=mode)
+
+retrieval_fallbacks = metrics.Counter("oneiromind_retrieval_fallbacks_total", "Hybrid retrievals answered from keyword hits alone.")
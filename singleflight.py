@@ -0,0 +1,153 @@
+import time
+import asyncio
+
+class Flight:
+    """
+    One computation shared by every caller that joined it. The computation publishes partial
+    output (e.g. streamed tokens) with `publish`; callers replay and follow it with `follow`,
+    or wait for the final result with `wait`.
+    """
+
+    def __init__(self, payload=None):
+        self.payload = payload
+        self.chunks = []
+        self.result = None
+        self.error = None
+        self.done = False
+        self.finished_at = None
+        self.task = None
+        self._updated = asyncio.Event()
+
+    def _notify(self):
+        # Swap in a fresh event so followers that catch up later wait for the next update
+        updated, self._updated = self._updated, asyncio.Event()
+        updated.set()
+
+    def publish(self, chunk):
+        self.chunks.append(chunk)
+        self._notify()
+
+    def finish(self, result=None, error=None):
+        self.result = result
+        self.error = error
+        self.done = True
+        self.finished_at = time.monotonic()
+        self._notify()
+
+    async def follow(self):
+        """Yields every chunk published so far, then each new one as it arrives, until the flight finishes."""
+        index = 0
+        while True:
+            while index < len(self.chunks):
+                yield self.chunks[index]
+                index += 1
+            if self.done:
+                return
+            await self._updated.wait()
+
+    async def wait(self):
+        """Returns the flight's result, raising its exception if it failed."""
+        while not self.done:
+            await self._updated.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+class KeyReused(Exception):
+    """A key is already registered to a flight for a different payload."""
+
+    def __init__(self, key):
+        super().__init__(f"{key!r} is already in use for a different request")
+        self.key = key
+
+# The event loop only keeps weak references to tasks, so detached runs are held here until they finish
+_running = set()
+
+async def _finish(flight, func):
+    try:
+        flight.finish(result=await func(flight))
+    except Exception as e:
+        flight.finish(error=e)
+
+def run_detached(func):
+    """
+    Starts `func(flight)` as a background task and returns its flight. Followers can come and go
+    (e.g. a client disconnecting mid-stream) without cancelling the work.
+    """
+    flight = Flight()
+    flight.task = asyncio.create_task(_finish(flight, func))
+    _running.add(flight.task)
+    flight.task.add_done_callback(_running.discard)
+    return flight
+
+class SingleFlight:
+    """
+    Coalesces duplicate requests. The first caller for a key starts `func(flight)` as a background
+    task, so it keeps running if that caller goes away; later callers with any of the same keys join
+    the same flight until `ttl_seconds` after it succeeds. Failed flights are dropped as soon as they
+    finish, so a retry starts afresh. All methods run on the event loop, so no locking is needed.
+    """
+
+    def __init__(self, ttl_seconds):
+        self.ttl_seconds = ttl_seconds
+        self.flights = {}
+        self.started = 0
+        self.coalesced = 0
+
+    def _expire(self):
+        cutoff = time.monotonic() - self.ttl_seconds
+        for key in [key for key, flight in self.flights.items() if flight.done and flight.finished_at < cutoff]:
+            del self.flights[key]
+
+    def forget(self, predicate):
+        """Drops every flight for which `predicate(flight)` is true, so the next caller with its keys starts afresh."""
+        for key in [key for key, flight in self.flights.items() if predicate(flight)]:
+            del self.flights[key]
+
+    def find(self, keys):
+        """Returns the live or remembered flight registered under any of `keys`, without joining it."""
+        self._expire()
+        for key in keys:
+            if key in self.flights:
+                return self.flights[key]
+        return None
+
+    def join(self, keys, func, payload=None):
+        """
+        Returns (flight, joined): the flight registered under any of `keys`, or a new one running `func`.
+        A flight is only joined for the same `payload`; raises KeyReused if one of the keys belongs to
+        a flight for a different payload, rather than answering with that flight's result.
+        """
+        self._expire()
+        existing = [(key, self.flights.get(key)) for key in keys]
+        for key, flight in existing:
+            if flight is not None and flight.payload != payload:
+                raise KeyReused(key)
+        for key, flight in existing:
+            if flight is not None:
+                for other_key in keys:
+                    self.flights.setdefault(other_key, flight)
+                self.coalesced += 1
+                return flight, True
+
+        flight = Flight(payload)
+        for key in keys:
+            self.flights[key] = flight
+        flight.task = asyncio.create_task(self._run(flight, func))
+        self.started += 1
+        return flight, False
+
+    async def _run(self, flight, func):
+        try:
+            flight.finish(result=await func(flight))
+        except Exception as e:
+            self.forget(lambda existing: existing is flight)
+            flight.finish(error=e)
+
+    def stats(self):
+        return {
+            "started": self.started,
+            "coalesced": self.coalesced,
+            "in_flight": len({id(flight) for flight in self.flights.values() if not flight.done}),
+            "remembered": len({id(flight) for flight in self.flights.values()}),
+        }
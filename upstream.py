@@ -0,0 +1,218 @@
+import os
+import time
+import random
+import asyncio
+from contextlib import asynccontextmanager
+import httpx
+from langchain_core.embeddings import Embeddings
+
+import metrics
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+class UpstreamOverloaded(Exception):
+    """Raised instead of queueing when a provider already has a full queue of waiting calls."""
+
+    def __init__(self, name, retry_after):
+        super().__init__(f"{name} is overloaded; try again in {retry_after} seconds")
+        self.name = name
+        self.retry_after = retry_after
+
+def is_retryable(exc):
+    """
+    True for rate limiting (429), server errors (5xx) and transport failures. Status codes are read
+    from httpx errors and from google.api_core exceptions, which carry the HTTP status as `code`.
+    """
+    if isinstance(exc, httpx.HTTPStatusError):
+        return exc.response.status_code in RETRYABLE_STATUS_CODES
+    if isinstance(exc, httpx.TransportError):
+        return True
+    return getattr(exc, "code", None) in RETRYABLE_STATUS_CODES or getattr(exc, "status_code", None) in RETRYABLE_STATUS_CODES
+
+def _retry_after(exc):
+    """Returns the delay a provider asked for in a Retry-After header, if any."""
+    if isinstance(exc, httpx.HTTPStatusError):
+        try:
+            return float(exc.response.headers.get("Retry-After", ""))
+        except ValueError:
+            return None
+    return None
+
+class Upstream:
+    """
+    Admission control for one external provider.
+
+    Each call first takes a token from a bucket refilled at `rate` per second (up to `burst`), then
+    one of `concurrency` slots. Callers waiting for either count against `max_queue`; once it is
+    full, new calls fail immediately with UpstreamOverloaded rather than piling up behind a provider
+    that is already saturated. `call` retries retryable failures with full-jitter exponential backoff.
+    All methods run on the event loop, so plain counters need no locking.
+    """
+
+    def __init__(self, name, concurrency, rate, burst, max_queue, max_attempts=3, base_delay=1.0, max_delay=20.0):
+        self.name = name
+        self.concurrency = concurrency
+        self.rate = rate
+        self.burst = burst
+        self.max_queue = max_queue
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._semaphore = None
+        self._tokens = float(burst)
+        self._refilled_at = time.monotonic()
+        self.in_flight = 0
+        self.waiting = 0
+        self.calls = 0
+        self.rejected = 0
+        self.retries = 0
+        self.failures = 0
+        self.total_wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def _get_semaphore(self):
+        # Created lazily so it binds to the running event loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self._semaphore
+
+    async def _take_token(self):
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) * self.rate)
+            self._refilled_at = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def is_saturated(self):
+        """True if a new call would be rejected right now."""
+        return self.waiting >= self.max_queue
+
+    def retry_after_seconds(self):
+        """A rough estimate of how long a rejected caller should back off."""
+        return max(1, round(self.waiting / self.rate))
+
+    def reject(self):
+        """Counts a call turned away for a full queue and returns the exception to raise for it."""
+        self.rejected += 1
+        upstream_rejections.inc(provider=self.name)
+        return UpstreamOverloaded(self.name, self.retry_after_seconds())
+
+    @asynccontextmanager
+    async def slot(self):
+        """
+        Holds a rate-limited concurrency slot for the duration of the block. Streaming calls use this
+        directly, since a stream that has already produced output can't be transparently retried.
+        """
+        if self.is_saturated():
+            raise self.reject()
+        started = time.perf_counter()
+        self.waiting += 1
+        try:
+            await self._take_token()
+            await self._get_semaphore().acquire()
+        finally:
+            self.waiting -= 1
+        waited = time.perf_counter() - started
+        upstream_wait_seconds.observe(waited, provider=self.name)
+        self.total_wait_seconds += waited
+        self.max_wait_seconds = max(self.max_wait_seconds, waited)
+        self.calls += 1
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            self._get_semaphore().release()
+
+    async def call(self, func, *args, **kwargs):
+        """Awaits `func(*args, **kwargs)` in a slot, retrying retryable failures with jittered backoff."""
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                async with self.slot():
+                    return await func(*args, **kwargs)
+            except UpstreamOverloaded:
+                raise
+            except Exception as e:
+                if attempt == self.max_attempts or not is_retryable(e):
+                    self.failures += 1
+                    metrics.upstream_errors.inc(provider=self.name, retried="false")
+                    raise
+                self.retries += 1
+                metrics.upstream_errors.inc(provider=self.name, retried="true")
+                delay = _retry_after(e) or random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+                print(f"⏳ {self.name} call failed ({e}); retry {attempt}/{self.max_attempts - 1} in {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+    def stats(self):
+        """Returns queue depth, concurrency in use, wait times and retry/rejection counters."""
+        return {
+            "in_flight": self.in_flight,
+            "concurrency": self.concurrency,
+            "queue_depth": self.waiting,
+            "max_queue": self.max_queue,
+            "calls": self.calls,
+            "rejected": self.rejected,
+            "retries": self.retries,
+            "failures": self.failures,
+            "avg_wait_ms": round(self.total_wait_seconds / self.calls * 1000, 1) if self.calls else 0.0,
+            "max_wait_ms": round(self.max_wait_seconds * 1000, 1),
+        }
+
+class LimitedEmbeddings(Embeddings):
+    """
+    Routes an embeddings model's async calls through an Upstream. The sync methods pass straight
+    through; they are only used by the offline index builder, which bounds its own concurrency.
+    """
+
+    def __init__(self, embeddings, upstream):
+        self.embeddings = embeddings
+        self.upstream = upstream
+
+    def embed_documents(self, texts):
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text):
+        return self.embeddings.embed_query(text)
+
+    async def aembed_documents(self, texts):
+        return await self.upstream.call(self.embeddings.aembed_documents, texts)
+
+    async def aembed_query(self, text):
+        return await self.upstream.call(self.embeddings.aembed_query, text)
+
+# Limits are per process, so with several server workers each gets an equal share of the provider's
+WORKER_COUNT = max(1, int(os.environ.get("WEB_CONCURRENCY", "1")))
+
+def _from_env(name, prefix, concurrency, rate, burst, max_queue):
+    """
+    Builds an Upstream whose limits can be overridden with <PREFIX>_CONCURRENCY, _RATE, _BURST and
+    _MAX_QUEUE. The limits are totals across all workers; each worker keeps at least one slot.
+    """
+    return Upstream(
+        name,
+        concurrency=max(1, int(os.environ.get(f"{prefix}_CONCURRENCY", concurrency)) // WORKER_COUNT),
+        rate=float(os.environ.get(f"{prefix}_RATE", rate)) / WORKER_COUNT,
+        burst=max(1, int(os.environ.get(f"{prefix}_BURST", burst)) // WORKER_COUNT),
+        max_queue=max(1, int(os.environ.get(f"{prefix}_MAX_QUEUE", max_queue)) // WORKER_COUNT),
+    )
+
+# --- Providers ---
+gemini = _from_env("gemini", "GEMINI", concurrency=8, rate=4, burst=8, max_queue=64)
+embeddings = _from_env("embeddings", "EMBEDDINGS", concurrency=8, rate=20, burst=20, max_queue=128)
+stability = _from_env("stability", "STABILITY", concurrency=2, rate=1, burst=2, max_queue=32)
+
+PROVIDERS = (gemini, embeddings, stability)
+
+# --- Metrics ---
+upstream_wait_seconds = metrics.Histogram("oneiromind_upstream_wait_seconds", "Time calls waited for a rate token and a slot.", ("provider",))
+upstream_rejections = metrics.Counter("oneiromind_upstream_rejections_total", "Calls turned away because the queue was full.", ("provider",))
+metrics.GaugeFunc("oneiromind_upstream_queue_depth", "Calls waiting for a rate token or a slot.",
+                  lambda: [({"provider": provider.name}, provider.waiting) for provider in PROVIDERS])
+metrics.GaugeFunc("oneiromind_upstream_in_flight", "Calls currently running against the provider.",
+                  lambda: [({"provider": provider.name}, provider.in_flight) for provider in PROVIDERS])
+
+def stats():
+    return {provider.name: provider.stats() for provider in PROVIDERS}